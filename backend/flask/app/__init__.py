@@ -1,8 +1,11 @@
 import os
 from flask import Flask
+from .services.blob_spool import BLOB_SPOOL_MAX_BYTES
+from .services import scratch
 
 # Import the routes to register them with the application
 from . import routes
+from .routes import FORM_FIELDS_MAX_BYTES
 
 # The create_app function is a common pattern in Flask for creating a factory
 # that can be used to initialize the application in different environments (e.g., test, dev, prod).
@@ -12,6 +15,9 @@ def create_app(test_config=None):
     
     app.config.from_mapping(
         SECRET_KEY='dev',
+        # Reject oversized uploads before they are parsed, leaving some room for the form fields.
+        # /convert/batch raises the limit of its own requests to the batch size.
+        MAX_CONTENT_LENGTH=BLOB_SPOOL_MAX_BYTES + FORM_FIELDS_MAX_BYTES,
     )
 
     if test_config is None:
@@ -27,6 +33,9 @@ def create_app(test_config=None):
     except OSError:
         pass
 
+    # Pages rendered on demand by a previous run of this server may have been left behind
+    scratch.sweep_stale()
+
     app.register_blueprint(routes.bp)
 
     return app
\ No newline at end of file
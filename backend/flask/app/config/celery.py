@@ -1,4 +1,5 @@
 from celery import Celery
+from kombu import Queue
 import os
 from dotenv import load_dotenv
 
@@ -8,10 +9,28 @@ def make_celery(app_name=__name__):
     return Celery(
         app_name,
         broker=os.getenv("CELERY_BROKER_URL"),      # Use Redis as broker
-        backend=os.getenv("CELERY_RESULT_BACKEND")      # Store results in Redis
+        backend=os.getenv("CELERY_RESULT_BACKEND"),      # Store results in Redis
+        # Loaded by the workers only, the web tier sends the tasks by name (see services/task_signatures.py)
+        include=['app.services.celery_tasks']
     )
 
 celery = make_celery()
 
+# Conversion jobs are routed by size and type (see services/job_routing.py), each queue has its own workers.
+# Workers take one job at a time, so a long job never sits on short ones it has already prefetched.
+CONVERSION_QUEUES = ('conversion-small', 'conversion-large', 'conversion-docx')
+# Results are polled while a task runs and shortly after it finishes, they don't need to outlive a day
+RESULT_EXPIRES_SECONDS = int(os.getenv("CELERY_RESULT_EXPIRES_SECONDS", 24 * 60 * 60))
+
+celery.conf.update(
+    task_queues=[Queue('celery')] + [Queue(name) for name in CONVERSION_QUEUES],
+    task_default_queue='celery',
+    worker_prefetch_multiplier=int(os.getenv("CELERY_PREFETCH_MULTIPLIER", 1)),
+    task_default_priority=5,
+    result_expires=RESULT_EXPIRES_SECONDS,
+    # Redis emulates priorities with one list per level, taken from 0 to 9
+    broker_transport_options={'priority_steps': list(range(10)), 'sep': ':', 'queue_order_strategy': 'priority'}
+)
+
 # .\.venv\Scripts\activate
 # celery -A app.config.celery worker --loglevel=info --pool=solo
\ No newline at end of file
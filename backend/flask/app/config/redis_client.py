@@ -0,0 +1,11 @@
+import os
+import redis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Falls back to the Celery broker, which is a Redis instance as well
+REDIS_URL = os.getenv("REDIS_URL", os.getenv("CELERY_BROKER_URL"))
+
+# from_url() doesn't connect until the first command is sent
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
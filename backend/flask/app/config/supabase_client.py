@@ -1,5 +1,5 @@
 import os
-from supabase import create_client, Client
+import threading
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -8,5 +8,41 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
 SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+# Created on first use rather than at import time, importing supabase alone takes a noticeable part of a cold start
+_client = None
+# Whether _client was created here, a client given to set_client() is kept across forks
+_client_owned = False
+_client_lock = threading.Lock()
 
+def get_client():
+    """
+    Returns the Supabase client of this process, creating it on first use.
+    Every request of the process goes through it, so its HTTP connections are kept alive and reused.
+    """
+    global _client, _client_owned
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from supabase import create_client
+                _client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+                _client_owned = True
+    return _client
+
+def set_client(new_client):
+    """
+    Replaces the client of this process, returning the previous one, e.g. with a fake in benchmarks.
+    """
+    global _client, _client_owned
+    with _client_lock:
+        previous, _client, _client_owned = _client, new_client, False
+    return previous
+
+def _reset_after_fork():
+    # A forked process (gunicorn or Celery worker) must not share the sockets of its parent,
+    # it creates its own client on first use. The lock may have been held by another thread at fork time.
+    global _client, _client_owned, _client_lock
+    _client_lock = threading.Lock()
+    if _client_owned:
+        _client, _client_owned = None, False
+
+os.register_at_fork(after_in_child=_reset_after_fork)
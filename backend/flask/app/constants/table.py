@@ -6,3 +6,7 @@ class TABLE(Enum):
     MATERIAL_SUMMARY = 'MaterialSummary'
     RATING = 'Rating'
     TASK = 'Task'
+
+class RPC(Enum):
+    CREATE_MATERIAL_BUNDLE = 'create_material_bundle'
+    SEARCH_MATERIAL_PAGES = 'search_material_pages'
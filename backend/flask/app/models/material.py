@@ -1,25 +1,66 @@
-from ..config.supabase_client import SUPABASE_BUCKET, supabase
+from ..config.supabase_client import SUPABASE_BUCKET, get_client
 import uuid
-from ..constants.table import TABLE
+from ..constants.table import TABLE, RPC
 from datetime import datetime
 
+_storage_bucket = None
+
+def get_storage_bucket():
+    # Share one bucket proxy, and so one pooled HTTP client, between all upload threads.
+    # It is made again when the client changes, e.g. in a forked process.
+    global _storage_bucket
+    client = get_client()
+    if _storage_bucket is None or _storage_bucket[0] is not client:
+        _storage_bucket = (client, client.storage.from_(SUPABASE_BUCKET))
+    return _storage_bucket[1]
+
 class Material:
     @staticmethod
-    def upload_and_get_link(file_path: str) -> str:
-        with open(file_path, "rb") as file:
-            response = supabase.storage.from_(SUPABASE_BUCKET).upload(file=file, path=file_path)
-            print(response)
+    def upload_and_get_link(file_path: str, storage_path: str = None, data: bytes = None) -> str:
+        # The object is stored under its local path unless a storage path is given.
+        # Pages kept in memory (see scratch.ScratchSpace) are uploaded from data, without a local file.
+        storage_path = storage_path or file_path
+        bucket = get_storage_bucket()
+        # Upsert so that a retried upload doesn't fail on the object written by the previous attempt
+        if data is not None:
+            response = bucket.upload(file=data, path=storage_path, file_options={"upsert": "true"})
+        else:
+            with open(file_path, "rb") as file:
+                response = bucket.upload(file=file, path=storage_path, file_options={"upsert": "true"})
+        print(response)
 
         if response.path is not None:
-            public_url = supabase.storage.from_(SUPABASE_BUCKET).get_public_url(file_path)
-            print(f'Uploaded {file_path} to Supabase storage. Public URL: {public_url}')
+            public_url = bucket.get_public_url(storage_path)
+            print(f'Uploaded {file_path or storage_path} to Supabase storage. Public URL: {public_url}')
             return public_url
         else:
             raise Exception("Failed to upload file to Supabase storage")
 
     @staticmethod
-    def create_task_record(task_id: str, material_id: str, content: str, status: str):
-        data = {
+    def download_file(storage_path: str, dest_path: str):
+        data = get_storage_bucket().download(storage_path)
+        with open(dest_path, "wb") as file:
+            file.write(data)
+        print(f'Downloaded {storage_path} from Supabase storage to {dest_path}')
+        return dest_path
+
+    @staticmethod
+    def copy_and_get_link(source_path: str, dest_path: str) -> str:
+        # Server-side copy, the object never leaves storage
+        bucket = get_storage_bucket()
+        try:
+            bucket.copy(source_path, dest_path)
+        except Exception:
+            # Copies don't upsert, so a retried task replaces the object copied by its previous attempt
+            bucket.remove([dest_path])
+            bucket.copy(source_path, dest_path)
+        public_url = bucket.get_public_url(dest_path)
+        print(f'Copied {source_path} to {dest_path} in Supabase storage. Public URL: {public_url}')
+        return public_url
+
+    @staticmethod
+    def task_record(task_id: str, material_id: str, content: str, status: str) -> dict:
+        return {
             "task_id": task_id,
             "material_id": material_id,
             "created_date": datetime.now().isoformat(),
@@ -27,46 +68,44 @@ class Material:
             "status": status
         }
 
-        response = supabase.table(TABLE.TASK.value).insert(data).execute()
-        print(f'Created task record in Supabase: {response}')
-        return response
-
-    @staticmethod
-    def update_pending_task_record(task_id: str, material_id: str, content: str):
-        data = {
-            "status": "pending",
-            "material_id": material_id,
-            "content": content
-        }
-
-        response = supabase.table(TABLE.TASK.value).update(data).eq("task_id", task_id).eq("status", "pending").execute()
-        print(f'Updated task record in Supabase: {response}')
-        return response
-    
-    @staticmethod
-    def create_material_record(info: dict):
-        response = supabase.table(TABLE.MATERIAL.value).insert(info).execute()
-        print(f'Created material record in Supabase: {response}')
-        return response
-    
     @staticmethod
-    def create_material_page_record(material_id: str, public_links: list):
-        records = [
-            {
+    def material_page_records(material_id: str, public_links: list, page_texts: dict = None, page_summaries: dict = None) -> list:
+        records = []
+        for link_info in public_links:
+            record = {
                 "material_id": material_id,
                 "page": link_info["page"],
-                "url": link_info["url"]
+                "url": link_info["url"],
+                # Pages past LAZY_RENDER_PAGES are rendered the first time they are requested
+                "is_rendered": link_info.get("rendered", True)
             }
-            for link_info in public_links
-        ]
 
-        response = supabase.table(TABLE.MATERIAL_PAGE.value).insert(records).execute()
-        print(f'Created material page records in Supabase: {response}')
-        return response
+            # The local text layer of the page, see text_layer.extract_page_texts
+            if page_texts is not None:
+                record["text_content"] = page_texts.get(link_info["page"])
+            # The summary section of the page, indexed for search together with the text
+            if page_summaries is not None:
+                record["summary_content"] = page_summaries.get(link_info["page"])
+
+            # Rendition details, see page_encoder.encode_renditions
+            renditions = link_info.get("renditions")
+            if renditions:
+                reader = renditions["reader"]
+                record.update({
+                    "thumbnail_url": renditions.get("thumbnail", {}).get("url"),
+                    "zoom_url": renditions.get("zoom", {}).get("url"),
+                    "width": reader["width"],
+                    "height": reader["height"],
+                    "byte_size": reader["bytes"],
+                    "content_kind": link_info.get("kind")
+                })
+            records.append(record)
+
+        return records
 
     @staticmethod
-    def create_summary_record(user_id: str, material_id: str, content: str, usage: dict):
-        data = {
+    def summary_record(user_id: str, material_id: str, content: str, usage: dict) -> dict:
+        return {
             "summary_id": f"{user_id}-{str(uuid.uuid4())}",
             "material_id": material_id,
             "content": content,
@@ -75,14 +114,10 @@ class Material:
             "total_token_count": usage["total_token_count"]
         }
 
-        response = supabase.table(TABLE.MATERIAL_SUMMARY.value).insert(data).execute()
-        print(f'Created summary record in Supabase: {response}')
-        return response
-    
     @staticmethod
-    def create_material_rating_record(material_id: str):
+    def material_rating_records(material_id: str) -> list:
         MAX_STAR_LEVEL = 5
-        records = [
+        return [
             {
                 "material_id": material_id,
                 "star_level": star_level,
@@ -91,6 +126,125 @@ class Material:
             for star_level in range(1, MAX_STAR_LEVEL + 1)
         ]
 
-        response = supabase.table(TABLE.RATING.value).insert(records).execute()
-        print(f'Created material rating records in Supabase: {response}')
+    @staticmethod
+    def create_task_record(task_id: str, material_id: str, content: str, status: str):
+        data = Material.task_record(task_id, material_id, content, status)
+
+        response = get_client().table(TABLE.TASK.value).insert(data).execute()
+        print(f'Created task record in Supabase: {response}')
+        return response
+
+    @staticmethod
+    def get_pending_task_content(task_id: str):
+        response = get_client().table(TABLE.TASK.value).select("content").eq("task_id", task_id).eq("status", "pending").limit(1).execute()
+        return response.data[0]["content"] if response.data else None
+
+    @staticmethod
+    def update_pending_task_record(task_id: str, material_id: str, content: str):
+        data = {
+            "status": "pending",
+            "material_id": material_id,
+            "content": content
+        }
+
+        response = get_client().table(TABLE.TASK.value).update(data).eq("task_id", task_id).eq("status", "pending").execute()
+        print(f'Updated task record in Supabase: {response}')
+        return response
+    
+    @staticmethod
+    def is_publicly_viewable(material_id: str) -> bool:
+        # The rule of search_material_pages (see database/schema.sql): public materials that aren't paid
+        response = get_client().table(TABLE.MATERIAL.value).select("is_public, is_paid").eq("material_id", material_id).limit(1).execute()
+        if not response.data:
+            return False
+        material = response.data[0]
+        return bool(material.get("is_public")) and not material.get("is_paid")
+
+    @staticmethod
+    def get_material_page_record(material_id: str, page: int):
+        response = get_client().table(TABLE.MATERIAL_PAGE.value).select("*").eq("material_id", material_id).eq("page", page).limit(1).execute()
+        return response.data[0] if response.data else None
+
+    @staticmethod
+    def get_material_page_texts(material_id: str) -> dict:
+        response = get_client().table(TABLE.MATERIAL_PAGE.value).select("page, text_content").eq("material_id", material_id).execute()
+        return {row["page"]: row["text_content"] for row in response.data if row.get("text_content")}
+
+    @staticmethod
+    def search_pages(query: str, limit: int, offset: int) -> list:
+        # Ranked by the search_material_pages function over the GIN index of MaterialPage (see database/schema.sql)
+        response = get_client().rpc(RPC.SEARCH_MATERIAL_PAGES.value, {
+            "query": query,
+            "result_limit": limit,
+            "result_offset": offset
+        }).execute()
+        return response.data or []
+
+    @staticmethod
+    def update_material_page_record(material_id: str, page: int, rendered: dict):
+        record = Material.material_page_records(material_id, [rendered])[0]
+
+        response = get_client().table(TABLE.MATERIAL_PAGE.value).update(record).eq("material_id", material_id).eq("page", page).execute()
+        print(f'Updated material page record in Supabase: {response}')
+        return response
+
+    @staticmethod
+    def get_summary_record(material_id: str):
+        response = get_client().table(TABLE.MATERIAL_SUMMARY.value).select("*").eq("material_id", material_id).limit(1).execute()
+        return response.data[0] if response.data else None
+
+class MaterialBundle:
+    """
+    Buffers every record of a converted material and writes them with a single RPC.
+    The create_material_bundle function (see database/schema.sql) runs in one transaction,
+    so a failing insert rolls back the whole bundle instead of leaving an orphan Material row.
+    """
+    def __init__(self, material_id: str):
+        self.material_id = material_id
+        self.material = None
+        self.pages = []
+        self.summary = None
+        self.ratings = []
+        self.tasks = []
+        self.pending_task = None
+
+    def add_material(self, info: dict):
+        self.material = info
+        return self
+
+    def add_pages(self, public_links: list, page_texts: dict = None, page_summaries: dict = None):
+        self.pages.extend(Material.material_page_records(self.material_id, public_links, page_texts, page_summaries))
+        return self
+
+    def add_summary(self, user_id: str, content: str, usage: dict):
+        self.summary = Material.summary_record(user_id, self.material_id, content, usage)
+        return self
+
+    def add_ratings(self):
+        self.ratings = Material.material_rating_records(self.material_id)
+        return self
+
+    def add_task(self, task_id: str, content: str, status: str):
+        self.tasks.append(Material.task_record(task_id, self.material_id, content, status))
+        return self
+
+    def update_pending_task(self, task_id: str, content: str):
+        self.pending_task = {
+            "task_id": task_id,
+            "content": content
+        }
+        return self
+
+    def commit(self):
+        payload = {
+            "material": self.material,
+            "pages": self.pages,
+            "summary": self.summary,
+            "ratings": self.ratings,
+            "tasks": self.tasks,
+            "pending_task": self.pending_task
+        }
+
+        response = get_client().rpc(RPC.CREATE_MATERIAL_BUNDLE.value, {"payload": payload}).execute()
+        print(f'Committed material bundle {self.material_id} in Supabase ({len(self.pages)} pages)')
         return response
@@ -1,8 +1,36 @@
-from flask import Blueprint, request, jsonify
+import os
+import json
+import time
+import zipfile
+from datetime import datetime, timezone
+from flask import Blueprint, Response, request, jsonify, redirect, send_file, stream_with_context
 
 from .config.celery import celery
-from .services.celery_tasks import convert_pdf_to_webp as celery_convert_pdf_to_webp
-from .services.celery_tasks import convert_docx_to_webp as celery_convert_docx_to_webp
+from .config.redis_client import redis_client
+from .services.task_signatures import conversion_signature
+from .services.blob_spool import spool_upload, store as blob_store, BlobTooLargeError
+from .services.job_routing import route_job, estimate_job_cost, choose_queue
+from .services import admission
+from .services import batches
+from .services import task_status
+from .services.progress import progress_channel, FINAL_STAGES
+from .models.material import Material
+
+SEARCH_DEFAULT_PER_PAGE = 20
+SEARCH_MAX_PER_PAGE = 50
+# Deep pages of a ranked search cost as much as every page before them
+SEARCH_MAX_OFFSET = 1000
+# Pages served from the rendered-page cache never change, so browsers may keep them
+PAGE_MAX_AGE_SECONDS = 24 * 60 * 60
+# How often an idle event stream checks the task and sends a keep-alive comment
+EVENT_STREAM_KEEPALIVE_SECONDS = 15
+# Streams are closed after this long, EventSource reconnects on its own (with Last-Event-ID)
+EVENT_STREAM_MAX_SECONDS = int(os.getenv("EVENT_STREAM_MAX_SECONDS", 5 * 60))
+# How long the browser waits before it reconnects a closed stream
+EVENT_STREAM_RETRY_MS = 3000
+
+# Room for the form fields of an upload on top of its files
+FORM_FIELDS_MAX_BYTES = 1024 * 1024
 
 # Create a Blueprint for the routes.
 bp = Blueprint('routes', __name__, url_prefix='/')
@@ -11,42 +39,299 @@ bp = Blueprint('routes', __name__, url_prefix='/')
 def index():
     return "Welcome to the File Conversion Service!"
 
-@bp.route('/convert/pdf-to-webp', methods=['POST'])
-def convert_pdf_to_webp():
+def enqueue_conversion(kind):
+    """
+    Spools the upload and queues its conversion, unless the queue it belongs to is over its backlog limits.
+
+    Returns:
+        A 202 response with the task id and the estimated completion time, or a 429 response with a Retry-After header.
+    """
     file = request.files['file']
     form = request.form.to_dict()
-    file_bytes = file.read()
-    file_info = {
-        'filename': file.filename,
-        'content_type': file.content_type,
-        'data': file_bytes.hex()  # convert bytes to hex string for JSON serialization
-    }
-    task = celery_convert_pdf_to_webp.apply_async(args=[file_info, form])
-    return jsonify({'task_id': task.id}), 202
+
+    # Stream the upload to the shared spool, only its reference goes through the broker
+    try:
+        file_info = spool_upload(file)
+    except BlobTooLargeError as e:
+        return jsonify({'error': str(e)}), 413
+
+    # The queue depends on the size of the job, and so does the time it will take
+    cost = estimate_job_cost(file_info, kind)
+    queue = choose_queue(cost)
+    decision = admission.admit(queue, cost)
+    if not decision['admitted']:
+        blob_store.delete(file_info['blob'])
+        return busy_response(decision)
+
+    admission.record_enqueued(file_info, queue, cost)
+    # Pick the priority from the estimated cost of the job
+    task = conversion_signature(kind, file_info, form, **route_job(file_info, form, kind, cost)).apply_async()
+
+    return jsonify({
+        'task_id': task.id,
+        'eta_seconds': decision['eta_seconds'],
+        'estimated_completion_at': completion_time(decision['eta_seconds'])
+    }), 202
+
+def completion_time(eta_seconds):
+    if eta_seconds is None:
+        return None
+    return datetime.fromtimestamp(time.time() + eta_seconds, timezone.utc).isoformat()
+
+def busy_response(decision):
+    response = jsonify({
+        'error': 'The conversion service is busy, try again later',
+        'retry_after': decision['retry_after'],
+        'eta_seconds': decision['eta_seconds']
+    })
+    response.headers['Retry-After'] = str(decision['retry_after'])
+    return response, 429
+
+@bp.route('/convert/pdf-to-webp', methods=['POST'])
+def convert_pdf_to_webp():
+    return enqueue_conversion('pdf')
 
 @bp.route('/convert/docx-to-webp', methods=['POST'])
 def convert_docx_to_webp():
-    file_bytes = request.files['file'].read()
-    form = request.form.to_dict()
-    task = celery_convert_docx_to_webp.apply_async(args=[file_bytes, form])
-    return jsonify({'task_id': task.id}), 202
+    return enqueue_conversion('docx')
+
+@bp.route('/convert/batch', methods=['POST'])
+def convert_batch():
+    """
+    Converts many files in one request, as a single batch. The request has any number of "file" parts,
+    PDF and DOCX files or zip archives of them, and two optional JSON fields: info (material fields shared
+    by every file, like user_id and lesson_id) and items (filename -> material fields of that file, files of a zip
+    archive are named by their path in it).
+    """
+    # Only batches may be larger than a single file, see MAX_CONTENT_LENGTH in create_app
+    request.max_content_length = batches.BATCH_MAX_BYTES + FORM_FIELDS_MAX_BYTES
+    files = request.files.getlist('file')
+    if not files:
+        return jsonify({'error': 'No files in the batch'}), 400
+
+    try:
+        shared_info = json.loads(request.form.get('info', '{}'))
+        items = json.loads(request.form.get('items', '{}'))
+    except ValueError:
+        return jsonify({'error': 'info and items must be JSON objects'}), 400
+
+    try:
+        uploads, skipped = batches.spool_batch(files)
+    except (BlobTooLargeError, batches.BatchTooLargeError) as e:
+        return jsonify({'error': str(e)}), 413
+    except zipfile.BadZipFile:
+        return jsonify({'error': 'Invalid zip archive'}), 400
+
+    if not uploads:
+        return jsonify({'error': 'No PDF or DOCX files in the batch', 'skipped': skipped}), 400
+
+    jobs = batches.plan_jobs(uploads, shared_info, items, request.form.get('quality'))
+    decision = batches.admit(jobs)
+    if not decision['admitted']:
+        batches.discard(uploads)
+        return busy_response(decision)
+
+    batch = batches.enqueue(jobs)
+    return jsonify(dict(
+        batch,
+        skipped=skipped,
+        eta_seconds=decision['eta_seconds'],
+        estimated_completion_at=completion_time(decision['eta_seconds'])
+    )), 202
+
+@bp.route('/batch-status/<batch_id>', methods=['GET'])
+def get_batch_status(batch_id):
+    status = batches.get_status(batch_id)
+    if status is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    return conditional_json(status)
+
+@bp.route('/convert/backlog', methods=['GET'])
+def get_conversion_backlog():
+    """
+    Returns the backlog of each conversion queue, so clients can show the wait before uploading.
+    """
+    backlog = admission.backlog_snapshot()
+    if backlog is None:
+        return jsonify({'error': 'The backlog is not available'}), 503
+    return jsonify({
+        queue: {
+            'queued_jobs': state['depth'],
+            'workers': state['slots'],
+            'backlog_seconds': int(state['backlog_seconds'])
+        } for queue, state in backlog.items()
+    })
+
+def conditional_json(payload):
+    """
+    Returns payload as JSON with an ETag. Pollers send it back in If-None-Match and get an empty 304
+    as long as nothing changed.
+    """
+    response = jsonify(payload)
+    response.add_etag()
+    # Browsers may keep the response, but must check it is still current before using it
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+def wants_details():
+    return request.args.get('details', '').lower() in ('1', 'true')
 
 @bp.route('/task-status/<task_id>', methods=['GET'])
 def get_task_status(task_id):
+    """
+    Returns the state of a task. Add details=1 for the full progress event or result.
+    """
+    return conditional_json(task_status.get_statuses([task_id], wants_details())[task_id])
+
+@bp.route('/task-status', methods=['GET', 'POST'])
+def get_task_statuses():
+    """
+    Returns the state of many tasks at once, read from the result backend in a single round trip.
+    The ids are given as ?ids=a,b,c or as a JSON body {"ids": [...]}. Add details=1 for the full results.
+    """
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        task_ids = body.get('ids', [])
+    else:
+        task_ids = [task_id for task_id in request.args.get('ids', '').split(',') if task_id]
+
+    if not isinstance(task_ids, list) or not all(isinstance(task_id, str) for task_id in task_ids) or not task_ids:
+        return jsonify({'error': 'ids must be a non-empty list of task ids'}), 400
+    if len(task_ids) > task_status.TASK_STATUS_MAX_IDS:
+        return jsonify({'error': f'At most {task_status.TASK_STATUS_MAX_IDS} task ids per request'}), 400
+
+    return conditional_json({'tasks': task_status.get_statuses(task_ids, wants_details())})
+
+@bp.route('/materials/<material_id>/page/<int:page>.webp', methods=['GET'])
+def get_material_page(material_id, page):
+    """
+    Serves a page of a material, rendering it on first request when it wasn't rendered at upload time.
+    """
+    # Imported on the first page request, on-demand rendering is the only part of the web tier that needs
+    # the conversion stack (pdf2image, PIL and the office converters)
+    from .services import lazy_renderer
+    from .services.page_encoder import PAGE_RENDITIONS
+
+    rendition = request.args.get('rendition', 'reader')
+    if rendition not in PAGE_RENDITIONS:
+        return jsonify({'error': f'Unknown rendition {rendition}'}), 400
+
+    # Pages of private and paid materials are not served, like in search
+    if not Material.is_publicly_viewable(material_id):
+        return jsonify({'error': 'Page not found'}), 404
+
+    # A cached page may be evicted by another worker before it is sent, it is then rendered again
+    for _ in range(2):
+        try:
+            result = lazy_renderer.get_page(material_id, page, rendition)
+        except Exception as e:
+            return jsonify({'error': f'Rendering failed: {str(e)}'}), 500
+
+        if result is None:
+            return jsonify({'error': 'Page not found'}), 404
+
+        kind, location = result
+        if kind == 'url':
+            return redirect(location)
+        try:
+            return send_file(location, mimetype='image/webp', max_age=PAGE_MAX_AGE_SECONDS)
+        except FileNotFoundError:
+            continue
+    return jsonify({'error': 'The page could not be served, try again'}), 503
+
+@bp.route('/search', methods=['GET'])
+def search_material_pages():
+    """
+    Searches the text of every public material page. Query parameters: q, page (from 1) and per_page.
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Missing search query'}), 400
+
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = min(max(int(request.args.get('per_page', SEARCH_DEFAULT_PER_PAGE)), 1), SEARCH_MAX_PER_PAGE)
+    except ValueError:
+        return jsonify({'error': 'page and per_page must be integers'}), 400
+
+    offset = (page - 1) * per_page
+    if offset > SEARCH_MAX_OFFSET:
+        return jsonify({'error': f'Results past the first {SEARCH_MAX_OFFSET} are not available, refine the query'}), 400
+
+    # One extra row tells whether there is a next page without counting every match
+    hits = Material.search_pages(query, per_page + 1, offset)
+    return jsonify({
+        'query': query,
+        'page': page,
+        'per_page': per_page,
+        'has_more': len(hits) > per_page,
+        'results': hits[:per_page]
+    })
+
+def format_sse(data, event=None, event_id=None):
+    message = f"data: {json.dumps(data)}\n\n"
+    if event:
+        message = f"event: {event}\n{message}"
+    return f"id: {event_id}\n{message}" if event_id is not None else message
+
+def progress_event_id(event):
+    # Progress events are snapshots of the task, the time since the attempt started orders them
+    return f"{event.get('stage')}:{event.get('elapsed')}" if isinstance(event, dict) else None
+
+@bp.route('/task-events/<task_id>', methods=['GET'])
+def stream_task_events(task_id):
+    """
+    Streams the progress events of a task as Server-Sent Events until the task finishes,
+    or for at most EVENT_STREAM_MAX_SECONDS, after which the client reconnects.
+    Answers 404 for a task that was never queued or whose result has expired.
+    """
+    # Subscribe before reading the current state so no event is missed in between
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(progress_channel(task_id))
     task = celery.AsyncResult(task_id)
+    # Queued tasks are in the SENT state (see task_signatures.mark_queued), PENDING means no record at all
     if task.state == 'PENDING':
-        response = {
-            'state': task.state,
-            'status': 'Pending...'
-        }
-    elif task.state != 'FAILURE':
-        response = {
-            'state': task.state,
-            'result': task.result
-        }
-    else:
-        response = {
-            'state': task.state,
-            'status': str(task.info),
+        pubsub.close()
+        return jsonify({'error': 'Unknown task'}), 404
+
+    last_event_id = request.headers.get('Last-Event-ID')
+
+    def generate():
+        try:
+            yield f"retry: {EVENT_STREAM_RETRY_MS}\n\n"
+            if task.state == 'PROGRESS':
+                # A reconnecting client already has this snapshot
+                if progress_event_id(task.info) != last_event_id:
+                    yield format_sse(task.info, 'progress', progress_event_id(task.info))
+            elif task.ready():
+                yield format_sse({'state': task.state}, 'end')
+                return
+
+            deadline = time.time() + EVENT_STREAM_MAX_SECONDS
+            while time.time() < deadline:
+                message = pubsub.get_message(timeout=min(EVENT_STREAM_KEEPALIVE_SECONDS, max(deadline - time.time(), 0)))
+                if message is None:
+                    # Covers tasks that finished without publishing a final event, e.g. a killed worker
+                    current = celery.AsyncResult(task_id)
+                    if current.ready():
+                        yield format_sse({'state': current.state}, 'end')
+                        return
+                    yield ": keep-alive\n\n"
+                    continue
+
+                event = json.loads(message['data'])
+                yield format_sse(event, 'progress', progress_event_id(event))
+                if event['stage'] in FINAL_STAGES:
+                    yield format_sse({'state': event['stage']}, 'end')
+                    return
+        finally:
+            pubsub.close()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # Don't let nginx buffer the stream
         }
-    return jsonify(response)
\ No newline at end of file
+    )
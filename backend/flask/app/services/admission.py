@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import socket
+import threading
+from dotenv import load_dotenv
+from prometheus_client import Counter
+from prometheus_client.core import GaugeMetricFamily
+from celery.signals import worker_ready, worker_shutdown, task_prerun, task_postrun
+from ..config.celery import CONVERSION_QUEUES, RESULT_EXPIRES_SECONDS
+from ..config.redis_client import redis_client
+
+load_dotenv()
+
+# Above either limit a queue stops accepting jobs, the convert endpoints answer 429 with a Retry-After
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "true").lower() == "true"
+ADMISSION_MAX_QUEUE_DEPTH = int(os.getenv("ADMISSION_MAX_QUEUE_DEPTH", 200))
+ADMISSION_MAX_BACKLOG_SECONDS = int(os.getenv("ADMISSION_MAX_BACKLOG_SECONDS", 30 * 60))
+ADMISSION_MIN_RETRY_AFTER_SECONDS = int(os.getenv("ADMISSION_MIN_RETRY_AFTER_SECONDS", 10))
+ADMISSION_MAX_RETRY_AFTER_SECONDS = int(os.getenv("ADMISSION_MAX_RETRY_AFTER_SECONDS", 10 * 60))
+# The backlog is read from Redis at most once per interval, however many uploads arrive
+ADMISSION_SNAPSHOT_SECONDS = float(os.getenv("ADMISSION_SNAPSHOT_SECONDS", 2))
+# Used until the workers have measured the real throughput of a queue
+DEFAULT_SECONDS_PER_PAGE = float(os.getenv("DEFAULT_SECONDS_PER_PAGE", 1.5))
+# Weight of the latest job in the moving average of the seconds per page
+THROUGHPUT_SMOOTHING = float(os.getenv("THROUGHPUT_SMOOTHING", 0.2))
+WORKER_HEARTBEAT_SECONDS = int(os.getenv("WORKER_HEARTBEAT_SECONDS", 15))
+
+QUEUED_PAGES_KEY = 'admission:queued-pages'
+SECONDS_PER_PAGE_KEY = 'admission:seconds-per-page'
+WORKER_KEY_PREFIX = 'admission:workers'
+# Set when a task is first taken off the backlog, retries and redeliveries of the task find it there
+STARTED_KEY_PREFIX = 'admission:started'
+# Matches the priority_steps of the broker (see config/celery.py)
+PRIORITY_STEPS = range(10)
+PRIORITY_SEPARATOR = ':'
+
+ADMISSION_DECISIONS = Counter(
+    'studyshare_admission_decisions_total', 'Conversion jobs accepted or rejected by admission control',
+    ['queue', 'decision']
+)
+
+def _priority_keys(queue):
+    # The Redis transport keeps one list per priority: "queue" for 0, then "queue:1" to "queue:9"
+    return [queue if priority == 0 else f"{queue}{PRIORITY_SEPARATOR}{priority}" for priority in PRIORITY_STEPS]
+
+def _decode(mapping):
+    return {key.decode() if isinstance(key, bytes) else key: float(value) for key, value in mapping.items()}
+
+def _worker_slots(queue_names):
+    """
+    Sums the concurrency of the live workers of each queue, as registered by their heartbeat.
+    """
+    slots = dict.fromkeys(queue_names, 0)
+    keys = list(redis_client.scan_iter(match=f"{WORKER_KEY_PREFIX}:*", count=100))
+    for value in (redis_client.mget(keys) if keys else []):
+        if value is None:
+            continue
+        worker = json.loads(value)
+        for queue in worker['queues']:
+            if queue in slots:
+                slots[queue] += worker['concurrency']
+    return slots
+
+def read_backlog():
+    """
+    Reads the backlog of every conversion queue from Redis.
+
+    Returns:
+        dict: For each queue, the queued jobs (depth) and pages, the worker slots, the measured seconds per page,
+        the total work left (work_seconds) and the time to drain it with the current workers (backlog_seconds).
+    """
+    with redis_client.pipeline() as pipe:
+        for queue in CONVERSION_QUEUES:
+            for key in _priority_keys(queue):
+                pipe.llen(key)
+        pipe.hgetall(QUEUED_PAGES_KEY)
+        pipe.hgetall(SECONDS_PER_PAGE_KEY)
+        results = pipe.execute()
+
+    queued_pages = _decode(results[-2])
+    seconds_per_page = _decode(results[-1])
+    slots = _worker_slots(CONVERSION_QUEUES)
+
+    backlog = {}
+    for index, queue in enumerate(CONVERSION_QUEUES):
+        depth = sum(results[index * len(PRIORITY_STEPS):(index + 1) * len(PRIORITY_STEPS)])
+        # The page counter only drifts when messages are lost, an empty queue resets it
+        pages = max(queued_pages.get(queue, 0), 0) if depth else 0
+        speed = seconds_per_page.get(queue, DEFAULT_SECONDS_PER_PAGE)
+        work_seconds = pages * speed
+        backlog[queue] = {
+            'depth': depth,
+            'pages': pages,
+            'slots': slots[queue],
+            'seconds_per_page': speed,
+            'work_seconds': work_seconds,
+            # With no worker running (scaled to zero), count on the first one the autoscaler starts
+            'backlog_seconds': work_seconds / max(slots[queue], 1)
+        }
+    return backlog
+
+_snapshot = None
+_snapshot_time = 0
+_snapshot_lock = threading.Lock()
+
+def backlog_snapshot():
+    """
+    Returns read_backlog(), cached for ADMISSION_SNAPSHOT_SECONDS. None when Redis can't be reached.
+    """
+    global _snapshot, _snapshot_time
+    if redis_client is None:
+        return None
+
+    with _snapshot_lock:
+        if _snapshot is not None and time.time() - _snapshot_time < ADMISSION_SNAPSHOT_SECONDS:
+            return _snapshot
+        try:
+            _snapshot = read_backlog()
+            _snapshot_time = time.time()
+        except Exception as e:
+            print(f"Could not read the conversion backlog: {e}")
+            return None
+        return _snapshot
+
+def admit(queue, cost):
+    """
+    Decides whether a conversion job may be queued and estimates when it will be done.
+    Redis being unreachable never blocks an upload, the job is admitted without an estimate.
+
+    Args:
+        queue (str): The queue chosen by job_routing.choose_queue.
+        cost (dict): The estimate of job_routing.estimate_job_cost.
+
+    Returns:
+        dict: admitted, eta_seconds (None when unknown) and retry_after (seconds) for a rejected job.
+    """
+    backlog = backlog_snapshot()
+    if backlog is None:
+        return {'admitted': True, 'eta_seconds': None, 'retry_after': None}
+
+    state = backlog[queue]
+    # The jobs ahead are drained by every slot, this one by a single slot once it starts.
+    # Jobs of a higher priority may still overtake it, so this is an estimate, not a promise.
+    eta_seconds = state['backlog_seconds'] + cost['pages'] * state['seconds_per_page']
+
+    over_backlog = state['backlog_seconds'] - ADMISSION_MAX_BACKLOG_SECONDS
+    over_depth = state['depth'] - ADMISSION_MAX_QUEUE_DEPTH
+    if ADMISSION_CONTROL and (over_backlog >= 0 or over_depth >= 0):
+        # Roughly the time for the queue to drain back below its limits
+        average_job_seconds = state['backlog_seconds'] / state['depth'] if state['depth'] else 0
+        wait = max(over_backlog, (over_depth + 1) * average_job_seconds)
+        retry_after = int(min(max(wait, ADMISSION_MIN_RETRY_AFTER_SECONDS), ADMISSION_MAX_RETRY_AFTER_SECONDS))
+        ADMISSION_DECISIONS.labels(queue, 'rejected').inc()
+        return {'admitted': False, 'eta_seconds': int(eta_seconds), 'retry_after': retry_after}
+
+    ADMISSION_DECISIONS.labels(queue, 'admitted').inc()
+    return {'admitted': True, 'eta_seconds': int(eta_seconds), 'retry_after': None}
+
+def record_enqueued(file_info, queue, cost):
+    """
+    Adds a queued job to the backlog. The reference travels with the job, so the worker can take it off again.
+    """
+    file_info['admission'] = {'queue': queue, 'pages': cost['pages'], 'enqueued_at': time.time()}
+    if redis_client is not None:
+        try:
+            redis_client.hincrby(QUEUED_PAGES_KEY, queue, cost['pages'])
+        except Exception as e:
+            print(f"Could not record the queued job: {e}")
+
+class BacklogCollector:
+    """
+    Exports the backlog of the conversion queues on the /metrics endpoint of Flask, which keeps running
+    when the workers are scaled to zero. KEDA scales the workers on studyshare_conversion_work_seconds.
+    """
+    def describe(self):
+        # Registering the collector shouldn't read from Redis
+        return []
+
+    def collect(self):
+        backlog = backlog_snapshot()
+        if backlog is None:
+            return
+
+        gauges = {
+            'depth': GaugeMetricFamily('studyshare_conversion_queue_depth', 'Jobs waiting in each conversion queue', labels=['queue']),
+            'pages': GaugeMetricFamily('studyshare_conversion_queued_pages', 'Estimated pages of the queued jobs', labels=['queue']),
+            'slots': GaugeMetricFamily('studyshare_conversion_worker_slots', 'Worker processes consuming each queue', labels=['queue']),
+            'work_seconds': GaugeMetricFamily(
+                'studyshare_conversion_work_seconds', 'Processing time of the queued jobs, for a single worker process', labels=['queue']
+            ),
+            'backlog_seconds': GaugeMetricFamily(
+                'studyshare_conversion_backlog_seconds', 'Estimated time to drain each queue with the current workers', labels=['queue']
+            )
+        }
+        for queue, state in backlog.items():
+            for name, gauge in gauges.items():
+                gauge.add_metric([queue], state[name])
+        yield from gauges.values()
+
+# Start times of the running conversion tasks of this worker process, keyed by the Celery task id
+_started = {}
+
+def _admission_of(args):
+    file_info = args[0] if args and isinstance(args[0], dict) else {}
+    return file_info.get('admission')
+
+@task_prerun.connect
+def take_off_backlog(task_id = None, task = None, args = None, **kwargs):
+    admission = _admission_of(args)
+    if admission is None or redis_client is None:
+        return
+
+    _started[task_id] = time.time()
+    try:
+        # Once per task: a task redelivered after its worker died still has 0 retries
+        if redis_client.set(f"{STARTED_KEY_PREFIX}:{task_id}", 1, nx=True, ex=RESULT_EXPIRES_SECONDS):
+            if redis_client.hincrby(QUEUED_PAGES_KEY, admission['queue'], -admission['pages']) < 0:
+                redis_client.hset(QUEUED_PAGES_KEY, admission['queue'], 0)
+    except Exception as e:
+        print(f"Could not update the conversion backlog: {e}")
+
+@task_postrun.connect
+def measure_throughput(task_id = None, args = None, state = None, **kwargs):
+    started = _started.pop(task_id, None)
+    admission = _admission_of(args)
+    if started is None or admission is None or state != 'SUCCESS':
+        return
+
+    seconds_per_page = (time.time() - started) / max(admission['pages'], 1)
+    try:
+        previous = redis_client.hget(SECONDS_PER_PAGE_KEY, admission['queue'])
+        if previous is not None:
+            seconds_per_page = THROUGHPUT_SMOOTHING * seconds_per_page + (1 - THROUGHPUT_SMOOTHING) * float(previous)
+        redis_client.hset(SECONDS_PER_PAGE_KEY, admission['queue'], seconds_per_page)
+    except Exception as e:
+        print(f"Could not update the conversion throughput: {e}")
+
+_heartbeat_stopped = threading.Event()
+
+def _worker_key(hostname):
+    return f"{WORKER_KEY_PREFIX}:{hostname}"
+
+@worker_ready.connect
+def register_worker(sender = None, **kwargs):
+    """
+    Registers the queues and concurrency of this worker until it shuts down, so the Flask side knows the slots.
+    """
+    if redis_client is None:
+        return
+
+    hostname = getattr(sender, 'hostname', None) or socket.gethostname()
+    worker = json.dumps({
+        'queues': list(sender.app.amqp.queues.consume_from.keys()),
+        'concurrency': sender.controller.concurrency
+    })
+
+    def heartbeat():
+        # Expires after a few missed beats, so a killed worker stops counting
+        while True:
+            try:
+                redis_client.set(_worker_key(hostname), worker, ex=WORKER_HEARTBEAT_SECONDS * 3)
+            except Exception as e:
+                print(f"Could not register the worker: {e}")
+            if _heartbeat_stopped.wait(WORKER_HEARTBEAT_SECONDS):
+                return
+
+    threading.Thread(target=heartbeat, name='admission-heartbeat', daemon=True).start()
+
+@worker_shutdown.connect
+def unregister_worker(sender = None, **kwargs):
+    _heartbeat_stopped.set()
+    if redis_client is not None:
+        try:
+            redis_client.delete(_worker_key(getattr(sender, 'hostname', None) or socket.gethostname()))
+        except Exception as e:
+            print(f"Could not unregister the worker: {e}")
@@ -0,0 +1,293 @@
+import os
+import json
+import uuid
+import zipfile
+import threading
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from celery import group
+from ..config.celery import RESULT_EXPIRES_SECONDS
+from ..config.redis_client import redis_client
+from .task_signatures import conversion_signature, allowed_file, QUEUED_STATE
+from .blob_spool import store as blob_store
+from .job_routing import estimate_job_cost, choose_queue, route_job
+from . import admission
+from . import task_status
+
+load_dotenv()
+
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", 100))
+# The whole request, zip archives included. Every file is still limited to BLOB_SPOOL_MAX_BYTES.
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", 1024 * 1024 * 1024))
+# Batches are kept as long as the results of their tasks
+BATCH_TTL_SECONDS = int(os.getenv("BATCH_TTL_SECONDS", RESULT_EXPIRES_SECONDS))
+BATCH_KEY_PREFIX = 'conversion-batch'
+
+CONTENT_TYPES = {
+    'pdf': 'application/pdf',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+}
+
+class BatchTooLargeError(Exception):
+    pass
+
+def _kind_of(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+class _BatchBudget:
+    """
+    Counts the bytes spooled by a batch, zip members uncompressed, and stops the batch as soon as it
+    goes over BATCH_MAX_BYTES. Nothing over the limit ever reaches the spool, however well a zip compresses.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total = 0
+
+    def wrap(self, stream):
+        return _BudgetedStream(stream, self)
+
+    def consume(self, size):
+        self.total += size
+        if self.total > self.max_bytes:
+            raise BatchTooLargeError(f"The files of a batch may not exceed {self.max_bytes} bytes in total")
+
+class _BudgetedStream:
+    def __init__(self, stream, budget):
+        self.stream = stream
+        self.budget = budget
+
+    def read(self, size = -1):
+        chunk = self.stream.read(size)
+        self.budget.consume(len(chunk))
+        return chunk
+
+def _spool_file(stream, filename, content_type, uploads, skipped, budget):
+    # items refers to the files by name, so a second file with the same name is left out instead of shadowing the first
+    if any(upload['filename'] == filename for upload in uploads):
+        skipped.append(filename)
+        return
+    if len(uploads) >= BATCH_MAX_FILES:
+        raise BatchTooLargeError(f"A batch may contain at most {BATCH_MAX_FILES} files")
+    uploads.append({'filename': filename, 'content_type': content_type, 'blob': blob_store.put_stream(budget.wrap(stream), filename, content_type)})
+
+def _spool_archive(archive_file, uploads, skipped, budget):
+    with zipfile.ZipFile(archive_file.stream) as archive:
+        for member in archive.infolist():
+            # Members are named by their path in the archive, files of different folders may share a name
+            filename = member.filename
+            basename = os.path.basename(filename)
+            # Folders, and the resource forks and hidden files that archivers add
+            if member.is_dir() or not basename or basename.startswith('.') or filename.startswith('__MACOSX/'):
+                continue
+            if not allowed_file(basename):
+                skipped.append(filename)
+                continue
+
+            # Spooled straight from the archive, one chunk at a time, and limited like any other upload.
+            # The budget counts the bytes as they are decompressed, not the sizes the archive claims.
+            with archive.open(member) as stream:
+                _spool_file(stream, filename, CONTENT_TYPES[_kind_of(basename)], uploads, skipped, budget)
+
+def spool_batch(files):
+    """
+    Spools every PDF and DOCX file of a batch, unpacking zip archives.
+
+    Args:
+        files (list): The werkzeug FileStorage objects of the request.
+
+    Returns:
+        tuple: The file infos of the spooled files (see blob_spool.spool_upload) and the names of the skipped files,
+        including files named like an earlier one. Zip members are named by their path in the archive.
+    """
+    uploads = []
+    skipped = []
+    budget = _BatchBudget(BATCH_MAX_BYTES)
+    try:
+        for file in files:
+            if _kind_of(file.filename) == 'zip':
+                _spool_archive(file, uploads, skipped, budget)
+            elif allowed_file(file.filename):
+                _spool_file(file.stream, file.filename, file.content_type, uploads, skipped, budget)
+            else:
+                skipped.append(file.filename)
+    except Exception:
+        # Including the blobs spooled before the batch went over its limits, the partial one is removed by put_stream
+        discard(uploads)
+        raise
+
+    return uploads, skipped
+
+def discard(uploads):
+    for upload in uploads:
+        blob_store.delete(upload['blob'])
+
+def plan_jobs(uploads, shared_info, items, quality = None):
+    """
+    Builds the task arguments of every file: its material info is the shared info over the defaults
+    of a new material, with a generated material id and name, and the fields given for the file in items.
+
+    Args:
+        uploads (list): The spooled files, see spool_batch.
+        shared_info (dict): Material fields shared by the batch (user_id, subject_id, lesson_id...).
+        items (dict): Filename (the path of a zip member) -> material fields of that file.
+        quality (str): The WebP quality of the batch.
+    """
+    jobs = []
+    for upload in uploads:
+        kind = _kind_of(upload['filename'])
+        # The values the upload page sends for a single file, the batch and its items may override them
+        info = {
+            'upload_date': datetime.now(timezone.utc).isoformat(),
+            'download_count': 0,
+            'view_count': 0,
+            'rating_count': 0,
+            'total_rating': 0,
+            'is_paid': False,
+            'price': 0
+        }
+        info.update(shared_info)
+        info.update({
+            'material_id': str(uuid.uuid4()),
+            'name': os.path.basename(upload['filename']).rsplit('.', 1)[0],
+            'file_type': kind,
+            'size': upload['blob']['size']
+        })
+        info.update(items.get(upload['filename'], {}))
+
+        form = {'info': json.dumps(info)}
+        if quality is not None:
+            form['quality'] = quality
+
+        cost = estimate_job_cost(upload, kind)
+        jobs.append({'kind': kind, 'file_info': upload, 'form': form, 'cost': cost, 'queue': choose_queue(cost)})
+    return jobs
+
+def admit(jobs):
+    """
+    Admits a batch as a whole, each queue with the pages the batch adds to it.
+
+    Returns:
+        dict: Like admission.admit, the ETA being the one of the last job of the batch.
+    """
+    pages_by_queue = {}
+    for job in jobs:
+        pages_by_queue[job['queue']] = pages_by_queue.get(job['queue'], 0) + job['cost']['pages']
+
+    decisions = [admission.admit(queue, {'pages': pages}) for queue, pages in pages_by_queue.items()]
+    rejected = [decision for decision in decisions if not decision['admitted']]
+    if rejected:
+        return {'admitted': False, 'eta_seconds': None, 'retry_after': max(decision['retry_after'] for decision in rejected)}
+
+    etas = [decision['eta_seconds'] for decision in decisions]
+    return {'admitted': True, 'eta_seconds': None if None in etas else max(etas), 'retry_after': None}
+
+# Batches are kept here when there is no Redis, which only happens on a single development process
+_local_batches = {}
+_local_lock = threading.Lock()
+
+def _batch_key(batch_id):
+    return f"{BATCH_KEY_PREFIX}:{batch_id}"
+
+def _save_batch(batch):
+    if redis_client is None:
+        with _local_lock:
+            _local_batches[batch['batch_id']] = batch
+        return
+    redis_client.set(_batch_key(batch['batch_id']), json.dumps(batch), ex=BATCH_TTL_SECONDS)
+
+def _load_batch(batch_id):
+    if redis_client is None:
+        with _local_lock:
+            return _local_batches.get(batch_id)
+    value = redis_client.get(_batch_key(batch_id))
+    return json.loads(value) if value is not None else None
+
+def enqueue(jobs):
+    """
+    Queues the conversion of every file of a batch as one Celery group. Each child keeps the queue and priority
+    of its own size, so a batch of short files isn't held up by the long ones.
+
+    Returns:
+        dict: The batch id and, for every file, its task id, material id and filename.
+    """
+    signatures = []
+    for job in jobs:
+        admission.record_enqueued(job['file_info'], job['queue'], job['cost'])
+        options = route_job(job['file_info'], job['form'], job['kind'], job['cost'])
+        signatures.append(conversion_signature(job['kind'], job['file_info'], job['form'], **options))
+
+    # The children are published over a single producer connection
+    result = group(signatures).apply_async()
+
+    batch = {
+        'batch_id': result.id,
+        'items': [
+            {
+                'task_id': child.id,
+                'material_id': json.loads(job['form']['info'])['material_id'],
+                'filename': job['file_info']['filename']
+            }
+            for job, child in zip(jobs, result.results)
+        ]
+    }
+    _save_batch(batch)
+    return batch
+
+def _child_status(item, meta):
+    # Queued children are reported as PENDING, like by /task-status
+    status = dict(item, state='PENDING' if meta['status'] == QUEUED_STATE else meta['status'])
+
+    if meta['status'] == 'PROGRESS':
+        info = meta['result'] or {}
+        status.update({'stage': info.get('stage'), 'page': info.get('page'), 'total': info.get('total')})
+        # Pages are the bulk of the work, the other stages count as not started
+        status['progress'] = info['page'] / info['total'] if info.get('page') and info.get('total') else 0
+    elif meta['status'] == 'SUCCESS':
+        # Conversion tasks report failures as an error dict instead of raising
+        result = task_status.task_result(meta)
+        if isinstance(result, dict) and 'error' in result:
+            status.update({'state': 'FAILURE', 'error': result['error']})
+        else:
+            status['result'] = result
+        status['progress'] = 1
+    elif meta['status'] in ('FAILURE', 'REVOKED'):
+        status.update({'state': 'FAILURE', 'error': str(meta['result']), 'progress': 1})
+    else:
+        status['progress'] = 0
+    return status
+
+def get_status(batch_id):
+    """
+    Aggregates the state of every task of a batch, so clients poll once per batch instead of once per file.
+
+    Returns:
+        dict: The overall state and progress (0-1), the count of tasks per state and the status of every file.
+        None when the batch doesn't exist or has expired.
+    """
+    batch = _load_batch(batch_id)
+    if batch is None:
+        return None
+
+    # Every child is read in one round trip to the result backend
+    metas = task_status.read_metas([item['task_id'] for item in batch['items']])
+    items = [_child_status(item, metas[item['task_id']]) for item in batch['items']]
+    counts = {}
+    for item in items:
+        counts[item['state']] = counts.get(item['state'], 0) + 1
+
+    finished = counts.get('SUCCESS', 0) + counts.get('FAILURE', 0)
+    if finished < len(items):
+        state = 'PROGRESS' if finished or counts.get('PROGRESS') or counts.get('RETRY') else 'PENDING'
+    elif counts.get('FAILURE'):
+        state = 'FAILURE' if counts['FAILURE'] == len(items) else 'PARTIAL'
+    else:
+        state = 'SUCCESS'
+
+    return {
+        'batch_id': batch_id,
+        'state': state,
+        'total': len(items),
+        'counts': counts,
+        'progress': round(sum(item['progress'] for item in items) / len(items), 3) if items else 1,
+        'items': items
+    }
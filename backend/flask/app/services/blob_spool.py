@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# The spool directory must be shared between the Flask container and the Celery workers
+# (a docker volume or a ReadWriteMany PVC). Only a small reference to the blob goes through the broker.
+BLOB_SPOOL_DIR = os.getenv("BLOB_SPOOL_DIR", "spool")
+BLOB_SPOOL_MAX_BYTES = int(os.getenv("BLOB_SPOOL_MAX_BYTES", 150 * 1024 * 1024))
+BLOB_SPOOL_TTL_SECONDS = int(os.getenv("BLOB_SPOOL_TTL_SECONDS", 6 * 60 * 60))
+
+CHUNK_SIZE = 1024 * 1024
+SWEEP_INTERVAL_SECONDS = 5 * 60
+PARTIAL_SUFFIX = '.part'
+META_SUFFIX = '.json'
+
+class BlobTooLargeError(Exception):
+    pass
+
+class BlobNotFoundError(Exception):
+    pass
+
+class BlobIntegrityError(Exception):
+    pass
+
+class FilesystemBlobStore:
+    """
+    Stores uploaded files on a directory so the worker can fetch them by reference.
+    Blobs are written in chunks, checksummed with SHA-256 and expire after a TTL.
+    """
+    def __init__(self, root, max_bytes, ttl_seconds):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._last_sweep = 0
+
+    def _blob_path(self, blob_id):
+        # blob_id comes from the broker message, never trust it as a path component
+        if not blob_id or not all(c in '0123456789abcdef' for c in blob_id):
+            raise BlobNotFoundError(f"Invalid blob id: {blob_id}")
+        return os.path.join(self.root, blob_id)
+
+    def put_stream(self, stream, filename, content_type):
+        """
+        Writes a file-like object to the spool in chunks and returns a reference to it.
+
+        Args:
+            stream: A readable binary file-like object.
+            filename (str): The original filename of the upload.
+            content_type (str): The MIME type of the upload.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        self.sweep_expired()
+
+        blob_id = uuid.uuid4().hex
+        blob_path = self._blob_path(blob_id)
+        partial_path = blob_path + PARTIAL_SUFFIX
+        digest = hashlib.sha256()
+        size = 0
+
+        try:
+            with open(partial_path, 'wb') as f:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise BlobTooLargeError(f"File exceeds the maximum upload size of {self.max_bytes} bytes")
+                    digest.update(chunk)
+                    f.write(chunk)
+
+            # Rename only once the blob is complete so the worker never sees a partial file
+            os.replace(partial_path, blob_path)
+        except Exception:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+
+        ref = {
+            'blob_id': blob_id,
+            'sha256': digest.hexdigest(),
+            'size': size,
+            'filename': filename,
+            'content_type': content_type,
+            'created_at': time.time()
+        }
+
+        with open(blob_path + META_SUFFIX, 'w') as f:
+            json.dump(ref, f)
+
+        print(f'Spooled {filename} ({size} bytes) as blob {blob_id}')
+        return ref
+
+    def fetch_to(self, ref, dest_path):
+        """
+        Copies a spooled blob to dest_path, verifying its size and checksum on the way.
+        """
+        blob_path = self._blob_path(ref['blob_id'])
+        if not os.path.exists(blob_path):
+            raise BlobNotFoundError(f"Blob {ref['blob_id']} does not exist or has expired")
+
+        digest = hashlib.sha256()
+        size = 0
+        with open(blob_path, 'rb') as src, open(dest_path, 'wb') as dst:
+            while True:
+                chunk = src.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                digest.update(chunk)
+                dst.write(chunk)
+
+        if size != ref['size'] or digest.hexdigest() != ref['sha256']:
+            os.remove(dest_path)
+            raise BlobIntegrityError(f"Checksum mismatch for blob {ref['blob_id']}")
+
+        return dest_path
+
+    def path_of(self, ref):
+        """
+        Returns the local path of a spooled blob, for reading it in place without a copy.
+        """
+        blob_path = self._blob_path(ref['blob_id'])
+        if not os.path.exists(blob_path):
+            raise BlobNotFoundError(f"Blob {ref['blob_id']} does not exist or has expired")
+        return blob_path
+
+    def delete(self, ref):
+        blob_path = self._blob_path(ref['blob_id'])
+        for path in (blob_path, blob_path + META_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def sweep_expired(self, force=False):
+        """
+        Removes blobs (and abandoned partial writes) older than the TTL. Returns the number of files removed.
+        """
+        now = time.time()
+        if not force and now - self._last_sweep < SWEEP_INTERVAL_SECONDS:
+            return 0
+        self._last_sweep = now
+
+        if not os.path.isdir(self.root):
+            return 0
+
+        removed = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                if now - os.path.getmtime(path) > self.ttl_seconds:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                # Another process removed it first
+                continue
+
+        if removed:
+            print(f'Removed {removed} expired files from the blob spool')
+        return removed
+
+store = FilesystemBlobStore(BLOB_SPOOL_DIR, BLOB_SPOOL_MAX_BYTES, BLOB_SPOOL_TTL_SECONDS)
+
+def spool_upload(file):
+    """
+    Spools a werkzeug FileStorage and returns the file info that is sent to the Celery task.
+    """
+    return {
+        'filename': file.filename,
+        'content_type': file.content_type,
+        'blob': store.put_stream(file.stream, file.filename, file.content_type)
+    }
@@ -1,219 +1,298 @@
 import os
 import json
+from pdf2image.exceptions import PDFInfoNotInstalledError, PDFPageCountError, PDFSyntaxError
+from pypdf.errors import PyPdfError
+from celery.signals import worker_process_init, worker_process_shutdown
 from ..config.celery import celery
 from . import file_converter
 from werkzeug.utils import secure_filename
-from ..models.material import Material
-from .file_content_extractor import extract_all_pages_content
+from ..models.material import MaterialBundle
+from .blob_spool import store as blob_store, BlobNotFoundError, BlobIntegrityError
+from .conversion_pipeline import StageTimer, run_conversion_stages
+from . import conversion_cache
+from .progress import ProgressReporter
+from .checkpoints import TaskCheckpoint
+from .file_content_extractor import page_sections, is_rejected_request
+from . import office_converter
+from .scratch import ScratchSpace, scratch_mode_for
+from .task_signatures import CONVERT_PDF_TASK, CONVERT_DOCX_TASK, allowed_file
+# Connects the task signals and serves /metrics from the worker
+from . import worker_metrics  # noqa: F401
+# Releases the per-user in-flight count of finished jobs
+from . import job_routing  # noqa: F401
+# Takes started jobs off the admission backlog and measures the throughput of each queue
+from . import admission  # noqa: F401
 import uuid
-import time
 
-ALLOWED_EXTENSIONS = {'pdf', 'docx'}
-UPLOADS_FOLDER = 'uploads'
-OUTPUT_WEBP_FOLDER = 'output_webp'
-
-def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
-@celery.task(bind=True)
+CONVERSION_MAX_RETRIES = int(os.getenv("CONVERSION_MAX_RETRIES", 3))
+CONVERSION_RETRY_BACKOFF_MAX_SECONDS = int(os.getenv("CONVERSION_RETRY_BACKOFF_MAX_SECONDS", 300))
+# Redeliveries after the worker process died (e.g. OOM-killed) before a file is given up,
+# so a document that always kills its worker isn't redelivered forever
+CONVERSION_MAX_WORKER_LOSSES = int(os.getenv("CONVERSION_MAX_WORKER_LOSSES", 2))
+
+class WorkerLostTooOftenError(Exception):
+    pass
+
+# Failures that a retry cannot fix: a missing or corrupt upload, a document poppler or pypdf can't read
+# (damaged or encrypted), a worker without poppler, and invalid form values such as the quality
+PERMANENT_ERRORS = (
+    BlobNotFoundError, BlobIntegrityError, WorkerLostTooOftenError,
+    PDFInfoNotInstalledError, PDFPageCountError, PDFSyntaxError, PyPdfError, ValueError
+)
+
+# A failed attempt is retried with exponential backoff and resumes from its checkpoint (see TaskCheckpoint).
+# Tasks are acknowledged late and rejected (requeued) when their worker process dies,
+# so the task of an OOM-killed worker is redelivered and resumed instead of failing with WorkerLostError.
+CONVERSION_TASK_OPTIONS = {
+    'bind': True,
+    'autoretry_for': (Exception,),
+    'max_retries': CONVERSION_MAX_RETRIES,
+    'retry_backoff': True,
+    'retry_backoff_max': CONVERSION_RETRY_BACKOFF_MAX_SECONDS,
+    'retry_jitter': True,
+    'acks_late': True,
+    'reject_on_worker_lost': True
+}
+
+@worker_process_init.connect
+def warm_office_converters(**kwargs):
+    # Start LibreOffice in every worker process ahead of the first DOCX job, without holding up the process start
+    if office_converter.DOCX_CONVERTER_BACKEND == 'unoserver' and office_converter.OFFICE_WARM_ON_START:
+        office_converter.warm_in_background()
+
+@worker_process_shutdown.connect
+def stop_office_converters(**kwargs):
+    office_converter.shutdown_pool()
+
+def is_permanent(error):
+    # The conversion stages wrap their errors, the original one is in the chain
+    while error is not None:
+        if isinstance(error, PERMANENT_ERRORS) or is_rejected_request(error):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+def should_retry(task, error):
+    return not is_permanent(error) and task.request.retries < task.max_retries
+
+def start_task(task, info):
+    """
+    Returns the task id, checkpoint and progress reporter of a conversion attempt.
+    The Celery task id survives retries, so every attempt shares the same Task record and checkpoint.
+    """
+    task_id = task.request.id or str(uuid.uuid4())
+    checkpoint = TaskCheckpoint(task_id)
+    reporter = ProgressReporter(task, task_id, info["material_id"], resumed=checkpoint.get('task_created', False))
+    checkpoint.mark('task_created')
+
+    # Every attempt is counted, the ones that didn't come from a retry were redelivered after their worker died
+    attempts = checkpoint.get('attempts', 0) + 1
+    checkpoint.mark('attempts', attempts)
+    if attempts - (task.request.retries + 1) > CONVERSION_MAX_WORKER_LOSSES:
+        reporter.fail('Conversion failed: the worker died on every attempt')
+        checkpoint.clear()
+        raise WorkerLostTooOftenError(f"Task {task_id} lost its worker {attempts - task.request.retries - 1} times")
+    return task_id, checkpoint, reporter
+
+def save_material_records(info, public_links, content, reporter, timer):
+    """
+    Writes the material, its pages, summary, ratings and the final task records in a single transaction.
+    """
+    info['num_page'] = public_links[-1]['page'] if public_links else 0
+
+    bundle = MaterialBundle(info["material_id"])
+    bundle.add_material(info)
+    # Each page is indexed for search with its local text and its section of the summary
+    bundle.add_pages(public_links, getattr(content, 'page_texts', None) or {}, page_sections(content.text))
+    bundle.add_summary(info["user_id"], content.text, {
+            'prompt_token_count': content.usage.prompt_token_count,
+            'thoughts_token_count': content.usage.thoughts_token_count,
+            'total_token_count': content.usage.total_token_count
+        })
+    bundle.add_ratings()
+    reporter.complete(bundle, timer)
+    bundle.commit()
+
+@celery.task(name=CONVERT_PDF_TASK, **CONVERSION_TASK_OPTIONS)
 def convert_pdf_to_webp(self, file_info, form):
-    print(form.get('info', '{}'))
-    file_bytes = bytes.fromhex(file_info['data'])
     info = json.loads(form.get('info', '{}'))
     storage_filename = info["material_id"]
-    task_id = str(uuid.uuid4())
-
-    # Create a pending task record in Supabase
-    task_record_content = "- [Step 1/5] Starting conversion task\n" # This content will be updated later
-    Material.create_task_record(task_id, info["material_id"], task_record_content, "pending")
-    start_time = time.time()
+    timer = StageTimer()
 
     # If the user does not select a file, the browser submits an empty file without a filename.
     if file_info['filename'] == '':
+        blob_store.delete(file_info['blob'])
         return {'error': 'No selected file'}
 
-    # Check if the file is a PDF and save it securely
-    if file_info and allowed_file(file_info['filename']):
-        # Secure the filename to prevent directory traversal attacks
-        filename = secure_filename(storage_filename)
-        os.makedirs(UPLOADS_FOLDER, exist_ok=True)
-        pdf_path = os.path.join(UPLOADS_FOLDER, filename)
-        
-        # Write the bytes to a file
-        with open(pdf_path, 'wb') as f:
-            f.write(file_bytes)
+    # Only PDF files are converted by this task
+    if not allowed_file(file_info['filename'], {'pdf'}):
+        blob_store.delete(file_info['blob'])
+        return {'error': 'File type not allowed'}
+
+    # Secure the filename to prevent directory traversal attacks
+    filename = secure_filename(storage_filename)
+    checkpoint = reporter = scratch = None
+    retrying = False
+
+    try:
+        # Create (or, on a retry, reuse) the pending task record in Supabase.
+        # Inside the try, so the spooled upload is still cleaned up when this fails.
+        task_id, checkpoint, reporter = start_task(self, info)
+        # Private to this task and shared by its retries, small uploads keep their pages in memory
+        scratch = ScratchSpace(task_id, scratch_mode_for(file_info['blob']['size'])).open()
+        pdf_path = scratch.path(f"{filename}.pdf")
 
         # Get quality from form data, default to 20 if not provided
         quality = int(form.get('quality', 20))
 
-        # Extract content from the PDF
-        content = extract_all_pages_content(pdf_path, mime_type='application/pdf')
-        print("Extracted Content:", content)
-        task_record_content += f"- [Step 2/5] Extracted content from PDF: {content.text[:100]}...\n"  # Preview of the content
-        Material.update_pending_task_record(task_id, info["material_id"], task_record_content)
-
-        # Convert PDF to WebP
-        try:
-            output_dir_webp = os.path.join(OUTPUT_WEBP_FOLDER, filename)
-            prefix = filename
-            file_converter.pdf_to_webp(pdf_path, output_dir_webp, prefix, quality)
-            task_record_content += f"- [Step 3/5] Converted PDF to WebP: {output_dir_webp}\n"
-            Material.update_pending_task_record(task_id, info["material_id"], task_record_content)
-
-            public_links = []
-            files_list = sorted(os.listdir(output_dir_webp), key=lambda x: int(x.split('_')[-1].split('.')[0])) # Sort files by page number
-
-            for i in range(len(files_list)):
-                webp_filename = files_list[i]
-                webp_path = os.path.join(output_dir_webp, webp_filename)
-                webp_path = webp_path.replace("\\", "/")
-                print(f'Uploading {webp_path}')
-                public_link = Material.upload_and_get_link(webp_path)
-                public_links.append({
-                    'page': i + 1,
-                    'url': public_link
-                })
-
-            task_record_content += f"- [Step 4/5] Uploaded {len(public_links)} WebP files to storage\n"
-            Material.update_pending_task_record(task_id, info["material_id"], task_record_content)
-
-            # Save records to Supabase
-            info['num_page'] = public_links[-1]['page'] if public_links else 0
-
-            Material.create_material_record(info)
-            Material.create_material_page_record(info["material_id"], public_links)
-            Material.create_summary_record(info["user_id"], info["material_id"], content.text, {
-                    'prompt_token_count': content.usage.prompt_token_count,
-                    'thoughts_token_count': content.usage.thoughts_token_count,
-                    'total_token_count': content.usage.total_token_count
-                })
-            Material.create_material_rating_record(info["material_id"])
-
-            # Update task record to success
-            end_time = time.time()
-            task_record_content += f"- [Step 5/5] All steps completed successfully in {end_time - start_time:.2f} seconds\n"
-            Material.update_pending_task_record(task_id, info["material_id"], task_record_content)
-            Material.create_task_record(task_id, info["material_id"], f"Processed in {end_time - start_time:.2f} seconds", "success")
-
-            return {
-                'message': 'PDF converted to WebP successfully',
-                'material_id': info["material_id"]
-            }
-        except Exception as e:
-            # Handle any errors during conversion
-            return {'error': f'Conversion failed: {str(e)}'}
-        finally:
-            # Clean up the uploaded file
-            os.remove(pdf_path)
-
-            for file in os.listdir(output_dir_webp):
-                os.remove(os.path.join(output_dir_webp, file))
-            os.rmdir(output_dir_webp)
-
-    return {'error': 'File type not allowed'}
-
-@celery.task(bind=True)
+        # Copy the spooled upload, verifying its checksum. A retry on the same worker still has it.
+        if not os.path.exists(pdf_path):
+            blob_store.fetch_to(file_info['blob'], pdf_path)
+
+        if checkpoint.get('persisted'):
+            # A previous attempt failed after the records were committed, only the final event is left
+            print(f"Material {info['material_id']} was already persisted by a previous attempt")
+        else:
+            # Skip rendering, uploading and the LLM call if the same file was already converted with the same settings
+            cache_key = conversion_cache.make_cache_key(file_info['blob']['sha256'], 'pdf', quality)
+            with timer.stage('cache_lookup'):
+                cached = conversion_cache.restore(cache_key, filename)
+
+            if cached is not None:
+                content, public_links = cached
+                reporter.cache_hit(public_links)
+            else:
+                # Extract the content and convert the pages to WebP at the same time
+                content, public_links = run_conversion_stages(pdf_path, scratch.pages_dir, filename, quality, timer, reporter, checkpoint)
+
+            # Save records to Supabase once every stage is done
+            with timer.stage('persist'):
+                save_material_records(info, public_links, content, reporter, timer)
+            checkpoint.mark('persisted')
+
+            if cached is None:
+                conversion_cache.remember(cache_key, info["material_id"], public_links)
+
+        reporter.finish('done', 'PDF converted to WebP successfully')
+        checkpoint.clear()
+
+        return {
+            'message': 'PDF converted to WebP successfully',
+            'material_id': info["material_id"],
+            'timings': timer.stages
+        }
+    except Exception as e:
+        if should_retry(self, e):
+            # Keep the local files, the spooled upload and the checkpoint for the next attempt
+            retrying = True
+            if reporter is not None:
+                reporter.retrying(e)
+            raise
+
+        # Handle any errors during conversion
+        if reporter is not None:
+            reporter.fail(f'Conversion failed: {str(e)}')
+            checkpoint.clear()
+        return {'error': f'Conversion failed: {str(e)}'}
+    finally:
+        if not retrying:
+            # Clean up the spooled upload and every local file of the task
+            blob_store.delete(file_info['blob'])
+            if scratch is not None:
+                scratch.cleanup()
+
+@celery.task(name=CONVERT_DOCX_TASK, **CONVERSION_TASK_OPTIONS)
 def convert_docx_to_webp(self, file_info, form):
-    print(form.get('info', '{}'))
-    file_bytes = bytes.fromhex(file_info['data'])
     info = json.loads(form.get('info', '{}'))
     storage_filename = info["material_id"]
-    task_id = str(uuid.uuid4())
-
-    # Create a pending task record in Supabase
-    task_record_content = "- [Step 1/5] Starting conversion task\n" # This content will be updated later
-    Material.create_task_record(task_id, info["material_id"], task_record_content, "pending")
-    start_time = time.time()
+    timer = StageTimer()
 
     # If the user does not select a file, the browser submits an empty file without a filename.
     if file_info['filename'] == '':
+        blob_store.delete(file_info['blob'])
         return {'error': 'No selected file'}
 
-    # Check if the file is a DOCX and save it securely
-    if file_info and allowed_file(file_info['filename']):
-        # Secure the filename to prevent directory traversal attacks
-        filename = secure_filename(storage_filename)
-        upload_folder = 'uploads'
-        os.makedirs(upload_folder, exist_ok=True)
-        docx_path = os.path.join(upload_folder, filename)
-
-        # Save the uploaded DOCX file with the correct extension
-        with open(docx_path + '.docx', 'wb') as f:
-            f.write(file_bytes)
-
-        try:
-            # Call the file conversion service
-            output_dir_pdf = 'output_pdf'
-            output_pdf_filename = f"{filename}.pdf"
-            file_converter.docx_to_pdf(docx_path, output_dir_pdf, output_pdf_filename)
-            pdf_filename = os.path.join(output_dir_pdf, output_pdf_filename)
-
-            # Extract content from the DOCX (via the converted PDF)
-            content = extract_all_pages_content(pdf_filename, mime_type='application/pdf')
-            print("Extracted Content:", content)
-            task_record_content += f"- [Step 2/5] Extracted content from PDF: {content.text[:100]}...\n"  # Preview of the content
-            Material.update_pending_task_record(task_id, info["material_id"], task_record_content)
-
-            # Convert PDF to WebP
-            output_dir_webp = os.path.join('output_webp', filename)
-            prefix = filename
-            os.makedirs(output_dir_webp, exist_ok=True)
-            file_converter.pdf_to_webp(pdf_filename, output_dir_webp, prefix)
-            task_record_content += f"- [Step 3/5] Converted PDF to WebP: {output_dir_webp}\n"
-            Material.update_pending_task_record(task_id, info["material_id"], task_record_content)
-            
-            public_links = []
-            files_list = sorted(os.listdir(output_dir_webp), key=lambda x: int(x.split('_')[-1].split('.')[0])) # Sort files by page number
-
-            for i in range(len(files_list)):
-                webp_filename = files_list[i]
-                webp_path = os.path.join(output_dir_webp, webp_filename)
-                webp_path = webp_path.replace("\\", "/")
-                print(f'Uploading {webp_path}')
-                public_link = Material.upload_and_get_link(webp_path)
-                public_links.append({
-                    'page': i + 1,
-                    'url': public_link
-                })
-            
-            task_record_content += f"- [Step 4/5] Uploaded {len(public_links)} WebP files to storage\n"
-            Material.update_pending_task_record(task_id, info["material_id"], task_record_content)
-
-            # Save records to Supabase
-            info['num_page'] = public_links[-1]['page'] if public_links else 0
-
-            Material.create_material_record(info)
-            Material.create_material_page_record(info["material_id"], public_links)
-            Material.create_summary_record(info["user_id"], info["material_id"], content.text, {
-                    'prompt_token_count': content.usage.prompt_token_count,
-                    'thoughts_token_count': content.usage.thoughts_token_count,
-                    'total_token_count': content.usage.total_token_count
-                })
-            Material.create_material_rating_record(info["material_id"])
-
-            # Update task record to success
-            end_time = time.time()
-            task_record_content += f"- [Step 5/5] All steps completed successfully in {end_time - start_time:.2f} seconds\n"
-            Material.update_pending_task_record(task_id, info["material_id"], task_record_content)
-            Material.create_task_record(task_id, info["material_id"], f"Processed in {end_time - start_time:.2f} seconds", "success")
-
-            return {
-                'message': 'DOCX converted to WebP successfully',
-                'material_id': info["material_id"]
-            }
-        except Exception as e:
-            # Handle any errors during conversion
-            return {'error': f'Conversion failed: {str(e)}'}, 500
-        finally:
-            # Clean up the uploaded file
-            os.remove(docx_path + '.docx')
-
-            # Clean up the converted files
-            os.remove(os.path.join(output_dir_pdf, output_pdf_filename))
-
-            for file in os.listdir(output_dir_webp):
-                os.remove(os.path.join(output_dir_webp, file))
-            os.rmdir(output_dir_webp)
-
-    return {'error': 'File type not allowed'}, 400
\ No newline at end of file
+    # Only DOCX files are converted by this task
+    if not allowed_file(file_info['filename'], {'docx'}):
+        blob_store.delete(file_info['blob'])
+        return {'error': 'File type not allowed'}, 400
+
+    # Secure the filename to prevent directory traversal attacks
+    filename = secure_filename(storage_filename)
+    checkpoint = reporter = scratch = None
+    retrying = False
+
+    try:
+        # Create (or, on a retry, reuse) the pending task record in Supabase.
+        # Inside the try, so the spooled upload is still cleaned up when this fails.
+        task_id, checkpoint, reporter = start_task(self, info)
+        # Private to this task and shared by its retries, small uploads keep their pages in memory
+        scratch = ScratchSpace(task_id, scratch_mode_for(file_info['blob']['size'])).open()
+        docx_path = scratch.path(filename)
+        output_pdf_filename = f"{filename}.pdf"
+        pdf_filename = scratch.path(output_pdf_filename)
+
+        # Get quality from form data, default to 20 if not provided
+        quality = int(form.get('quality', 20))
+
+        # Copy the spooled DOCX file with the correct extension, verifying its checksum
+        if not os.path.exists(docx_path + '.docx'):
+            blob_store.fetch_to(file_info['blob'], docx_path + '.docx')
+
+        if checkpoint.get('persisted'):
+            # A previous attempt failed after the records were committed, only the final event is left
+            print(f"Material {info['material_id']} was already persisted by a previous attempt")
+        else:
+            # Skip the whole conversion and the LLM call if the same file was already converted with the same settings
+            cache_key = conversion_cache.make_cache_key(file_info['blob']['sha256'], 'docx', quality)
+            with timer.stage('cache_lookup'):
+                cached = conversion_cache.restore(cache_key, filename)
+
+            if cached is not None:
+                content, public_links = cached
+                reporter.cache_hit(public_links)
+            else:
+                # Call the file conversion service, unless a previous attempt on this worker already did
+                if not (checkpoint.get('converted_to_pdf') and os.path.exists(pdf_filename)):
+                    with timer.stage('docx_to_pdf'):
+                        file_converter.docx_to_pdf(docx_path, scratch.root, output_pdf_filename)
+                    checkpoint.mark('converted_to_pdf')
+
+                # Extract the content (via the converted PDF) and convert the pages to WebP at the same time
+                content, public_links = run_conversion_stages(pdf_filename, scratch.pages_dir, filename, quality, timer, reporter, checkpoint)
+
+            # Save records to Supabase once every stage is done
+            with timer.stage('persist'):
+                save_material_records(info, public_links, content, reporter, timer)
+            checkpoint.mark('persisted')
+
+            if cached is None:
+                conversion_cache.remember(cache_key, info["material_id"], public_links)
+
+        reporter.finish('done', 'DOCX converted to WebP successfully')
+        checkpoint.clear()
+
+        return {
+            'message': 'DOCX converted to WebP successfully',
+            'material_id': info["material_id"],
+            'timings': timer.stages
+        }
+    except Exception as e:
+        if should_retry(self, e):
+            # Keep the local files, the spooled upload and the checkpoint for the next attempt
+            retrying = True
+            if reporter is not None:
+                reporter.retrying(e)
+            raise
+
+        # Handle any errors during conversion
+        if reporter is not None:
+            reporter.fail(f'Conversion failed: {str(e)}')
+            checkpoint.clear()
+        return {'error': f'Conversion failed: {str(e)}'}, 500
+    finally:
+        if not retrying:
+            # Clean up the spooled upload and every local file of the task
+            blob_store.delete(file_info['blob'])
+            if scratch is not None:
+                scratch.cleanup()
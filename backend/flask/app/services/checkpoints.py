@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import threading
+from types import SimpleNamespace
+from dotenv import load_dotenv
+from ..config.redis_client import redis_client
+
+load_dotenv()
+
+# Checkpoints only have to outlive the retries of a task
+CHECKPOINT_TTL_SECONDS = int(os.getenv("CHECKPOINT_TTL_SECONDS", 24 * 60 * 60))
+KEY_PREFIX = 'conversion-checkpoint'
+
+class InMemoryCheckpointStore:
+    """
+    Process-local stand-in for the Redis store, a retry only resumes when it runs in the same worker process.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get_all(self, key):
+        with self._lock:
+            expires_at, fields = self._entries.get(key, (0, {}))
+            if expires_at < time.time():
+                self._entries.pop(key, None)
+                return {}
+            return dict(fields)
+
+    def set_field(self, key, field, value, ttl_seconds):
+        with self._lock:
+            _, fields = self._entries.get(key, (0, {}))
+            fields[field] = value
+            self._entries[key] = (time.time() + ttl_seconds, fields)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+class RedisCheckpointStore:
+    """
+    Keeps each checkpoint in a Redis hash, one field per stage or page, so the upload threads never overwrite each other.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def get_all(self, key):
+        return {field.decode(): json.loads(value) for field, value in self.client.hgetall(key).items()}
+
+    def set_field(self, key, field, value, ttl_seconds):
+        with self.client.pipeline() as pipe:
+            pipe.hset(key, field, json.dumps(value))
+            pipe.expire(key, ttl_seconds)
+            pipe.execute()
+
+    def delete(self, key):
+        self.client.delete(key)
+
+store = RedisCheckpointStore(redis_client) if redis_client else InMemoryCheckpointStore()
+
+class TaskCheckpoint:
+    """
+    Records the completed stages of a conversion task: the extracted content, every rendered and uploaded page,
+    the converted PDF of a DOCX and whether the records were persisted. A retry of the task resumes after the
+    last completed stage instead of starting over. Checkpoints are keyed by the Celery task id, which a retry keeps.
+    """
+    def __init__(self, celery_task_id, checkpoint_store = None):
+        self.key = f"{KEY_PREFIX}:{celery_task_id}"
+        self.store = checkpoint_store or store
+        self.fields = self.store.get_all(self.key)
+
+    @property
+    def resumed(self):
+        return bool(self.fields)
+
+    def _set(self, field, value):
+        self.fields[field] = value
+        self.store.set_field(self.key, field, value, CHECKPOINT_TTL_SECONDS)
+
+    def get(self, field, default = None):
+        return self.fields.get(field, default)
+
+    def mark(self, field, value = True):
+        self._set(field, value)
+
+    def extracted(self):
+        data = self.fields.get('extracted')
+        if data is None:
+            return None
+        return SimpleNamespace(
+            text=data['text'],
+            usage=SimpleNamespace(**data['usage']),
+            # JSON object keys are strings
+            page_texts={int(page): text for page, text in data['page_texts'].items()}
+        )
+
+    def mark_extracted(self, content):
+        self._set('extracted', {
+            'text': content.text,
+            'usage': {
+                'prompt_token_count': content.usage.prompt_token_count,
+                'thoughts_token_count': content.usage.thoughts_token_count,
+                'total_token_count': content.usage.total_token_count
+            },
+            'page_texts': getattr(content, 'page_texts', None) or {}
+        })
+
+    def _pages(self, stage):
+        prefix = f"{stage}:"
+        return {int(field[len(prefix):]): value for field, value in self.fields.items() if field.startswith(prefix)}
+
+    def rendered_pages(self):
+        """
+        Returns page -> rendered (see page_encoder.encode_renditions) of the pages rendered by a previous attempt.
+        """
+        return self._pages('rendered')
+
+    def uploaded_pages(self):
+        """
+        Returns page -> public link info of the pages uploaded by a previous attempt.
+        """
+        return self._pages('uploaded')
+
+    def mark_rendered(self, page, rendered):
+        self._set(f"rendered:{page}", rendered)
+
+    def mark_uploaded(self, link):
+        self._set(f"uploaded:{link['page']}", link)
+
+    def clear(self):
+        self.fields = {}
+        self.store.delete(self.key)
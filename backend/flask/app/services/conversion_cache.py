@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from ..config.redis_client import redis_client
+from ..models.material import Material
+from . import file_converter
+from . import page_encoder
+from .file_content_extractor import GEMINI_MODEL
+from .page_uploader import UPLOAD_CONCURRENCY
+
+load_dotenv()
+
+# Bump CONVERSION_CACHE_VERSION to drop every cached conversion, e.g. after changing the prompt
+CONVERSION_CACHE_BACKEND = os.getenv("CONVERSION_CACHE_BACKEND", "redis" if redis_client else "memory")  # "redis", "memory" or "none"
+CONVERSION_CACHE_VERSION = os.getenv("CONVERSION_CACHE_VERSION", "2")
+CONVERSION_CACHE_TTL_SECONDS = int(os.getenv("CONVERSION_CACHE_TTL_SECONDS", 30 * 24 * 60 * 60))
+KEY_PREFIX = 'conversion-cache'
+
+class InMemoryCacheIndex:
+    """
+    Process-local stand-in for the Redis index, used in tests and when no Redis is configured.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl_seconds):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl_seconds, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+class RedisCacheIndex:
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key):
+        value = self.client.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl_seconds):
+        self.client.set(key, json.dumps(value), ex=ttl_seconds)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+def make_index(backend):
+    if backend == 'redis':
+        return RedisCacheIndex(redis_client)
+    if backend == 'memory':
+        return InMemoryCacheIndex()
+    return None
+
+index = make_index(CONVERSION_CACHE_BACKEND)
+
+def make_cache_key(sha256, kind, quality, dpi = None, model = None):
+    """
+    Builds the cache key of a conversion. Every setting that changes the output is part of the key,
+    so changing the model, quality, DPI or encoding profiles invalidates the old entries.
+
+    Args:
+        sha256 (str): The SHA-256 of the uploaded file.
+        kind (str): The type of the upload, "pdf" or "docx".
+        quality (int): The quality of the WebP images.
+        dpi (int): The rendering resolution, defaults to PDF_RENDER_DPI.
+        model (str): The summarization model, defaults to GEMINI_MODEL.
+    """
+    params = {
+        'kind': kind,
+        'quality': quality,
+        'dpi': dpi or file_converter.PDF_RENDER_DPI,
+        'model': model or GEMINI_MODEL,
+        'encoding': page_encoder.settings_fingerprint()
+    }
+    params_digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    return f"{KEY_PREFIX}:v{CONVERSION_CACHE_VERSION}:{sha256}:{params_digest}"
+
+def remember(key, material_id, public_links):
+    """
+    Records a finished conversion so the next upload of the same file can reuse it.
+    """
+    if index is None:
+        return
+
+    # Pages rendered on demand end up under this material only, so there is nothing complete to reuse
+    if any(not link.get('rendered', True) for link in public_links):
+        return
+
+    pages = [
+        {
+            'page': link['page'],
+            'kind': link.get('kind'),
+            'renditions': {
+                name: {field: value for field, value in rendition.items() if field != 'url'}
+                for name, rendition in link['renditions'].items()
+            }
+        }
+        for link in public_links
+    ]
+    index.set(key, {'material_id': material_id, 'pages': pages}, CONVERSION_CACHE_TTL_SECONDS)
+
+def restore(key, prefix):
+    """
+    Looks up a previous conversion of the same file. On a hit, the stored pages are copied inside storage
+    to this material's paths (so deleting either material never breaks the other), and the stored summary is reused.
+
+    Returns:
+        (content, public_links) on a hit, None on a miss.
+    """
+    if index is None:
+        return None
+
+    entry = index.get(key)
+    if entry is None:
+        return None
+
+    try:
+        summary = Material.get_summary_record(entry['material_id'])
+        if summary is None:
+            raise LookupError(f"Summary of material {entry['material_id']} no longer exists")
+
+        def copy_page(page_info):
+            renditions = {}
+            for name, rendition in page_info['renditions'].items():
+                dest_path = page_encoder.storage_path(prefix, page_info['page'], name)
+                renditions[name] = dict(rendition, path=dest_path, url=Material.copy_and_get_link(rendition['path'], dest_path))
+
+            return {
+                'page': page_info['page'],
+                'url': renditions['reader']['url'],
+                'path': renditions['reader']['path'],
+                'kind': page_info['kind'],
+                'renditions': renditions
+            }
+
+        with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as executor:
+            public_links = list(executor.map(copy_page, entry['pages']))
+    except Exception as e:
+        # The source material was probably deleted, forget it and convert from scratch
+        print(f"Cached conversion {key} is no longer usable: {e}")
+        index.delete(key)
+        return None
+
+    content = SimpleNamespace(
+        text=summary['content'],
+        usage=SimpleNamespace(
+            prompt_token_count=summary['prompt_token_count'],
+            thoughts_token_count=summary['thoughts_token_count'],
+            total_token_count=summary['total_token_count']
+        ),
+        page_texts=Material.get_material_page_texts(entry['material_id'])
+    )
+    print(f"Reused cached conversion of material {entry['material_id']} ({len(public_links)} pages)")
+    return content, public_links
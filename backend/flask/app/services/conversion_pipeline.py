@@ -0,0 +1,140 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from . import file_converter
+from .file_content_extractor import extract_all_pages_content
+from .page_uploader import PageUploader
+from . import lazy_renderer
+from . import worker_metrics
+
+class StageTimer:
+    """
+    Records when each stage of a task started and ended, relative to the start of the task.
+    Stages may overlap, the one that ends last is the critical path.
+    """
+    def __init__(self):
+        self.origin = time.time()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            worker_metrics.observe_stage(name, end - start)
+            with self._lock:
+                self.stages[name] = {
+                    'start': round(start - self.origin, 3),
+                    'end': round(end - self.origin, 3),
+                    'duration': round(end - start, 3)
+                }
+
+    def elapsed(self):
+        return time.time() - self.origin
+
+    def summary(self):
+        with self._lock:
+            ordered = sorted(self.stages.items(), key=lambda item: item[1]['start'])
+        return ", ".join(f"{name} {timing['duration']:.2f}s (+{timing['start']:.2f}s)" for name, timing in ordered)
+
+def _on_disk(rendered):
+    # Pages kept in memory don't outlive the attempt that rendered them
+    return all(rendition.get('file') for rendition in rendered['renditions'].values())
+
+def _files_exist(rendered):
+    return _on_disk(rendered) and all(os.path.exists(rendition['file']) for rendition in rendered['renditions'].values())
+
+def run_conversion_stages(pdf_path, output_dir_webp, prefix, quality, timer, reporter = None, checkpoint = None):
+    """
+    Runs the independent stages of a conversion concurrently and returns (content, public_links):
+
+        extract ──────────────────────┐
+        render ──> upload (per page) ─┴──> persist (done by the caller)
+
+    The caller only waits for the longest branch instead of the sum of all stages.
+    Stages run on threads inside the worker since every stage needs the same local PDF file.
+    Pages past LAZY_RENDER_PAGES are not rendered, they are returned as placeholders (see lazy_renderer).
+
+    Args:
+        pdf_path (str): The path to the input PDF file.
+        output_dir_webp (str): The directory to save the rendered pages, None to hand them to the uploader in memory.
+        prefix (str): The filename prefix of the rendered pages.
+        quality (int): The quality of the WebP images (0-100).
+        timer (StageTimer): Receives the timing of each stage.
+        reporter (ProgressReporter): Receives stage_done(stage, result) and page_done(stage, page, total) calls.
+        checkpoint (TaskCheckpoint): Records the extracted content and every rendered and uploaded page.
+            Stages and pages completed by a previous attempt of the task are skipped.
+    """
+    def extract():
+        content = checkpoint.extracted() if checkpoint is not None else None
+        if content is None:
+            with timer.stage('extract'):
+                content = extract_all_pages_content(pdf_path, mime_type='application/pdf')
+            if checkpoint is not None:
+                checkpoint.mark_extracted(content)
+        if reporter is not None:
+            reporter.stage_done('extract', content)
+        return content
+
+    def render_and_upload():
+        page_count = file_converter.count_pdf_pages(pdf_path)
+        # With LAZY_RENDER_PAGES set, the remaining pages are rendered on demand from the kept source PDF
+        pages = lazy_renderer.eager_pages(page_count)
+        total = len(pages)
+
+        uploaded_before = checkpoint.uploaded_pages() if checkpoint is not None else {}
+        # Rendered files only survive a retry that runs on the same worker
+        rendered_before = {
+            page: rendered for page, rendered in (checkpoint.rendered_pages() if checkpoint is not None else {}).items()
+            if page not in uploaded_before and _files_exist(rendered)
+        }
+        pages_to_render = [page for page in pages if page not in uploaded_before and page not in rendered_before]
+
+        rendered_count = total - len(pages_to_render)
+        uploaded = len(uploaded_before)
+        uploaded_lock = threading.Lock()
+
+        def on_uploaded(page, link):
+            nonlocal uploaded
+            if checkpoint is not None:
+                checkpoint.mark_uploaded(link)
+            with uploaded_lock:
+                uploaded += 1
+                count = uploaded
+            if reporter is not None:
+                reporter.page_done('upload', count, total)
+
+        with timer.stage('upload'), PageUploader(on_uploaded=on_uploaded) as uploader:
+            for page, rendered in sorted(rendered_before.items()):
+                uploader.submit(page, rendered)
+
+            with timer.stage('render'):
+                if pages_to_render:
+                    for page, rendered in file_converter.iter_pdf_to_webp(pdf_path, output_dir_webp, prefix, quality, pages=pages_to_render):
+                        worker_metrics.observe_page(rendered)
+                        if checkpoint is not None and _on_disk(rendered):
+                            checkpoint.mark_rendered(page, rendered)
+                        uploader.submit(page, rendered)
+                        rendered_count += 1
+                        if reporter is not None:
+                            reporter.page_done('render', rendered_count, total)
+            if reporter is not None:
+                reporter.stage_done('render', output_dir_webp or 'memory')
+
+            if total < page_count:
+                lazy_renderer.keep_source(pdf_path, prefix)
+            public_links = sorted(list(uploaded_before.values()) + uploader.results(), key=lambda link: link['page'])
+
+        if reporter is not None:
+            reporter.stage_done('upload', public_links)
+        return public_links + lazy_renderer.pending_page_links(total + 1, page_count)
+
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix='conversion-stage') as executor:
+        extract_future = executor.submit(extract)
+        pages_future = executor.submit(render_and_upload)
+        return extract_future.result(), pages_future.result()
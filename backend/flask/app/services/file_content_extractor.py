@@ -1,69 +1,359 @@
 import os
-from google import genai
-from google.genai import types
+import re
+import sys
+import time
+import random
+import tempfile
+import threading
 from dotenv import load_dotenv
 from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from pypdf import PdfReader, PdfWriter
+from . import text_layer
+from . import worker_metrics
 
 load_dotenv()
 
 # Set your API key
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-client = genai.Client(api_key=GEMINI_API_KEY)
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash-lite")
 
-def extract_all_pages_content(file_path, mime_type):
+# "single" sends the whole document in one request, "map_reduce" summarizes page ranges concurrently
+# and "auto" switches to map_reduce for documents longer than SUMMARY_MAP_REDUCE_MIN_PAGES.
+SUMMARY_MODE = os.getenv("SUMMARY_MODE", "auto")
+SUMMARY_MAP_REDUCE_MIN_PAGES = int(os.getenv("SUMMARY_MAP_REDUCE_MIN_PAGES", 30))
+SUMMARY_CHUNK_PAGES = int(os.getenv("SUMMARY_CHUNK_PAGES", 15))
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", 4))
+SUMMARY_MAX_RETRIES = int(os.getenv("SUMMARY_MAX_RETRIES", 2))
+SUMMARY_BACKOFF_SECONDS = float(os.getenv("SUMMARY_BACKOFF_SECONDS", 2))
+
+# "auto" reads the text layer of PDFs locally and only sends the scanned pages to the model as PDF,
+# "off" always sends the whole file.
+TEXT_LAYER_MODE = os.getenv("TEXT_LAYER_MODE", "auto")
+TEXT_DIGEST_CHUNK_PAGES = int(os.getenv("TEXT_DIGEST_CHUNK_PAGES", 40))
+TEXT_DIGEST_MAX_CHARS_PER_PAGE = int(os.getenv("TEXT_DIGEST_MAX_CHARS_PER_PAGE", 8000))
+
+# Define the system instruction
+SYSTEM_INSTRUCTION = (
+    "You are an expert document parser and data extractor. "
+    "Your task is to analyze an entire PDF or DOC document and provide a detailed, page-by-page breakdown of its contents. "
+    "For each page, you must identify and transcribe all text, describe any tables, charts, or images, "
+    "and present the information clearly under a header for that specific page. "
+    "Maintain the structure and logical flow of the original document. "
+    "Do not miss any details."
+)
+
+# Craft a single prompt to get content for all pages
+USER_PROMPT = "Provide a detailed, page-by-page summary of the entire document. Use '## Page [number]' as a header for each new page."
+
+PAGE_HEADER_PATTERN = re.compile(r'^(##\s*Page\s+)(\d+)', re.IGNORECASE | re.MULTILINE)
+
+class GeminiBackend:
     """
-    Extracts and summarizes the content of all pages from a PDF in a single response.
+    Sends a file and a prompt to Gemini. Any object with the same generate() method can replace it
+    through set_backend(), e.g. a fake backend that answers without network access in tests.
     """
-    # Define the system instruction
-    system_instruction = (
-        "You are an expert document parser and data extractor. "
-        "Your task is to analyze an entire PDF or DOC document and provide a detailed, page-by-page breakdown of its contents. "
-        "For each page, you must identify and transcribe all text, describe any tables, charts, or images, "
-        "and present the information clearly under a header for that specific page. "
-        "Maintain the structure and logical flow of the original document. "
-        "Do not miss any details."
-    )
+    def __init__(self, api_key, model):
+        # Only the workers talk to Gemini, the web tier never pays for importing the SDK
+        from google import genai
+        self.client = genai.Client(api_key=api_key)
+        self.model = model
 
-    try:
-        # Upload the file to the Gemini API
-        uploaded_file = client.files.upload(file=file_path, config=types.UploadFileConfig(mime_type=mime_type))
-        print(f"Uploaded file '{uploaded_file.name}' as: {uploaded_file.uri}")
-
-        # Craft a single prompt to get content for all pages
-        user_prompt = "Provide a detailed, page-by-page summary of the entire document. Use '## Page [number]' as a header for each new page."
-        
-        # Send the request with the file and the single prompt
-        response = client.models.generate_content(
-            model="gemini-2.0-flash-lite",
-            config=types.GenerateContentConfig(
-                system_instruction=system_instruction,
-                response_mime_type="text/plain"
-            ),
-            contents=[
-                user_prompt,
-                uploaded_file
-            ]
-        )
+    def generate(self, file_path, mime_type, system_instruction, user_prompt):
+        """
+        Returns:
+            SimpleNamespace: text, and usage with prompt_token_count, thoughts_token_count and total_token_count.
+        """
+        from google.genai import types
+        try:
+            # Upload the file to the Gemini API
+            uploaded_file = self.client.files.upload(file=file_path, config=types.UploadFileConfig(mime_type=mime_type))
+            print(f"Uploaded file '{uploaded_file.name}' as: {uploaded_file.uri}")
 
-        # Print the entire response
-        print(f"\n--- Detailed Content for the Entire Document ---")
-        usageMetadata = response.usage_metadata
-        
-    except Exception as e:
-        print(f"Gemini error occurred: {e}")
-    finally:
-        # Clean up the uploaded file to free up storage
-        if 'uploaded_file' in locals():
-            client.files.delete(name=uploaded_file.name)
-            print(f"\nDeleted file '{uploaded_file.name}'.")
-        
-        usage_details = SimpleNamespace(
-            prompt_token_count=usageMetadata.prompt_token_count,
-            thoughts_token_count=getattr(usageMetadata, 'thoughts_token_count', 0),
-            total_token_count=usageMetadata.total_token_count
-        )
+            # Send the request with the file and the prompt
+            response = self.client.models.generate_content(
+                model=self.model,
+                config=types.GenerateContentConfig(
+                    system_instruction=system_instruction,
+                    response_mime_type="text/plain"
+                ),
+                contents=[
+                    user_prompt,
+                    uploaded_file
+                ]
+            )
+        finally:
+            # Clean up the uploaded file to free up storage
+            if 'uploaded_file' in locals():
+                self.client.files.delete(name=uploaded_file.name)
+                print(f"\nDeleted file '{uploaded_file.name}'.")
 
+        usage_metadata = response.usage_metadata
         return SimpleNamespace(
             text=response.text,
-            usage=usage_details
-        )
\ No newline at end of file
+            usage=SimpleNamespace(
+                prompt_token_count=usage_metadata.prompt_token_count or 0,
+                thoughts_token_count=getattr(usage_metadata, 'thoughts_token_count', 0) or 0,
+                total_token_count=usage_metadata.total_token_count or 0
+            )
+        )
+
+# Created on first use by get_backend(), each process has its own client and keeps its connections alive
+backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    global backend
+    if backend is None:
+        with _backend_lock:
+            if backend is None:
+                backend = GeminiBackend(GEMINI_API_KEY, GEMINI_MODEL)
+    return backend
+
+def set_backend(new_backend):
+    """
+    Replaces the model backend, returning the previous one.
+    """
+    global backend
+    previous, backend = backend, new_backend
+    return previous
+
+def _reset_after_fork():
+    # A forked worker process opens its own connections instead of sharing the sockets of its parent
+    global backend, _backend_lock
+    _backend_lock = threading.Lock()
+    if isinstance(backend, GeminiBackend):
+        backend = None
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def is_rejected_request(error):
+    """
+    Whether Gemini rejected the request itself (a 4xx other than rate limiting), which sending it again won't fix.
+    """
+    # The SDK is only loaded once the backend was created, no request was sent before that
+    if 'google.genai' not in sys.modules:
+        return False
+    from google.genai import errors
+    return isinstance(error, errors.ClientError) and error.code != 429
+
+def _generate_with_retry(file_path, mime_type, user_prompt, max_retries = None):
+    max_retries = SUMMARY_MAX_RETRIES if max_retries is None else max_retries
+
+    start = time.time()
+    for attempt in range(max_retries + 1):
+        try:
+            result = get_backend().generate(file_path, mime_type, SYSTEM_INSTRUCTION, user_prompt)
+            worker_metrics.observe_gemini(time.time() - start, 'success', result.usage)
+            return result
+        except Exception as e:
+            if attempt == max_retries or is_rejected_request(e):
+                worker_metrics.observe_gemini(time.time() - start, 'failure')
+                raise
+            delay = SUMMARY_BACKOFF_SECONDS * (2 ** attempt) * (1 + random.random())
+            print(f"Gemini error occurred: {e}, retrying in {delay:.2f} seconds")
+            time.sleep(delay)
+
+def _renumber_pages(text, first_page):
+    """
+    Shifts the '## Page N' headers of a chunk summary to the page numbers of the whole document.
+    The model is asked to number from first_page, but it sometimes restarts at 1.
+    """
+    numbers = [int(match.group(2)) for match in PAGE_HEADER_PATTERN.finditer(text)]
+    if not numbers or numbers[0] == first_page:
+        return text
+
+    offset = first_page - numbers[0]
+    return PAGE_HEADER_PATTERN.sub(lambda match: f"{match.group(1)}{int(match.group(2)) + offset}", text)
+
+def _sum_usage(usages):
+    return SimpleNamespace(
+        prompt_token_count=sum(usage.prompt_token_count for usage in usages),
+        thoughts_token_count=sum(usage.thoughts_token_count for usage in usages),
+        total_token_count=sum(usage.total_token_count for usage in usages)
+    )
+
+def _write_pages(reader, pages, output_path):
+    writer = PdfWriter()
+    for page in pages:
+        writer.add_page(reader.pages[page - 1])
+    with open(output_path, 'wb') as f:
+        writer.write(f)
+
+def _write_page_range(reader, first_page, last_page, output_path):
+    _write_pages(reader, range(first_page, last_page + 1), output_path)
+
+def _number_as(text, pages):
+    """
+    Maps the '## Page N' headers of a summary of non-consecutive pages to their page numbers in the document,
+    for when the model numbered them 1, 2, 3... instead.
+    """
+    numbers = [int(match.group(2)) for match in PAGE_HEADER_PATTERN.finditer(text)]
+    if not numbers or set(numbers) <= set(pages) or not all(1 <= number <= len(pages) for number in numbers):
+        return text
+    return PAGE_HEADER_PATTERN.sub(lambda match: f"{match.group(1)}{pages[int(match.group(2)) - 1]}", text)
+
+def _split_sections(text, default_page):
+    """
+    Splits a page-by-page summary into (page, section) pairs. Text without headers is kept as one section at default_page.
+    """
+    matches = list(PAGE_HEADER_PATTERN.finditer(text))
+    if not matches:
+        return [(default_page, text.strip())]
+
+    sections = []
+    for index, match in enumerate(matches):
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(text)
+        sections.append((int(match.group(2)), text[match.start():end].strip()))
+    return sections
+
+def extract_content_map_reduce(pdf_path, chunk_pages = None, concurrency = None):
+    """
+    Splits the PDF into page ranges, summarizes them concurrently and stitches the '## Page N' sections back together in order.
+    A failing chunk is retried on its own instead of throwing away the whole document.
+
+    Args:
+        pdf_path (str): The path to the input PDF file.
+        chunk_pages (int): The number of pages per chunk, defaults to SUMMARY_CHUNK_PAGES.
+        concurrency (int): The maximum number of concurrent requests, defaults to SUMMARY_CONCURRENCY.
+    """
+    chunk_pages = chunk_pages or SUMMARY_CHUNK_PAGES
+    concurrency = concurrency or SUMMARY_CONCURRENCY
+
+    reader = PdfReader(pdf_path)
+    page_count = len(reader.pages)
+    chunks = [
+        (first_page, min(first_page + chunk_pages - 1, page_count))
+        for first_page in range(1, page_count + 1, chunk_pages)
+    ]
+
+    with tempfile.TemporaryDirectory() as chunk_dir:
+        # Split up front, PdfReader is not safe to share between threads
+        chunk_paths = []
+        for first_page, last_page in chunks:
+            chunk_path = os.path.join(chunk_dir, f"pages_{first_page}_{last_page}.pdf")
+            _write_page_range(reader, first_page, last_page, chunk_path)
+            chunk_paths.append(chunk_path)
+
+        def summarize_chunk(chunk, chunk_path):
+            first_page, last_page = chunk
+            user_prompt = (
+                f"This file contains pages {first_page} to {last_page} of a {page_count}-page document. "
+                f"Provide a detailed, page-by-page summary of these pages. Use '## Page [number]' as a header for each new page, "
+                f"numbering the pages from {first_page} to {last_page}."
+            )
+            result = _generate_with_retry(chunk_path, 'application/pdf', user_prompt)
+            print(f"Summarized pages {first_page}-{last_page}")
+            return SimpleNamespace(text=_renumber_pages(result.text, first_page), usage=result.usage)
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='summarize') as executor:
+            results = list(executor.map(summarize_chunk, chunks, chunk_paths))
+
+    return SimpleNamespace(
+        text="\n\n".join(result.text.strip() for result in results),
+        usage=_sum_usage([result.usage for result in results])
+    )
+
+def page_sections(text):
+    """
+    Returns page number -> '## Page N' section of a page-by-page summary, which is indexed with the page for search.
+    """
+    sections = {}
+    for page, section in _split_sections(text, None):
+        if page is None:
+            continue
+        sections[page] = f"{sections[page]}\n\n{section}" if page in sections else section
+    return sections
+
+def extract_content_with_text_layer(pdf_path, page_texts, concurrency = None):
+    """
+    Summarizes a PDF using its local text layer. Pages with usable text are sent as a compact text digest,
+    and only the scanned pages are sent as PDF. The requests run concurrently and the '## Page N' sections
+    are stitched back together in page order.
+
+    Args:
+        pdf_path (str): The path to the input PDF file.
+        page_texts (dict): page number -> raw text of every page, see text_layer.extract_page_texts.
+        concurrency (int): The maximum number of concurrent requests, defaults to SUMMARY_CONCURRENCY.
+    """
+    concurrency = concurrency or SUMMARY_CONCURRENCY
+    page_count = len(page_texts)
+    digests = {
+        page: text_layer.compact_text(text)[:TEXT_DIGEST_MAX_CHARS_PER_PAGE]
+        for page, text in page_texts.items() if text_layer.has_text_layer(text)
+    }
+    text_pages = sorted(digests)
+    scanned_pages = [page for page in sorted(page_texts) if page not in digests]
+    print(f"{len(text_pages)} of {page_count} pages have a text layer, sending {len(scanned_pages)} scanned pages as PDF")
+
+    with tempfile.TemporaryDirectory() as chunk_dir:
+        jobs = []
+        for index in range(0, len(text_pages), TEXT_DIGEST_CHUNK_PAGES):
+            pages = text_pages[index:index + TEXT_DIGEST_CHUNK_PAGES]
+            chunk_path = os.path.join(chunk_dir, f"text_{pages[0]}_{pages[-1]}.txt")
+            with open(chunk_path, 'w', encoding='utf-8') as f:
+                f.write("\n\n".join(f"## Page {page}\n{digests[page]}" for page in pages))
+            user_prompt = (
+                f"This file contains the text of some pages of a {page_count}-page document, each under a '## Page [number]' header. "
+                f"Provide a detailed, page-by-page summary of these pages, keeping the same '## Page [number]' headers."
+            )
+            jobs.append((chunk_path, 'text/plain', user_prompt, pages))
+
+        if scanned_pages:
+            # Split up front, PdfReader is not safe to share between threads
+            reader = PdfReader(pdf_path)
+            for index in range(0, len(scanned_pages), SUMMARY_CHUNK_PAGES):
+                pages = scanned_pages[index:index + SUMMARY_CHUNK_PAGES]
+                chunk_path = os.path.join(chunk_dir, f"scanned_{pages[0]}_{pages[-1]}.pdf")
+                _write_pages(reader, pages, chunk_path)
+                user_prompt = (
+                    f"This file contains pages {', '.join(str(page) for page in pages)} of a {page_count}-page document, in that order. "
+                    f"Provide a detailed, page-by-page summary of these pages. Use '## Page [number]' as a header for each new page, "
+                    f"numbering the pages with the page numbers above."
+                )
+                jobs.append((chunk_path, 'application/pdf', user_prompt, pages))
+
+        def summarize(job):
+            chunk_path, mime_type, user_prompt, pages = job
+            result = _generate_with_retry(chunk_path, mime_type, user_prompt)
+            print(f"Summarized {len(pages)} pages from {os.path.basename(chunk_path)}")
+            return SimpleNamespace(text=_number_as(result.text, pages), usage=result.usage, pages=pages)
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='summarize') as executor:
+            results = list(executor.map(summarize, jobs))
+
+    sections = []
+    for result in results:
+        sections.extend(_split_sections(result.text, result.pages[0]))
+    sections.sort(key=lambda section: section[0])
+
+    return SimpleNamespace(
+        text="\n\n".join(section for _, section in sections),
+        usage=_sum_usage([result.usage for result in results])
+    )
+
+def extract_all_pages_content(file_path, mime_type):
+    """
+    Extracts and summarizes the content of all pages from a PDF. Pages with a text layer are read locally first
+    (see TEXT_LAYER_MODE), otherwise the file is sent in a single response or per page range (see SUMMARY_MODE).
+
+    Returns:
+        SimpleNamespace: text, usage and, for PDFs, page_texts with the local text of every page that has a text layer.
+    """
+    if mime_type != 'application/pdf':
+        return _generate_with_retry(file_path, mime_type, USER_PROMPT)
+
+    page_count = len(PdfReader(file_path).pages)
+    page_texts = text_layer.extract_page_texts(file_path, page_count) if TEXT_LAYER_MODE == 'auto' else {}
+    usable_texts = {page: text_layer.compact_text(text) for page, text in page_texts.items() if text_layer.has_text_layer(text)}
+
+    if usable_texts:
+        result = extract_content_with_text_layer(file_path, page_texts)
+    elif SUMMARY_MODE == 'map_reduce' or (SUMMARY_MODE == 'auto' and page_count > SUMMARY_MAP_REDUCE_MIN_PAGES):
+        result = extract_content_map_reduce(file_path)
+    else:
+        result = _generate_with_retry(file_path, mime_type, USER_PROMPT)
+        print(f"\n--- Detailed Content for the Entire Document ---")
+
+    result.page_texts = usable_texts
+    return result
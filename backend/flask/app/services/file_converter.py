@@ -1,36 +1,177 @@
-from pdf2image import convert_from_path
-from docx2pdf import convert
+from pdf2image import convert_from_path, pdfinfo_from_path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dotenv import load_dotenv
+from PIL import Image
+import multiprocessing
+from . import office_converter
+from . import page_encoder
+import tempfile
+import time
 import os
 
-def pdf_to_webp(pdf_path, output_dir, prefix, quality = 20):
+load_dotenv()
+
+# Rasterization settings. A worker count of 0 means one render process per CPU core.
+PDF_RENDER_DPI = int(os.getenv("PDF_RENDER_DPI", 140))
+PDF_RENDER_WORKERS = int(os.getenv("PDF_RENDER_WORKERS", 0)) or os.cpu_count() or 1
+PDF_RENDER_BATCH_SIZE = int(os.getenv("PDF_RENDER_BATCH_SIZE", 8))
+PDF_RENDER_EXECUTOR = os.getenv("PDF_RENDER_EXECUTOR", "process")  # "process" or "thread"
+
+def count_pdf_pages(pdf_path):
+    return int(pdfinfo_from_path(pdf_path)["Pages"])
+
+def _encode_page(image, output_dir, prefix, page, quality, dpi, source_dpi, rasterize_seconds):
+    encode_start = time.time()
+    kind, renditions = page_encoder.encode_renditions(image, output_dir, prefix, page, quality, dpi, source_dpi)
+    return page, {
+        'kind': kind,
+        'renditions': renditions,
+        # Observed by the worker process, the render pool can't report metrics itself
+        'timings': {'rasterize': rasterize_seconds, 'encode': time.time() - encode_start}
+    }
+
+def _render_batch(pdf_path, output_dir, prefix, quality, dpi, first_page, last_page):
     """
-    Converts a PDF file to WebP images.
+    Rasterizes pages first_page..last_page and encodes their WebP renditions, one page in memory at a time.
+    With output_dir set to None, nothing touches the disk: pdftoppm streams the batch back over a pipe
+    (so the whole batch is held in memory while it is encoded) and the renditions are kept in memory.
+    Runs inside the render pool, so it must stay a picklable module-level function.
+    """
+    results = []
+    source_dpi = page_encoder.render_dpi(dpi)
+
+    if output_dir is None:
+        rasterize_start = time.time()
+        images = convert_from_path(pdf_path, dpi=source_dpi, first_page=first_page, last_page=last_page, fmt='ppm')
+        rasterize_seconds = (time.time() - rasterize_start) / max(len(images), 1)
+
+        for offset, image in enumerate(images):
+            with image:
+                results.append(_encode_page(image, None, prefix, first_page + offset, quality, dpi, source_dpi, rasterize_seconds))
+        return results
+
+    # Let pdftoppm write the raw pages to disk instead of holding the whole batch as PIL images
+    with tempfile.TemporaryDirectory(dir=output_dir) as raw_dir:
+        rasterize_start = time.time()
+        raw_paths = convert_from_path(
+            pdf_path,
+            dpi=source_dpi,
+            first_page=first_page,
+            last_page=last_page,
+            output_folder=raw_dir,
+            fmt='ppm',
+            paths_only=True
+        )
+        # pdftoppm renders the whole batch in one call, each page gets its share
+        rasterize_seconds = (time.time() - rasterize_start) / max(len(raw_paths), 1)
+
+        for offset, raw_path in enumerate(raw_paths):
+            with Image.open(raw_path) as image:
+                results.append(_encode_page(image, output_dir, prefix, first_page + offset, quality, dpi, source_dpi, rasterize_seconds))
+            os.remove(raw_path)
+
+    return results
+
+def _make_executor(workers):
+    # Celery's prefork children are daemonic and may not be allowed to fork a process pool of their own.
+    # Threads still render in parallel there, since pdftoppm runs as a subprocess and Pillow releases the GIL while encoding.
+    if PDF_RENDER_EXECUTOR == "thread" or multiprocessing.current_process().daemon:
+        return ThreadPoolExecutor(max_workers=workers)
+    return ProcessPoolExecutor(max_workers=workers)
+
+def page_batches(pages, batch_size):
+    """
+    Groups sorted page numbers into (first_page, last_page) ranges of consecutive pages, at most batch_size long.
+    """
+    batches = []
+    for page in sorted(set(pages)):
+        if batches and page == batches[-1][1] + 1 and page - batches[-1][0] < batch_size:
+            batches[-1] = (batches[-1][0], page)
+        else:
+            batches.append((page, page))
+    return batches
+
+def iter_pdf_to_webp(pdf_path, output_dir, prefix, quality = 20, dpi = None, workers = None, batch_size = None, pages = None):
+    """
+    Converts a PDF file to WebP images, yielding (page_number, rendered) as soon as each batch is encoded.
+    rendered holds the page kind and its renditions (see page_encoder.encode_renditions).
+    Pages are rendered in batches of batch_size over a pool of workers, and at most one batch per worker is
+    in flight, so memory use does not grow with the number of pages. Pages may be yielded out of order.
 
     Args:
         pdf_path (str): The path to the input PDF file.
-        output_dir (str): The directory to save the output WebP images.
+        output_dir (str): The directory to save the output WebP images, None to keep them in memory.
+        prefix (str): The filename prefix of the output images.
         quality (int): The quality of the WebP images (0-100).
+        dpi (int): The resolution of the reader rendition, defaults to PDF_RENDER_DPI.
+        workers (int): The size of the render pool, defaults to PDF_RENDER_WORKERS.
+        batch_size (int): The number of pages rendered per job, defaults to PDF_RENDER_BATCH_SIZE.
+        pages (iterable): The page numbers to render, defaults to every page.
     """
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    dpi = dpi or PDF_RENDER_DPI
+    workers = workers or PDF_RENDER_WORKERS
+    batch_size = batch_size or PDF_RENDER_BATCH_SIZE
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
 
     try:
-        # Convert PDF pages to images
-        images = convert_from_path(pdf_path, dpi = 140)
+        if pages is None:
+            pages = range(1, count_pdf_pages(pdf_path) + 1)
+        batch_list = page_batches(pages, batch_size)
+        batches = iter(batch_list)
+
+        with _make_executor(min(workers, max(len(batch_list), 1))) as executor:
+            pending = set()
+
+            def submit_next():
+                batch = next(batches, None)
+                if batch is not None:
+                    pending.add(executor.submit(_render_batch, pdf_path, output_dir, prefix, quality, dpi, *batch))
 
-        # Convert each page to WebP
-        for i, image in enumerate(images):
-            output_path = os.path.join(output_dir, f"{prefix}_page_{i+1}.webp")
+            for _ in range(workers):
+                submit_next()
 
-            # Convert to WebP using Pillow
-            image.save(output_path, 'WEBP', quality=quality)
-            print(f"Saved {output_path}")
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    for page, rendered in future.result():
+                        print(f"Rendered page {page} ({rendered['kind']}) to {output_dir or 'memory'}")
+                        yield page, rendered
+                    submit_next()
 
     except Exception as e:
-        raise RuntimeError(f"An error occurred during PDF to WebP conversion: {str(e)}")
+        raise RuntimeError(f"An error occurred during PDF to WebP conversion: {str(e)}") from e
+
+def pdf_to_webp(pdf_path, output_dir, prefix, quality = 20, dpi = None):
+    """
+    Converts a PDF file to WebP images.
+
+    Args:
+        pdf_path (str): The path to the input PDF file.
+        output_dir (str): The directory to save the output WebP images.
+        quality (int): The quality of the WebP images (0-100).
+
+    Returns:
+        list: The local paths of the reader renditions, ordered by page number.
+    """
+    pages = dict(iter_pdf_to_webp(pdf_path, output_dir, prefix, quality, dpi))
+    return [pages[page]['renditions']['reader']['file'] for page in sorted(pages)]
+
+def render_page(pdf_path, output_dir, prefix, page, quality = 20, dpi = None):
+    """
+    Renders a single page in the calling process, for on-demand rendering.
+
+    Returns:
+        dict: The page kind and its renditions (see page_encoder.encode_renditions).
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    return _render_batch(pdf_path, output_dir, prefix, quality, dpi or PDF_RENDER_DPI, page, page)[0][1]
 
 def docx_to_pdf(docx_path, output_dir, output_pdf_filename):
-    # Add .docx extension if not present. This ensure convert() works correctly
+    # Add .docx extension if not present. This ensure the converter works correctly
     if not docx_path.endswith('.docx'):
         docx_path += '.docx'
 
@@ -42,7 +183,8 @@ def docx_to_pdf(docx_path, output_dir, output_pdf_filename):
     pdf_path = os.path.join(output_dir, output_pdf_filename)
 
     try:
-        convert(docx_path, pdf_path)
+        # See office_converter.DOCX_CONVERTER_BACKEND, Linux workers use a pool of warm headless LibreOffice processes
+        office_converter.convert_docx(docx_path, pdf_path)
         print(f"Converted {docx_path} to {pdf_path}")
     except Exception as e:
-        raise RuntimeError(f"An error occurred during DOCX to PDF conversion: {str(e)}")
\ No newline at end of file
+        raise RuntimeError(f"An error occurred during DOCX to PDF conversion: {str(e)}") from e
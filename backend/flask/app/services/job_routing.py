@@ -0,0 +1,130 @@
+import os
+import re
+import json
+import zipfile
+from dotenv import load_dotenv
+from pypdf import PdfReader
+from celery.signals import task_postrun
+from ..config.celery import CONVERSION_QUEUES
+from ..config.redis_client import redis_client
+from .blob_spool import store as blob_store
+
+load_dotenv()
+
+# Each queue is served by its own workers (see docker-compose.yaml and k8s/deployments),
+# so a 400-page document never holds up the 5-page uploads queued behind it.
+SMALL_QUEUE, LARGE_QUEUE, DOCX_QUEUE = CONVERSION_QUEUES
+
+SMALL_JOB_MAX_PAGES = int(os.getenv("SMALL_JOB_MAX_PAGES", 30))
+SMALL_JOB_MAX_BYTES = int(os.getenv("SMALL_JOB_MAX_BYTES", 10 * 1024 * 1024))
+# Used when the page count can't be read, e.g. a DOCX saved without page statistics
+ESTIMATED_BYTES_PER_PAGE = int(os.getenv("ESTIMATED_BYTES_PER_PAGE", 50 * 1024))
+
+# Redis priorities run from 0 (first) to 9 (last). Cheap jobs start ahead, and every job a user
+# already has in flight pushes their next one back, so one uploader can't monopolize the workers.
+PRIORITY_LEVELS = 10
+FAIRNESS_PRIORITY_STEP = int(os.getenv("FAIRNESS_PRIORITY_STEP", 1))
+INFLIGHT_KEY_PREFIX = 'job-routing:inflight'
+# Lets a counter heal when a worker dies before its task_postrun
+INFLIGHT_TTL_SECONDS = int(os.getenv("INFLIGHT_TTL_SECONDS", 6 * 60 * 60))
+
+DOCX_PAGES_PATTERN = re.compile(rb'<Pages>(\d+)</Pages>')
+
+def _count_pdf_pages(path):
+    # Only the cross-reference table and the page tree are read, not the page contents
+    return len(PdfReader(path).pages)
+
+def _count_docx_pages(path):
+    # Word stores the page count of the last save in docProps/app.xml
+    with zipfile.ZipFile(path) as archive:
+        match = DOCX_PAGES_PATTERN.search(archive.read('docProps/app.xml'))
+    return int(match.group(1)) if match else None
+
+def estimate_job_cost(file_info, kind):
+    """
+    Estimates how expensive a conversion will be from the spooled upload.
+
+    Args:
+        file_info (dict): The spooled upload, see blob_spool.spool_upload.
+        kind (str): "pdf" or "docx".
+
+    Returns:
+        dict: kind, pages (estimated when it can't be read), bytes and whether the page count is exact.
+    """
+    size = file_info['blob']['size']
+    pages = None
+    try:
+        path = blob_store.path_of(file_info['blob'])
+        pages = _count_pdf_pages(path) if kind == 'pdf' else _count_docx_pages(path)
+    except Exception as e:
+        print(f"Could not count the pages of {file_info['filename']}: {e}")
+
+    return {
+        'kind': kind,
+        'pages': pages if pages is not None else max(1, size // ESTIMATED_BYTES_PER_PAGE),
+        'bytes': size,
+        'exact': pages is not None
+    }
+
+def choose_queue(cost):
+    if cost['kind'] == 'docx':
+        return DOCX_QUEUE
+    if cost['pages'] <= SMALL_JOB_MAX_PAGES and cost['bytes'] <= SMALL_JOB_MAX_BYTES:
+        return SMALL_QUEUE
+    return LARGE_QUEUE
+
+def base_priority(cost):
+    # 0-4 from the page count, so short documents of a queue run before long ones
+    for priority, max_pages in enumerate((5, 15, 50, 150)):
+        if cost['pages'] <= max_pages:
+            return priority
+    return 4
+
+def _user_id(form):
+    try:
+        return json.loads(form.get('info', '{}')).get('user_id')
+    except (ValueError, AttributeError):
+        return None
+
+def _inflight_key(user_id):
+    return f"{INFLIGHT_KEY_PREFIX}:{user_id}"
+
+def route_job(file_info, form, kind, cost = None):
+    """
+    Picks the queue and priority of a conversion job, and counts it as in flight for its user.
+
+    Args:
+        cost (dict): The estimate of estimate_job_cost, when the caller already has it.
+
+    Returns:
+        dict: Options for apply_async (queue and priority).
+    """
+    cost = cost or estimate_job_cost(file_info, kind)
+    priority = base_priority(cost)
+
+    user_id = _user_id(form)
+    if user_id and redis_client is not None:
+        with redis_client.pipeline() as pipe:
+            pipe.incr(_inflight_key(user_id))
+            pipe.expire(_inflight_key(user_id), INFLIGHT_TTL_SECONDS)
+            inflight = pipe.execute()[0] - 1
+        priority += inflight * FAIRNESS_PRIORITY_STEP
+
+    options = {'queue': choose_queue(cost), 'priority': min(priority, PRIORITY_LEVELS - 1)}
+    print(f"Routing {file_info['filename']} ({cost['pages']} pages, {cost['bytes']} bytes) to {options['queue']} with priority {options['priority']}")
+    return options
+
+@task_postrun.connect
+def release_inflight(task = None, args = None, state = None, **kwargs):
+    # A retried task is still in flight
+    if state == 'RETRY' or redis_client is None:
+        return
+    # Only conversion tasks, which take (file_info, form), were counted by route_job
+    if not args or len(args) < 2 or not isinstance(args[0], dict) or 'blob' not in args[0]:
+        return
+
+    user_id = _user_id(args[1])
+    if user_id:
+        # The counter may have expired while the task ran, don't let it go negative
+        if redis_client.decr(_inflight_key(user_id)) < 0:
+            redis_client.delete(_inflight_key(user_id))
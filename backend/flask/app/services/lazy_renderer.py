@@ -0,0 +1,137 @@
+import os
+import uuid
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from werkzeug.utils import secure_filename
+from ..models.material import Material
+from . import file_converter
+from . import page_encoder
+from .page_cache import cache as page_cache
+from .scratch import ScratchSpace
+
+load_dotenv()
+
+# Only the first LAZY_RENDER_PAGES pages are rendered at upload time, 0 renders every page up front
+LAZY_RENDER_PAGES = int(os.getenv("LAZY_RENDER_PAGES", 0))
+# The quality of the pages rendered on demand, the quality of the upload request isn't stored
+LAZY_RENDER_QUALITY = int(os.getenv("LAZY_RENDER_QUALITY", 20))
+LAZY_UPLOAD_WORKERS = int(os.getenv("LAZY_UPLOAD_WORKERS", 2))
+SOURCE_FOLDER = 'sources'
+
+# Concurrent requests for the same page wait for a single render instead of each rendering it
+_render_locks = [threading.Lock() for _ in range(64)]
+_upload_executor = ThreadPoolExecutor(max_workers=LAZY_UPLOAD_WORKERS, thread_name_prefix='lazy-upload')
+
+def source_storage_path(prefix):
+    return f"{SOURCE_FOLDER}/{prefix}.pdf"
+
+def eager_pages(page_count):
+    """
+    Returns the pages rendered at upload time.
+    """
+    if LAZY_RENDER_PAGES > 0:
+        return range(1, min(page_count, LAZY_RENDER_PAGES) + 1)
+    return range(1, page_count + 1)
+
+def keep_source(pdf_path, prefix):
+    # Pages past the eager ones are rendered from this copy of the PDF
+    Material.upload_and_get_link(pdf_path, source_storage_path(prefix))
+
+def pending_page_links(first_page, last_page):
+    # Placeholders for the MaterialPage rows of the pages that are rendered on demand
+    return [{'page': page, 'url': None, 'rendered': False} for page in range(first_page, last_page + 1)]
+
+def _page_key(prefix, page, rendition):
+    return f"{prefix}_page_{page}_{rendition}.webp"
+
+def _source_pdf(prefix):
+    # The source PDF goes through the same cache, so rendering a few pages of one material downloads it once
+    key = f"{prefix}_source.pdf"
+    path = page_cache.get(key)
+    if path is not None:
+        return path
+
+    fd, temp_path = tempfile.mkstemp(suffix='.pdf')
+    os.close(fd)
+    try:
+        Material.download_file(source_storage_path(prefix), temp_path)
+        return page_cache.put(key, temp_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def _persist_page(material_id, page, rendered, scratch):
+    """
+    Uploads the renditions of a page rendered on demand and marks it as rendered,
+    so the next requests are redirected to storage instead of hitting this server.
+    """
+    try:
+        # Same storage layout as the conversion tasks, see page_encoder.storage_path
+        renditions = {
+            name: page_encoder.stored_rendition(rendition, url=Material.upload_and_get_link(rendition['file'], rendition['path']))
+            for name, rendition in rendered['renditions'].items()
+        }
+
+        Material.update_material_page_record(material_id, page, {
+            'page': page,
+            'url': renditions['reader']['url'],
+            'kind': rendered['kind'],
+            'renditions': renditions
+        })
+    except Exception as e:
+        # The page is still served from the cache, the upload is tried again after it is evicted
+        print(f"Could not persist page {page} of material {material_id}: {e}")
+    finally:
+        scratch.cleanup()
+
+def _render(material_id, prefix, page, rendition):
+    scratch = ScratchSpace(f"lazy-{uuid.uuid4().hex}").open()
+    try:
+        source_path = _source_pdf(prefix)
+        rendered = file_converter.render_page(source_path, scratch.pages_dir, prefix, page, LAZY_RENDER_QUALITY)
+        # Making room for a rendition must not evict the source or the renditions cached before it
+        cached = {}
+        for name, info in rendered['renditions'].items():
+            cached[name] = page_cache.put(_page_key(prefix, page, name), info['file'], keep={source_path, *cached.values()})
+    except Exception:
+        scratch.cleanup()
+        raise
+
+    _upload_executor.submit(_persist_page, material_id, page, rendered, scratch)
+    return cached[rendition]
+
+def get_page(material_id, page, rendition = 'reader'):
+    """
+    Finds a rendition of a material page, rendering it if it was never rendered.
+
+    Args:
+        material_id (str): The material of the page.
+        page (int): The page number.
+        rendition (str): One of page_encoder.PAGE_RENDITIONS.
+
+    Returns:
+        ('url', public_url) when the page is already in storage, ('file', local_path) when it is served
+        from the rendered-page cache, or None when the material has no such page. The cached file may still
+        be evicted by another process before it is read, get_page renders it again on the next call.
+    """
+    prefix = secure_filename(material_id)
+    key = _page_key(prefix, page, rendition)
+
+    path = page_cache.get(key)
+    if path is not None:
+        return 'file', path
+
+    record = Material.get_material_page_record(material_id, page)
+    if record is None:
+        return None
+
+    url_column = 'url' if rendition == 'reader' else f'{rendition}_url'
+    if record.get('is_rendered', True) and record.get(url_column):
+        return 'url', record[url_column]
+
+    with _render_locks[hash(key) % len(_render_locks)]:
+        # Another request may have rendered the page while this one waited
+        path = page_cache.get(key) or _render(material_id, prefix, page, rendition)
+    return 'file', path
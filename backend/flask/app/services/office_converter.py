@@ -0,0 +1,246 @@
+import os
+import sys
+import time
+import queue
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "unoserver" keeps warm LibreOffice processes, "soffice" cold-starts LibreOffice per conversion
+# and "docx2pdf" drives Microsoft Word, which only works on Windows and macOS.
+DOCX_CONVERTER_BACKEND = os.getenv("DOCX_CONVERTER_BACKEND", "docx2pdf" if sys.platform == "win32" else "unoserver")
+OFFICE_POOL_SIZE = int(os.getenv("OFFICE_POOL_SIZE", 1))
+OFFICE_MAX_JOBS_PER_PROCESS = int(os.getenv("OFFICE_MAX_JOBS_PER_PROCESS", 50))
+OFFICE_CONVERT_TIMEOUT_SECONDS = int(os.getenv("OFFICE_CONVERT_TIMEOUT_SECONDS", 120))
+OFFICE_STARTUP_TIMEOUT_SECONDS = int(os.getenv("OFFICE_STARTUP_TIMEOUT_SECONDS", 30))
+OFFICE_CHECKOUT_TIMEOUT_SECONDS = int(os.getenv("OFFICE_CHECKOUT_TIMEOUT_SECONDS", 300))
+# Workers that don't consume the DOCX queue can skip starting LibreOffice
+OFFICE_WARM_ON_START = os.getenv("OFFICE_WARM_ON_START", "true").lower() == "true"
+UNOSERVER_BIN = os.getenv("UNOSERVER_BIN", "unoserver")
+UNOCONVERT_BIN = os.getenv("UNOCONVERT_BIN", "unoconvert")
+SOFFICE_BIN = os.getenv("SOFFICE_BIN", "soffice")
+
+def _free_port():
+    # Every prefork child runs its own pool, so ports are picked by the OS instead of configured
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def _kill_process_group(process):
+    # LibreOffice runs as a child of unoserver, so the whole process group has to go
+    if process is None or process.poll() is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        pass
+
+class OfficeServer:
+    """
+    A long-lived headless LibreOffice driven through unoserver, with its own ports and user profile.
+    """
+    def __init__(self):
+        self.process = None
+        self.port = None
+        self.jobs = 0
+        self.profile_dir = None
+
+    def start(self):
+        self.port = _free_port()
+        uno_port = _free_port()
+        self.profile_dir = tempfile.mkdtemp(prefix='unoserver-profile-')
+        self.jobs = 0
+
+        self.process = subprocess.Popen(
+            [
+                UNOSERVER_BIN,
+                '--interface', '127.0.0.1',
+                '--port', str(self.port),
+                '--uno-port', str(uno_port),
+                '--user-installation', f'file://{self.profile_dir}'
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True
+        )
+
+        deadline = time.time() + OFFICE_STARTUP_TIMEOUT_SECONDS
+        while time.time() < deadline:
+            if self.is_healthy():
+                print(f'Started unoserver on port {self.port} (pid {self.process.pid})')
+                return
+            if self.process.poll() is not None:
+                break
+            time.sleep(0.25)
+
+        self.stop()
+        raise RuntimeError(f"unoserver did not become ready within {OFFICE_STARTUP_TIMEOUT_SECONDS} seconds")
+
+    def is_healthy(self):
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            with socket.create_connection(('127.0.0.1', self.port), timeout=1):
+                return True
+        except OSError:
+            return False
+
+    def convert(self, source_path, pdf_path, timeout):
+        self.jobs += 1
+        subprocess.run(
+            [UNOCONVERT_BIN, '--host', '127.0.0.1', '--port', str(self.port), '--convert-to', 'pdf', source_path, pdf_path],
+            check=True,
+            timeout=timeout,
+            capture_output=True
+        )
+
+    def stop(self):
+        _kill_process_group(self.process)
+        self.process = None
+        if self.profile_dir is not None:
+            shutil.rmtree(self.profile_dir, ignore_errors=True)
+            self.profile_dir = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+class OfficeConverterPool:
+    """
+    A pool of warm OfficeServers. Each conversion checks a server out, so one LibreOffice never runs two jobs at once.
+    Servers are health-checked on checkout, recycled after max_jobs conversions and killed when a conversion times out.
+    """
+    def __init__(self, size = None, max_jobs = None, timeout = None):
+        self.size = size or OFFICE_POOL_SIZE
+        self.max_jobs = max_jobs or OFFICE_MAX_JOBS_PER_PROCESS
+        self.timeout = timeout or OFFICE_CONVERT_TIMEOUT_SECONDS
+        self._idle = queue.Queue()
+        self._servers = [OfficeServer() for _ in range(self.size)]
+        for server in self._servers:
+            self._idle.put(server)
+
+    def warm(self):
+        """
+        Starts every server up front so the first conversion doesn't pay for the LibreOffice cold start.
+        Each server is checked out while it starts, so a conversion that comes in meanwhile waits for it
+        instead of starting it a second time.
+        """
+        for _ in range(self.size):
+            with self.checkout():
+                pass
+
+    @contextmanager
+    def checkout(self):
+        try:
+            server = self._idle.get(timeout=OFFICE_CHECKOUT_TIMEOUT_SECONDS)
+        except queue.Empty:
+            raise RuntimeError("No LibreOffice converter became available in time")
+
+        try:
+            if server.jobs >= self.max_jobs:
+                print(f'Recycling unoserver on port {server.port} after {server.jobs} jobs')
+                server.restart()
+            elif not server.is_healthy():
+                server.restart()
+            yield server
+        finally:
+            self._idle.put(server)
+
+    def convert(self, source_path, pdf_path):
+        with self.checkout() as server:
+            try:
+                server.convert(source_path, pdf_path, self.timeout)
+            except subprocess.TimeoutExpired:
+                # A hung LibreOffice would fail every later job as well
+                print(f'Conversion of {source_path} timed out, killing unoserver on port {server.port}')
+                server.stop()
+                raise RuntimeError(f"DOCX to PDF conversion timed out after {self.timeout} seconds")
+            except subprocess.CalledProcessError as e:
+                raise RuntimeError(f"unoconvert failed: {e.stderr.decode(errors='replace').strip()}")
+
+    def shutdown(self):
+        for server in self._servers:
+            server.stop()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+    Returns the pool of the current process, creating it on first use. Forked workers must call this after the fork.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = OfficeConverterPool()
+        return _pool
+
+def warm_in_background():
+    """
+    Warms the pool of this process on a background thread. A prefork child that doesn't report ready within
+    worker_proc_alive_timeout (a few seconds) is killed by Celery, and LibreOffice takes longer than that to start.
+    """
+    def warm():
+        try:
+            get_pool().warm()
+        except Exception as e:
+            # The pool retries on checkout, don't take the worker down with it
+            print(f"Could not warm the LibreOffice converters: {e}")
+
+    thread = threading.Thread(target=warm, name='office-warmup', daemon=True)
+    thread.start()
+    return thread
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+def convert_with_soffice(source_path, pdf_path, timeout = None):
+    """
+    Cold-starts a headless LibreOffice for a single conversion. Slower than the pool, but needs no unoserver.
+    """
+    timeout = timeout or OFFICE_CONVERT_TIMEOUT_SECONDS
+    with tempfile.TemporaryDirectory(prefix='soffice-') as work_dir:
+        process = subprocess.Popen(
+            [
+                SOFFICE_BIN,
+                f'-env:UserInstallation=file://{os.path.join(work_dir, "profile")}',
+                '--headless', '--convert-to', 'pdf', '--outdir', work_dir, source_path
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            start_new_session=True
+        )
+        try:
+            _, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            _kill_process_group(process)
+            raise RuntimeError(f"DOCX to PDF conversion timed out after {timeout} seconds")
+
+        converted_path = os.path.join(work_dir, os.path.splitext(os.path.basename(source_path))[0] + '.pdf')
+        if process.returncode != 0 or not os.path.exists(converted_path):
+            raise RuntimeError(f"soffice failed: {stderr.decode(errors='replace').strip()}")
+        shutil.move(converted_path, pdf_path)
+
+def convert_docx(source_path, pdf_path):
+    if DOCX_CONVERTER_BACKEND == 'unoserver':
+        get_pool().convert(source_path, pdf_path)
+    elif DOCX_CONVERTER_BACKEND == 'soffice':
+        convert_with_soffice(source_path, pdf_path)
+    else:
+        from docx2pdf import convert
+        convert(source_path, pdf_path)
@@ -0,0 +1,75 @@
+import os
+import uuid
+import shutil
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PAGE_CACHE_DIR = os.getenv("PAGE_CACHE_DIR", os.path.join("cache", "pages"))
+PAGE_CACHE_MAX_BYTES = int(os.getenv("PAGE_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024))  # 2 GB
+
+class DiskLRUCache:
+    """
+    Files kept on local disk and evicted least recently used first once they take more than max_bytes.
+    Recency is the mtime of each file, refreshed on every hit, so the gunicorn workers of one host share the cache.
+    """
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        # Keys are built by the callers from secure filenames, never from raw user input
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, source_path, keep = ()):
+        """
+        Copies source_path into the cache and returns the path of the cached copy.
+        Neither the copy nor the paths in keep (e.g. files written together with it) are evicted to make room.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        path = self._path(key)
+
+        # Copy next to the final path first, so a reader never sees a partially written file
+        temp_path = f"{path}.{uuid.uuid4().hex}.part"
+        shutil.copyfile(source_path, temp_path)
+        os.replace(temp_path, path)
+
+        self.evict(keep={path, *keep})
+        return path
+
+    def evict(self, keep = ()):
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.root):
+                if not entry.is_file() or entry.name.endswith('.part'):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+            if total <= self.max_bytes:
+                return
+
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path in keep:
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                except FileNotFoundError:
+                    pass
+
+cache = DiskLRUCache(PAGE_CACHE_DIR, PAGE_CACHE_MAX_BYTES)
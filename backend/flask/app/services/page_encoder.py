@@ -0,0 +1,151 @@
+import io
+import os
+from PIL import Image
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Renditions written for every page. "reader" is always produced, it is the one shown in MaterialPage.url.
+PAGE_RENDITIONS = [name.strip() for name in os.getenv("PAGE_RENDITIONS", "thumbnail,reader,zoom").split(",") if name.strip()]
+if 'reader' not in PAGE_RENDITIONS:
+    PAGE_RENDITIONS.append('reader')
+
+PDF_ZOOM_DPI = int(os.getenv("PDF_ZOOM_DPI", 220))
+THUMBNAIL_WIDTH = int(os.getenv("THUMBNAIL_WIDTH", 240))
+WEBP_METHOD = int(os.getenv("WEBP_METHOD", 4))  # 0 (fast) - 6 (smallest output)
+WEBP_TEXT_MIN_QUALITY = int(os.getenv("WEBP_TEXT_MIN_QUALITY", 50))
+WEBP_TEXT_LOSSLESS = os.getenv("WEBP_TEXT_LOSSLESS", "false").lower() == "true"
+WEBP_THUMBNAIL_QUALITY = int(os.getenv("WEBP_THUMBNAIL_QUALITY", 40))
+
+TEXT = 'text'
+IMAGE = 'image'
+
+# Pages are stored under this folder of the bucket, wherever they were rendered locally
+STORAGE_FOLDER = 'output_webp'
+# Fields of a rendition that only make sense on the worker that rendered it
+LOCAL_FIELDS = ('file', 'data')
+
+def settings_fingerprint():
+    """
+    Every setting that changes the encoded output, used to key cached conversions.
+    """
+    return {
+        'renditions': sorted(PAGE_RENDITIONS),
+        'zoom_dpi': PDF_ZOOM_DPI,
+        'thumbnail_width': THUMBNAIL_WIDTH,
+        'method': WEBP_METHOD,
+        'text_min_quality': WEBP_TEXT_MIN_QUALITY,
+        'text_lossless': WEBP_TEXT_LOSSLESS,
+        'thumbnail_quality': WEBP_THUMBNAIL_QUALITY
+    }
+
+def render_dpi(reader_dpi):
+    # Render once at the largest resolution, the smaller renditions are downsampled from it
+    if 'zoom' in PAGE_RENDITIONS:
+        return max(reader_dpi, PDF_ZOOM_DPI)
+    return reader_dpi
+
+def rendition_path(output_dir, prefix, page, rendition):
+    if rendition == 'reader':
+        return os.path.join(output_dir, f"{prefix}_page_{page}.webp")
+    return os.path.join(output_dir, f"{prefix}_page_{page}_{rendition}.webp")
+
+def storage_path(prefix, page, rendition):
+    return rendition_path(os.path.join(STORAGE_FOLDER, prefix), prefix, page, rendition).replace("\\", "/")
+
+def stored_rendition(rendition, **changes):
+    """
+    Returns a rendition without its local file or buffer, as it is kept in checkpoints, caches and links.
+    """
+    stored = {field: value for field, value in rendition.items() if field not in LOCAL_FIELDS}
+    stored.update(changes)
+    return stored
+
+def classify_page(image):
+    """
+    Tells text pages (mostly paper and ink) from image-heavy pages (photos, diagrams, coloured slides).
+    """
+    sample = image.convert('RGB')
+    sample.thumbnail((256, 256))
+
+    histogram = sample.convert('L').histogram()
+    total = sum(histogram)
+    light = sum(histogram[225:]) / total
+    dark = sum(histogram[:60]) / total
+    midtones = 1 - light - dark
+
+    saturation = sample.convert('HSV').getchannel('S').histogram()
+    colourful = sum(saturation[64:]) / total
+
+    if light > 0.5 and midtones < 0.2 and colourful < 0.1:
+        return TEXT
+    return IMAGE
+
+def encoder_settings(kind, quality, rendition):
+    """
+    Picks the WebP settings of a rendition. Text stays sharp at a higher quality (or lossless),
+    while image-heavy pages use the requested quality since their noise costs the most bytes.
+    """
+    if rendition == 'thumbnail':
+        return {'quality': WEBP_THUMBNAIL_QUALITY, 'method': WEBP_METHOD}
+    if kind == TEXT:
+        if WEBP_TEXT_LOSSLESS:
+            return {'lossless': True, 'quality': 100, 'method': WEBP_METHOD}
+        return {'quality': max(quality, WEBP_TEXT_MIN_QUALITY), 'method': WEBP_METHOD}
+    return {'quality': quality, 'method': WEBP_METHOD}
+
+def _resize_for(image, rendition, scale):
+    if rendition == 'thumbnail':
+        width = min(THUMBNAIL_WIDTH, image.width)
+    elif rendition == 'reader':
+        width = round(image.width * scale)
+    else:
+        return image
+
+    if width == image.width:
+        return image
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), Image.LANCZOS)
+
+def encode_renditions(image, output_dir, prefix, page, quality, reader_dpi, source_dpi):
+    """
+    Encodes every rendition of a rendered page.
+
+    Args:
+        image (PIL.Image): The page rendered at source_dpi.
+        output_dir (str): The directory to save the renditions, None to keep them in memory.
+        prefix (str): The filename prefix of the renditions.
+        page (int): The page number.
+        quality (int): The requested quality of the WebP images (0-100).
+        reader_dpi (int): The resolution of the reader rendition.
+        source_dpi (int): The resolution the page was rendered at.
+
+    Returns:
+        tuple: The page kind ("text" or "image") and a dict of rendition name -> path (in storage), width, height,
+        bytes, and either file (the local path) or data (the encoded image).
+    """
+    kind = classify_page(image)
+    renditions = {}
+
+    for rendition in PAGE_RENDITIONS:
+        resized = _resize_for(image, rendition, reader_dpi / source_dpi)
+        renditions[rendition] = {
+            'path': storage_path(prefix, page, rendition),
+            'width': resized.width,
+            'height': resized.height
+        }
+
+        if output_dir is None:
+            # Handed to the uploader as is, the page never touches the disk
+            buffer = io.BytesIO()
+            resized.save(buffer, 'WEBP', **encoder_settings(kind, quality, rendition))
+            renditions[rendition].update({'data': buffer.getvalue(), 'bytes': buffer.tell()})
+        else:
+            path = rendition_path(output_dir, prefix, page, rendition)
+            resized.save(path, 'WEBP', **encoder_settings(kind, quality, rendition))
+            renditions[rendition].update({'file': path, 'bytes': os.path.getsize(path)})
+
+        if resized is not image:
+            resized.close()
+
+    return kind, renditions
@@ -0,0 +1,99 @@
+import os
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from ..models.material import Material
+from . import page_encoder
+from . import worker_metrics
+
+load_dotenv()
+
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", 8))
+UPLOAD_MAX_RETRIES = int(os.getenv("UPLOAD_MAX_RETRIES", 3))
+UPLOAD_BACKOFF_SECONDS = float(os.getenv("UPLOAD_BACKOFF_SECONDS", 0.5))
+
+def upload_with_retry(file_path, max_retries = None, backoff_seconds = None, storage_path = None, data = None):
+    """
+    Uploads a file (or the in-memory data of one) to storage, retrying with exponential backoff and jitter on failure.
+    """
+    max_retries = UPLOAD_MAX_RETRIES if max_retries is None else max_retries
+    backoff_seconds = UPLOAD_BACKOFF_SECONDS if backoff_seconds is None else backoff_seconds
+
+    for attempt in range(max_retries + 1):
+        try:
+            return Material.upload_and_get_link(file_path, storage_path, data)
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            delay = backoff_seconds * (2 ** attempt) * (1 + random.random())
+            print(f'Upload of {file_path or storage_path} failed ({e}), retrying in {delay:.2f} seconds')
+            time.sleep(delay)
+
+def upload_page(page, rendered):
+    """
+    Uploads every rendition of a page, from its local file or straight from memory, and returns its public link info.
+    """
+    renditions = {}
+    for name, rendition in rendered['renditions'].items():
+        start = time.time()
+        url = upload_with_retry(rendition.get('file'), storage_path=rendition['path'], data=rendition.get('data'))
+        renditions[name] = page_encoder.stored_rendition(rendition, url=url)
+        worker_metrics.observe_upload(time.time() - start, rendition['bytes'])
+
+    return {
+        'page': page,
+        'url': renditions['reader']['url'],
+        'path': renditions['reader']['path'],
+        'kind': rendered['kind'],
+        'renditions': renditions
+    }
+
+class PageUploader:
+    """
+    Uploads rendered pages on a bounded thread pool while the renderer keeps producing them.
+    on_uploaded(page, link) is called from the upload threads as each page finishes.
+    submit() blocks once too many pages are queued, so a fast renderer cannot run ahead of storage unboundedly.
+
+    Usage:
+        with PageUploader() as uploader:
+            for page, rendered in pages:
+                uploader.submit(page, rendered)
+            public_links = uploader.results()
+    """
+    def __init__(self, concurrency = None, on_uploaded = None):
+        self.concurrency = concurrency or UPLOAD_CONCURRENCY
+        self.on_uploaded = on_uploaded
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='page-upload')
+        self.slots = threading.BoundedSemaphore(self.concurrency * 2)
+        self.futures = {}
+
+    def submit(self, page, rendered):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(upload_page, page, rendered)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        if self.on_uploaded is not None:
+            def notify(done_future):
+                if not done_future.cancelled() and done_future.exception() is None:
+                    self.on_uploaded(page, done_future.result())
+            future.add_done_callback(notify)
+        self.futures[page] = future
+
+    def results(self):
+        """
+        Waits for every upload and returns the public links of the pages ordered by page number.
+        """
+        return [self.futures[page].result() for page in sorted(self.futures)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Don't start queued uploads if the pipeline already failed
+        self.executor.shutdown(wait=True, cancel_futures=exc_type is not None)
+        return False
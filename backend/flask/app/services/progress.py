@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import threading
+from dotenv import load_dotenv
+from ..config.redis_client import redis_client
+from ..models.material import Material
+
+load_dotenv()
+
+# The Task row is rewritten at most once per interval, the live events go through Redis instead
+PROGRESS_DB_MIN_INTERVAL_SECONDS = float(os.getenv("PROGRESS_DB_MIN_INTERVAL_SECONDS", 5))
+# Page events are coalesced into at most one result backend update per interval
+PROGRESS_STATE_MIN_INTERVAL_SECONDS = float(os.getenv("PROGRESS_STATE_MIN_INTERVAL_SECONDS", 0.5))
+PROGRESS_CHANNEL_PREFIX = 'task-progress'
+FINAL_STAGES = ('done', 'failed')
+
+def progress_channel(celery_task_id):
+    return f"{PROGRESS_CHANNEL_PREFIX}:{celery_task_id}"
+
+class ProgressReporter:
+    """
+    Publishes structured progress events of a conversion task (stage, page i/N, elapsed time).
+
+    Every event goes to the Redis channel of the task, which the /task-events endpoint streams to clients.
+    Events are coalesced before they reach the Celery result backend (self.update_state) and the Task table,
+    so a 300-page document doesn't cause 300 writes of the step log.
+    """
+    def __init__(self, task, task_id, material_id, resumed = False):
+        # task.request is thread-local, so keep the id for events sent from the stage threads
+        self.task = task
+        self.celery_task_id = task.request.id
+        self.task_id = task_id
+        self.material_id = material_id
+        self.start_time = time.time()
+        self.log = "- [Step 1/5] Starting conversion task\n"
+        self.current = None
+
+        self._lock = threading.Lock()
+        self._last_state_write = 0
+        self._last_db_write = 0
+        self._db_dirty = False
+        self._db_timer = None
+
+        if resumed:
+            # The pending record was created by the first attempt of the task, the log of the earlier attempts is kept
+            previous_log = Material.get_pending_task_content(task_id)
+            if previous_log:
+                self.log = previous_log if previous_log.endswith("\n") else previous_log + "\n"
+            self.log += f"- Resuming after a failed attempt (retry {task.request.retries})\n"
+            Material.update_pending_task_record(task_id, material_id, self.log)
+        else:
+            Material.create_task_record(task_id, material_id, self.log, "pending")
+        self._last_db_write = time.time()
+
+    def _content(self):
+        # The step log followed by the latest page progress, if any
+        if self.current and self.current.get('page') is not None:
+            return self.log + f"- {self.current['stage'].capitalize()}: page {self.current['page']}/{self.current['total']}\n"
+        return self.log
+
+    def _make_event(self, stage, message, page, total, now):
+        return {
+            'task_id': self.task_id,
+            'material_id': self.material_id,
+            'stage': stage,
+            'message': message,
+            'page': page,
+            'total': total,
+            'elapsed': round(now - self.start_time, 2)
+        }
+
+    def _publish(self, event):
+        if redis_client is not None:
+            redis_client.publish(progress_channel(self.celery_task_id), json.dumps(event))
+
+    def event(self, stage, message = None, page = None, total = None, log_line = None):
+        """
+        Reports progress. Events with a log_line are step transitions and always reach the result backend,
+        page events are published to Redis but coalesced everywhere else.
+        """
+        now = time.time()
+        event = self._make_event(stage, message, page, total, now)
+
+        with self._lock:
+            self.current = event
+            if log_line is not None:
+                self.log += log_line + "\n"
+
+            self._publish(event)
+
+            if log_line is not None or now - self._last_state_write >= PROGRESS_STATE_MIN_INTERVAL_SECONDS:
+                self.task.update_state(task_id=self.celery_task_id, state='PROGRESS', meta=event)
+                self._last_state_write = now
+
+            self._db_dirty = True
+            self._schedule_db_write(now)
+
+    def _schedule_db_write(self, now):
+        # Must be called with the lock held
+        wait_seconds = self._last_db_write + PROGRESS_DB_MIN_INTERVAL_SECONDS - now
+        if wait_seconds <= 0:
+            self._write_db()
+        elif self._db_timer is None:
+            # Flush whatever is pending once the interval has passed
+            self._db_timer = threading.Timer(wait_seconds, self._flush_timer)
+            self._db_timer.daemon = True
+            self._db_timer.start()
+
+    def _flush_timer(self):
+        with self._lock:
+            self._db_timer = None
+            if self._db_dirty:
+                self._write_db()
+
+    def _write_db(self):
+        Material.update_pending_task_record(self.task_id, self.material_id, self._content())
+        self._last_db_write = time.time()
+        self._db_dirty = False
+
+    def stage_done(self, stage, result):
+        # Stages run concurrently, so the steps are logged in the order they finish
+        if stage == 'extract':
+            self.event(stage, 'Extracted content', log_line=f"- [Step 2/5] Extracted content from PDF: {result.text[:100]}...")  # Preview of the content
+        elif stage == 'render':
+            self.event(stage, 'Converted PDF to WebP', log_line=f"- [Step 3/5] Converted PDF to WebP: {result}")
+        elif stage == 'upload':
+            self.event(stage, 'Uploaded pages', log_line=f"- [Step 4/5] Uploaded {len(result)} WebP files to storage")
+
+    def page_done(self, stage, page, total):
+        self.event(stage, page=page, total=total)
+
+    def cache_hit(self, public_links):
+        self.event('cache', 'Reused an identical upload', log_line=f"- [Step 2-4/5] Reused the content and {len(public_links)} WebP files of an identical upload")
+
+    def close(self):
+        """
+        Stops the pending DB flush. The final log is written together with the material (see complete()).
+        """
+        with self._lock:
+            if self._db_timer is not None:
+                self._db_timer.cancel()
+                self._db_timer = None
+
+    def complete(self, bundle, timer):
+        # The final log line and the success record are committed together with the material
+        self.close()
+        elapsed = timer.elapsed()
+        self.log += f"- [Step 5/5] All steps completed successfully in {elapsed:.2f} seconds ({timer.summary()})\n"
+        self.current = None
+        bundle.update_pending_task(self.task_id, self.log)
+        bundle.add_task(self.task_id, f"Processed in {elapsed:.2f} seconds", "success")
+
+    def retrying(self, error):
+        """
+        Logs a failed attempt that Celery will retry. The pending record stays pending.
+        """
+        self.event('retry', 'Attempt failed, retrying', log_line=f"- Attempt {self.task.request.retries + 1} failed: {error}, retrying")
+        self.close()
+        with self._lock:
+            self._write_db()
+
+    def fail(self, message):
+        """
+        Records a task that failed for good, so no pending record is left behind.
+        """
+        self.close()
+        self.log += f"- {message}\n"
+        self.current = None
+        Material.update_pending_task_record(self.task_id, self.material_id, self.log)
+        Material.create_task_record(self.task_id, self.material_id, message, "failed")
+        self.finish('failed', message)
+
+    def finish(self, stage, message):
+        """
+        Publishes the final event so that clients streaming the progress can stop. Nothing is written to the DB.
+        """
+        self.close()
+        self._publish(self._make_event(stage, message, None, None, time.time()))
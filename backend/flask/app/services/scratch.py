@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import shutil
+import socket
+import tempfile
+from dotenv import load_dotenv
+from werkzeug.utils import secure_filename
+from celery.signals import worker_init, worker_process_init
+
+load_dotenv()
+
+# Every task works in a directory of its own under one of these roots, never in the current directory.
+# SCRATCH_TMPFS_DIR should be on a RAM-backed filesystem (e.g. /dev/shm or an emptyDir with medium: Memory).
+SCRATCH_DIR = os.getenv("SCRATCH_DIR", os.path.join(tempfile.gettempdir(), 'studyshare-scratch'))
+SCRATCH_TMPFS_DIR = os.getenv("SCRATCH_TMPFS_DIR", "/dev/shm/studyshare-scratch")
+# "disk", "tmpfs", "memory" (rendered pages stay in memory) or "auto" (memory for uploads up to SCRATCH_MEMORY_MAX_BYTES)
+SCRATCH_MODE = os.getenv("SCRATCH_MODE", "auto")
+SCRATCH_MEMORY_MAX_BYTES = int(os.getenv("SCRATCH_MEMORY_MAX_BYTES", 20 * 1024 * 1024))
+# Directories of a live process are only swept after this long, e.g. a task retried on another host
+SCRATCH_STALE_SECONDS = int(os.getenv("SCRATCH_STALE_SECONDS", 6 * 60 * 60))
+
+DISK = 'disk'
+TMPFS = 'tmpfs'
+MEMORY = 'memory'
+OWNER_FILE = '.owner'
+PAGES_FOLDER = 'pages'
+
+def scratch_mode_for(size):
+    """
+    Picks the scratch mode of an upload of size bytes.
+    Pages kept in memory go straight to the uploader, but a retried task has to render them again.
+    """
+    if SCRATCH_MODE != 'auto':
+        return SCRATCH_MODE
+    return MEMORY if size <= SCRATCH_MEMORY_MAX_BYTES else DISK
+
+def _tmpfs_available():
+    return os.path.isdir(os.path.dirname(SCRATCH_TMPFS_DIR.rstrip(os.sep)))
+
+class ScratchSpace:
+    """
+    The private working directory of a task. Concurrent tasks never share a path, and the directory
+    records its owner (host and pid) so sweep_stale can remove what a crashed process left behind.
+
+    The name should be stable across retries (the Celery task id), so a retry on the same worker
+    finds the files of the previous attempt. In memory mode, pages_dir is None and the renderer
+    keeps the encoded pages in memory (see page_encoder.encode_renditions).
+
+    Usage:
+        scratch = ScratchSpace(task_id, scratch_mode_for(size)).open()
+        try:
+            pdf_path = scratch.path('source.pdf')
+        finally:
+            scratch.cleanup()
+    """
+    def __init__(self, name, mode = DISK):
+        if mode == TMPFS and not _tmpfs_available():
+            print(f"{SCRATCH_TMPFS_DIR} is not available, using {SCRATCH_DIR} for scratch space")
+            mode = DISK
+        self.mode = mode
+        self.in_memory = mode == MEMORY
+        base = SCRATCH_TMPFS_DIR if mode == TMPFS else SCRATCH_DIR
+        self.root = os.path.join(base, secure_filename(name))
+        self.pages_dir = None if self.in_memory else os.path.join(self.root, PAGES_FOLDER)
+
+    def open(self):
+        os.makedirs(self.root, exist_ok=True)
+        if self.pages_dir is not None:
+            os.makedirs(self.pages_dir, exist_ok=True)
+        # Rewritten by every attempt, the process running the task owns the directory
+        with open(os.path.join(self.root, OWNER_FILE), 'w') as f:
+            json.dump({'host': socket.gethostname(), 'pid': os.getpid()}, f)
+        return self
+
+    def path(self, filename):
+        return os.path.join(self.root, secure_filename(filename))
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+        return False
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _is_stale(path, now):
+    owner_path = os.path.join(path, OWNER_FILE)
+    try:
+        with open(owner_path) as f:
+            owner = json.load(f)
+        age = now - os.path.getmtime(owner_path)
+    except (OSError, ValueError):
+        # Not opened yet or half written, only its age tells
+        return now - os.path.getmtime(path) > SCRATCH_STALE_SECONDS
+
+    if owner.get('host') == socket.gethostname() and not _process_alive(owner.get('pid', 0)):
+        return True
+    return age > SCRATCH_STALE_SECONDS
+
+def sweep_stale():
+    """
+    Removes the scratch directories of processes that died without cleaning up (OOM kills, crashed workers),
+    and of any process after SCRATCH_STALE_SECONDS. Returns the number of directories removed.
+    """
+    now = time.time()
+    removed = 0
+    for base in {SCRATCH_DIR, SCRATCH_TMPFS_DIR}:
+        if not os.path.isdir(base):
+            continue
+        for name in os.listdir(base):
+            path = os.path.join(base, name)
+            try:
+                if os.path.isdir(path) and _is_stale(path, now):
+                    shutil.rmtree(path, ignore_errors=True)
+                    removed += 1
+            except FileNotFoundError:
+                # Another process removed it first
+                continue
+
+    if removed:
+        print(f'Removed {removed} leftover scratch directories')
+    return removed
+
+@worker_init.connect
+@worker_process_init.connect
+def sweep_on_start(**kwargs):
+    # The main worker sweeps before forking, and every replaced child sweeps what the one before it left
+    try:
+        sweep_stale()
+    except Exception as e:
+        print(f"Could not sweep the scratch space: {e}")
@@ -0,0 +1,43 @@
+from celery.signals import before_task_publish
+from ..config.celery import celery
+
+# The web tier queues conversions by task name, without importing celery_tasks and everything the workers
+# need to run them (pdf2image, the office converters, the Gemini client). The workers load the tasks
+# through the include of the Celery app, under these names.
+CONVERT_PDF_TASK = 'app.services.celery_tasks.convert_pdf_to_webp'
+CONVERT_DOCX_TASK = 'app.services.celery_tasks.convert_docx_to_webp'
+CONVERSION_TASKS = {'pdf': CONVERT_PDF_TASK, 'docx': CONVERT_DOCX_TASK}
+
+# The state of a conversion that is queued but not started. Celery reports PENDING for both queued and
+# unknown task ids, this state is what tells them apart (e.g. /task-events answers 404 for unknown ids).
+QUEUED_STATE = 'SENT'
+
+ALLOWED_EXTENSIONS = {'pdf', 'docx'}
+
+def allowed_file(filename, extensions = ALLOWED_EXTENSIONS):
+    return '.' in filename and \
+           filename.rsplit('.', 1)[1].lower() in extensions
+
+def conversion_signature(kind, file_info, form, **options):
+    """
+    Returns the signature of the conversion task of a file.
+
+    Args:
+        kind (str): "pdf" or "docx".
+        file_info (dict): The spooled upload, see blob_spool.spool_upload.
+        form (dict): The form fields of the upload.
+        **options: Options for apply_async, e.g. the queue and priority of job_routing.route_job.
+    """
+    # When the tasks are registered in this process (eager benchmarks), they run through the task itself,
+    # otherwise the signature is sent by name.
+    return celery.signature(CONVERSION_TASKS[kind], args=(file_info, form), options=options)
+
+@before_task_publish.connect
+def mark_queued(sender = None, headers = None, **kwargs):
+    # Stored before the message is sent, so it can't overwrite the first progress of a fast worker
+    if sender not in CONVERSION_TASKS.values() or not headers:
+        return
+    try:
+        celery.backend.store_result(headers['id'], None, QUEUED_STATE)
+    except Exception as e:
+        print(f"Could not mark task {headers.get('id')} as queued: {e}")
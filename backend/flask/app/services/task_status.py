@@ -0,0 +1,114 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from ..config.celery import celery
+from .task_signatures import QUEUED_STATE
+
+load_dotenv()
+
+# Pollers of the same task within this interval share one read of the result backend
+TASK_STATUS_CACHE_SECONDS = float(os.getenv("TASK_STATUS_CACHE_SECONDS", 1))
+# Finished tasks don't change anymore, so they are kept for longer
+TASK_STATUS_FINAL_CACHE_SECONDS = float(os.getenv("TASK_STATUS_FINAL_CACHE_SECONDS", 60))
+TASK_STATUS_CACHE_SIZE = int(os.getenv("TASK_STATUS_CACHE_SIZE", 10000))
+TASK_STATUS_MAX_IDS = int(os.getenv("TASK_STATUS_MAX_IDS", 200))
+
+FINAL_STATES = ('SUCCESS', 'FAILURE', 'REVOKED')
+# What pollers need from a progress event and from a result, the rest comes with details=True
+COMPACT_PROGRESS_FIELDS = ('stage', 'page', 'total')
+COMPACT_RESULT_FIELDS = ('message', 'material_id', 'error')
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def _fetch_metas(task_ids):
+    """
+    Reads the state and result of every task from the result backend, in a single MGET when the backend is a
+    key-value store (Redis, or the cache backend of the benchmarks). Other backends are read one task at a time.
+    """
+    backend = celery.backend
+    if not (hasattr(backend, 'mget') and hasattr(backend, 'get_key_for_task')):
+        metas = {}
+        for task_id in task_ids:
+            task = celery.AsyncResult(task_id)
+            metas[task_id] = {'status': task.state, 'result': task.info}
+        return metas
+
+    keys = [backend.get_key_for_task(task_id) for task_id in task_ids]
+    values = backend.mget(keys)
+    if isinstance(values, dict):
+        # The cache backend answers with a mapping of the keys it found, Redis with a list in the order of the keys
+        values = [values.get(key) for key in keys]
+    metas = {}
+    for task_id, value in zip(task_ids, values):
+        if value is None:
+            # Unknown, still queued or expired, Celery doesn't tell them apart either
+            metas[task_id] = {'status': 'PENDING', 'result': None}
+            continue
+        meta = backend.decode_result(value)
+        result = meta.get('result')
+        if meta['status'] in ('FAILURE', 'REVOKED'):
+            result = backend.exception_to_python(result)
+        metas[task_id] = {'status': meta['status'], 'result': result}
+    return metas
+
+def read_metas(task_ids):
+    """
+    Returns task id -> {status, result} for every task, from the in-process cache when it is fresh enough.
+    """
+    now = time.time()
+    metas = {}
+    with _cache_lock:
+        for task_id in task_ids:
+            cached = _cache.get(task_id)
+            if cached is not None and cached[0] > now:
+                metas[task_id] = cached[1]
+                _cache.move_to_end(task_id)
+
+    missing = [task_id for task_id in dict.fromkeys(task_ids) if task_id not in metas]
+    if missing:
+        fetched = _fetch_metas(missing)
+        with _cache_lock:
+            for task_id, meta in fetched.items():
+                ttl = TASK_STATUS_FINAL_CACHE_SECONDS if meta['status'] in FINAL_STATES else TASK_STATUS_CACHE_SECONDS
+                _cache[task_id] = (now + ttl, meta)
+                _cache.move_to_end(task_id)
+            while len(_cache) > TASK_STATUS_CACHE_SIZE:
+                _cache.popitem(last=False)
+        metas.update(fetched)
+    return metas
+
+def task_result(meta):
+    # DOCX tasks return an (result, http status) pair, which the backend stores as a list
+    result = meta['result']
+    return result[0] if isinstance(result, (list, tuple)) and result else result
+
+def format_status(meta, details = False):
+    """
+    Formats the status of a task like /task-status always did: the state and either a status message or the result.
+    Unless details is set, the progress event and the result are cut down to the fields pollers use.
+    """
+    state = meta['status']
+    # Queued tasks are reported as they always were
+    if state in ('PENDING', QUEUED_STATE):
+        return {'state': 'PENDING', 'status': 'Pending...'}
+    if state in ('FAILURE', 'REVOKED'):
+        return {'state': state, 'status': str(meta['result'])}
+
+    if details:
+        return {'state': state, 'result': meta['result']}
+
+    result = meta['result'] if state == 'PROGRESS' else task_result(meta)
+    fields = COMPACT_PROGRESS_FIELDS if state == 'PROGRESS' else COMPACT_RESULT_FIELDS
+    if isinstance(result, dict):
+        result = {field: result[field] for field in fields if field in result}
+    return {'state': state, 'result': result}
+
+def get_statuses(task_ids, details = False):
+    """
+    Returns task id -> status (see format_status) of every task.
+    """
+    metas = read_metas(task_ids)
+    return {task_id: format_status(metas[task_id], details) for task_id in task_ids}
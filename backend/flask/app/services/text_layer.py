@@ -0,0 +1,82 @@
+import os
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PDFTOTEXT_BIN = os.getenv("PDFTOTEXT_BIN", "pdftotext")
+TEXT_LAYER_WORKERS = int(os.getenv("TEXT_LAYER_WORKERS", os.cpu_count() or 2))
+TEXT_LAYER_BATCH_PAGES = int(os.getenv("TEXT_LAYER_BATCH_PAGES", 16))
+TEXT_LAYER_TIMEOUT_SECONDS = int(os.getenv("TEXT_LAYER_TIMEOUT_SECONDS", 60))
+# A page needs this many letters or digits to count as having a text layer, below it is treated as scanned
+TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", 80))
+# Pages where more than this share of the characters are unmapped glyphs have a broken font encoding
+TEXT_LAYER_MAX_GARBAGE_RATIO = float(os.getenv("TEXT_LAYER_MAX_GARBAGE_RATIO", 0.1))
+
+WHITESPACE_PATTERN = re.compile(r'[ \t]+')
+BLANK_LINES_PATTERN = re.compile(r'\n\s*\n+')
+
+def _run_pdftotext(pdf_path, first_page, last_page):
+    result = subprocess.run(
+        [PDFTOTEXT_BIN, '-f', str(first_page), '-l', str(last_page), '-enc', 'UTF-8', '-layout', pdf_path, '-'],
+        check=True,
+        timeout=TEXT_LAYER_TIMEOUT_SECONDS,
+        capture_output=True
+    )
+    # pdftotext ends every page with a form feed
+    texts = result.stdout.decode('utf-8', errors='replace').split('\f')
+    return {first_page + index: texts[index] if index < len(texts) else '' for index in range(last_page - first_page + 1)}
+
+def extract_page_texts(pdf_path, page_count, workers = None, batch_pages = None):
+    """
+    Reads the text layer of every page with poppler's pdftotext, running page ranges in parallel.
+
+    Args:
+        pdf_path (str): The path to the input PDF file.
+        page_count (int): The number of pages of the PDF.
+        workers (int): The maximum number of concurrent pdftotext processes, defaults to TEXT_LAYER_WORKERS.
+        batch_pages (int): The number of pages per pdftotext process, defaults to TEXT_LAYER_BATCH_PAGES.
+
+    Returns:
+        dict: page number -> raw text, empty when pdftotext isn't installed or fails.
+    """
+    workers = workers or TEXT_LAYER_WORKERS
+    batch_pages = batch_pages or TEXT_LAYER_BATCH_PAGES
+    batches = [
+        (first_page, min(first_page + batch_pages - 1, page_count))
+        for first_page in range(1, page_count + 1, batch_pages)
+    ]
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(batches)))) as executor:
+            results = list(executor.map(lambda batch: _run_pdftotext(pdf_path, *batch), batches))
+    except (OSError, subprocess.SubprocessError) as e:
+        # Every page then goes to the model, as before the local stage existed
+        print(f"Could not read the text layer of {pdf_path}: {e}")
+        return {}
+
+    page_texts = {}
+    for result in results:
+        page_texts.update(result)
+    return page_texts
+
+def compact_text(text):
+    """
+    Collapses the layout whitespace of pdftotext output, which costs tokens without carrying content.
+    """
+    lines = [WHITESPACE_PATTERN.sub(' ', line).strip() for line in text.splitlines()]
+    return BLANK_LINES_PATTERN.sub('\n\n', '\n'.join(lines)).strip()
+
+def has_text_layer(text):
+    """
+    Tells pages with a usable text layer from scanned pages, which have no text or only OCR-less garbage.
+    """
+    if not text:
+        return False
+    visible = [char for char in text if not char.isspace()]
+    if sum(char.isalnum() for char in visible) < TEXT_LAYER_MIN_CHARS:
+        return False
+    garbage = sum(char == '�' or (not char.isprintable()) for char in visible)
+    return garbage / len(visible) <= TEXT_LAYER_MAX_GARBAGE_RATIO
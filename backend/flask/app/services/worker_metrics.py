@@ -0,0 +1,152 @@
+import os
+import time
+import resource
+import threading
+from dotenv import load_dotenv
+from prometheus_client import Counter, Histogram, CollectorRegistry, start_http_server, multiprocess
+from celery.signals import worker_init, worker_process_shutdown, task_prerun, task_postrun
+
+load_dotenv()
+
+# The worker serves /metrics on this port. With the prefork pool, PROMETHEUS_MULTIPROC_DIR must be set,
+# so the metrics of every child process are collected through the shared directory. It must exist before
+# this module is imported.
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 9808))
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+RSS_SAMPLE_INTERVAL_SECONDS = float(os.getenv("RSS_SAMPLE_INTERVAL_SECONDS", 0.5))
+
+STAGE_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1200)
+PAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MEMORY_BUCKETS = tuple(mb * 1024 * 1024 for mb in (128, 256, 512, 768, 1024, 1536, 2048, 3072, 4096, 6144, 8192))
+
+STAGE_DURATION = Histogram(
+    'studyshare_worker_stage_duration_seconds', 'Wall-clock duration of each stage of a conversion task',
+    ['stage'], buckets=STAGE_BUCKETS
+)
+PAGE_STAGE_DURATION = Histogram(
+    'studyshare_worker_page_stage_duration_seconds', 'Duration of the per-page stages (rasterize, encode, upload)',
+    ['stage'], buckets=PAGE_BUCKETS
+)
+PAGES = Counter('studyshare_worker_pages_total', 'Pages rendered by the worker')
+BYTES = Counter('studyshare_worker_bytes_total', 'Bytes read from uploads (in) and written to storage (out)', ['direction'])
+GEMINI_TOKENS = Counter('studyshare_worker_gemini_tokens_total', 'Tokens used by summarization requests', ['kind'])
+GEMINI_DURATION = Histogram(
+    'studyshare_worker_gemini_request_duration_seconds', 'Latency of summarization requests, retries included',
+    ['outcome'], buckets=STAGE_BUCKETS
+)
+QUEUE_WAIT = Histogram(
+    'studyshare_worker_queue_wait_seconds', 'Time between the upload and the start of its conversion task',
+    ['task'], buckets=STAGE_BUCKETS
+)
+TASK_DURATION = Histogram('studyshare_worker_task_duration_seconds', 'Duration of one task attempt', ['task'], buckets=STAGE_BUCKETS)
+TASKS = Counter('studyshare_worker_tasks_total', 'Finished task attempts by outcome', ['task', 'outcome'])
+TASK_PEAK_RSS = Histogram(
+    'studyshare_worker_task_peak_rss_bytes', 'Peak resident memory of the worker process during a task',
+    ['task'], buckets=MEMORY_BUCKETS
+)
+
+def observe_stage(stage, seconds):
+    STAGE_DURATION.labels(stage).observe(seconds)
+
+def observe_page(rendered):
+    # rendered['timings'] is filled in by the render pool, see file_converter._render_batch
+    PAGES.inc()
+    for stage, seconds in rendered.get('timings', {}).items():
+        PAGE_STAGE_DURATION.labels(stage).observe(seconds)
+
+def observe_upload(seconds, size):
+    PAGE_STAGE_DURATION.labels('upload').observe(seconds)
+    BYTES.labels('out').inc(size)
+
+def observe_gemini(seconds, outcome, usage = None):
+    GEMINI_DURATION.labels(outcome).observe(seconds)
+    if usage is not None:
+        GEMINI_TOKENS.labels('prompt').inc(usage.prompt_token_count)
+        GEMINI_TOKENS.labels('thoughts').inc(usage.thoughts_token_count)
+        GEMINI_TOKENS.labels('total').inc(usage.total_token_count)
+
+def _current_rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # ru_maxrss is the peak of the whole process lifetime, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class PeakRSSSampler:
+    """
+    Samples the resident memory of the current process on a background thread and keeps the peak.
+    """
+    def __init__(self, interval = None):
+        self.interval = interval or RSS_SAMPLE_INTERVAL_SECONDS
+        self.peak = _current_rss()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.peak = max(self.peak, _current_rss())
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.peak = max(self.peak, _current_rss())
+        return self.peak
+
+# Per-attempt state between task_prerun and task_postrun, keyed by the Celery task id
+_running = {}
+
+@task_prerun.connect
+def start_task_metrics(task_id = None, task = None, args = None, **kwargs):
+    file_info = args[0] if args and isinstance(args[0], dict) else {}
+    blob = file_info.get('blob') or {}
+    if task.request.retries == 0 and blob:
+        # The spool reference is created when the upload is received, right before the task is queued
+        QUEUE_WAIT.labels(task.name).observe(max(0, time.time() - blob['created_at']))
+        BYTES.labels('in').inc(blob.get('size', 0))
+
+    _running[task_id] = (time.time(), PeakRSSSampler().start())
+
+@task_postrun.connect
+def finish_task_metrics(task_id = None, task = None, retval = None, state = None, **kwargs):
+    started = _running.pop(task_id, None)
+    if started is None:
+        return
+    start_time, sampler = started
+
+    # Conversion tasks report failures as an error dict (or an (error, status) tuple) instead of raising
+    result = retval[0] if isinstance(retval, tuple) and retval else retval
+    if state == 'RETRY':
+        outcome = 'retry'
+    elif state != 'SUCCESS' or (isinstance(result, dict) and 'error' in result):
+        outcome = 'failure'
+    else:
+        outcome = 'success'
+
+    TASKS.labels(task.name, outcome).inc()
+    TASK_DURATION.labels(task.name).observe(time.time() - start_time)
+    TASK_PEAK_RSS.labels(task.name).observe(sampler.stop())
+
+@worker_init.connect
+def start_metrics_server(**kwargs):
+    """
+    Serves /metrics from the main worker process, before the pool is forked.
+    """
+    if PROMETHEUS_MULTIPROC_DIR:
+        # The directory is created and emptied before Celery starts (see docker-entrypoint.sh),
+        # the metrics of this process are already written to it by then
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        start_http_server(WORKER_METRICS_PORT, registry=registry)
+    else:
+        start_http_server(WORKER_METRICS_PORT)
+    print(f'Serving worker metrics on port {WORKER_METRICS_PORT}')
+
+@worker_process_shutdown.connect
+def mark_process_dead(pid = None, **kwargs):
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid or os.getpid())
@@ -0,0 +1,116 @@
+import io
+import os
+import random
+from PIL import Image, ImageDraw
+
+# Letter-sized pages, in PDF points
+PAGE_WIDTH = 612
+PAGE_HEIGHT = 792
+
+WORDS = (
+    "lecture theorem proof matrix vector derivative integral function limit series network protocol "
+    "algorithm complexity graph tree sorting memory process thread kernel database index query "
+    "transaction schema entropy probability distribution variance regression gradient model training "
+    "energy force momentum reaction molecule cell protein history economy market policy analysis"
+).split()
+
+def _text_lines(rng, count):
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 12))).capitalize() for _ in range(count)]
+
+def _text_page(rng):
+    lines = _text_lines(rng, rng.randint(30, 45))
+    commands = ["BT", "/F1 11 Tf", "14 TL", f"56 {PAGE_HEIGHT - 64} Td", f"/F1 18 Tf ({lines[0]}) Tj", "/F1 11 Tf T* T*"]
+    commands += [f"({line}) Tj T*" for line in lines[1:]]
+    commands.append("ET")
+    return "\n".join(commands).encode('latin-1')
+
+def _image_jpeg(rng, width, height):
+    # Gradients and shapes, so the page is classified as an image page and doesn't compress to nothing
+    image = Image.new('RGB', (width, height))
+    draw = ImageDraw.Draw(image)
+    top, bottom = [tuple(rng.randint(0, 255) for _ in range(3)) for _ in range(2)]
+    for y in range(height):
+        mix = y / height
+        draw.line([(0, y), (width, y)], fill=tuple(int(a + (b - a) * mix) for a, b in zip(top, bottom)))
+    for _ in range(40):
+        x, y = rng.randint(0, width), rng.randint(0, height)
+        radius = rng.randint(10, width // 4)
+        draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill=tuple(rng.randint(0, 255) for _ in range(3)))
+
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=80)
+    return buffer.getvalue()
+
+def write_pdf(path, page_count, image_ratio = 0.3, seed = 0):
+    """
+    Writes a PDF of page_count pages. Text pages have a real text layer (Helvetica), image pages are a full-page
+    JPEG without text, like a scanned page. Output is deterministic for a given seed.
+
+    Args:
+        path (str): The path of the PDF to write.
+        page_count (int): The number of pages.
+        image_ratio (float): The share of image pages (0-1).
+        seed (int): The seed of the page contents.
+    """
+    rng = random.Random(f"{seed}-{page_count}-{image_ratio}")
+    objects = []
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    def stream(header, data):
+        return b"<< " + header + b" /Length " + str(len(data)).encode() + b" >>\nstream\n" + data + b"\nendstream"
+
+    catalog_id = add(None)
+    pages_id = add(None)
+    font_id = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    page_ids = []
+    for _ in range(page_count):
+        if rng.random() < image_ratio:
+            width, height = 850, 1100
+            image_id = add(stream(
+                f"/Type /XObject /Subtype /Image /Width {width} /Height {height} /ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode".encode(),
+                _image_jpeg(rng, width, height)
+            ))
+            content_id = add(stream(b"", f"q {PAGE_WIDTH} 0 0 {PAGE_HEIGHT} 0 0 cm /Im1 Do Q".encode()))
+            resources = f"<< /XObject << /Im1 {image_id} 0 R >> >>"
+        else:
+            content_id = add(stream(b"", _text_page(rng)))
+            resources = f"<< /Font << /F1 {font_id} 0 R >> >>"
+
+        page_ids.append(add(
+            f"<< /Type /Page /Parent {pages_id} 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+            f"/Resources {resources} /Contents {content_id} 0 R >>".encode()
+        ))
+
+    objects[catalog_id - 1] = f"<< /Type /Catalog /Pages {pages_id} 0 R >>".encode()
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    objects[pages_id - 1] = f"<< /Type /Pages /Kids [{kids}] /Count {page_count} >>".encode()
+
+    with open(path, 'wb') as f:
+        f.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(f"{number} 0 obj\n".encode() + body + b"\nendobj\n")
+
+        xref_offset = f.tell()
+        f.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+        for offset in offsets:
+            f.write(f"{offset:010d} 00000 n \n".encode())
+        f.write(f"trailer\n<< /Size {len(objects) + 1} /Root {catalog_id} 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode())
+
+def build_corpus(output_dir, page_counts, image_ratio = 0.3, seed = 0):
+    """
+    Writes one PDF per page count (reusing the files of a previous run) and returns their paths.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for page_count in page_counts:
+        path = os.path.join(output_dir, f"corpus_{page_count}p_{int(image_ratio * 100)}img_s{seed}.pdf")
+        if not os.path.exists(path):
+            write_pdf(path, page_count, image_ratio, seed)
+        paths.append(path)
+    return paths
@@ -0,0 +1,227 @@
+import re
+import time
+import random
+import threading
+from types import SimpleNamespace
+from datetime import datetime, timezone
+from pypdf import PdfReader
+
+# Gemini bills every PDF page as an image of about this many tokens
+TOKENS_PER_PDF_PAGE = 258
+PAGE_HEADER_PATTERN = re.compile(r'^##\s*Page\s+(\d+)', re.IGNORECASE | re.MULTILINE)
+
+class Latency:
+    """
+    A simulated network delay of base_ms plus per_kb_ms per kilobyte, with up to jitter (a fraction) on top.
+    """
+    def __init__(self, base_ms = 0, per_kb_ms = 0, jitter = 0.2, seed = 0):
+        self.base_ms = base_ms
+        self.per_kb_ms = per_kb_ms
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def wait(self, size = 0):
+        with self._lock:
+            factor = 1 + self.jitter * self._random.random()
+        delay_ms = (self.base_ms + self.per_kb_ms * size / 1024) * factor
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+
+class FakeStorageBucket:
+    """
+    Stands in for supabase.storage.from_(bucket). Objects are kept in memory.
+    """
+    def __init__(self, latency = None):
+        self.latency = latency or Latency()
+        self.objects = {}
+        self.bytes_uploaded = 0
+        self._lock = threading.Lock()
+
+    def upload(self, file, path, file_options = None):
+        # Like the real client, takes a file object or the bytes of one
+        data = file if isinstance(file, bytes) else file.read()
+        self.latency.wait(len(data))
+        with self._lock:
+            upsert = (file_options or {}).get("upsert") == "true"
+            if path in self.objects and not upsert:
+                raise Exception(f"The resource already exists: {path}")
+            self.objects[path] = data
+            self.bytes_uploaded += len(data)
+        return SimpleNamespace(path=path)
+
+    def get_public_url(self, path):
+        return f"https://storage.invalid/{path}"
+
+    def copy(self, source_path, dest_path):
+        self.latency.wait()
+        with self._lock:
+            if dest_path in self.objects:
+                raise Exception(f"The resource already exists: {dest_path}")
+            self.objects[dest_path] = self.objects[source_path]
+
+    def remove(self, paths):
+        self.latency.wait()
+        with self._lock:
+            for path in paths:
+                self.objects.pop(path, None)
+
+    def download(self, path):
+        self.latency.wait(len(self.objects.get(path, b"")))
+        return self.objects[path]
+
+class FakeQuery:
+    """
+    The subset of the PostgREST query builder used by the models: insert, update, select, eq, limit and execute.
+    """
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+        self.action = None
+        self.payload = None
+        self.filters = []
+        self.row_limit = None
+
+    def insert(self, data):
+        self.action, self.payload = 'insert', data
+        return self
+
+    def update(self, data):
+        self.action, self.payload = 'update', data
+        return self
+
+    def select(self, columns = "*"):
+        self.action = 'select'
+        return self
+
+    def eq(self, column, value):
+        self.filters.append((column, value))
+        return self
+
+    def limit(self, count):
+        self.row_limit = count
+        return self
+
+    def _matches(self, row):
+        return all(row.get(column) == value for column, value in self.filters)
+
+    def execute(self):
+        self.client.latency.wait()
+        with self.client.lock:
+            rows = self.client.tables.setdefault(self.table, [])
+            if self.action == 'insert':
+                new_rows = self.payload if isinstance(self.payload, list) else [self.payload]
+                rows.extend(dict(row) for row in new_rows)
+                return SimpleNamespace(data=new_rows)
+            if self.action == 'update':
+                updated = [row for row in rows if self._matches(row)]
+                for row in updated:
+                    row.update(self.payload)
+                return SimpleNamespace(data=updated)
+            selected = [dict(row) for row in rows if self._matches(row)]
+            return SimpleNamespace(data=selected[:self.row_limit] if self.row_limit is not None else selected)
+
+# Defaults of public.create_material_bundle for the columns of a new material
+MATERIAL_DEFAULTS = {
+    'upload_date': lambda: datetime.now(timezone.utc).replace(tzinfo=None).isoformat(),
+    'download_count': 0,
+    'view_count': 0,
+    'rating_count': 0,
+    'total_rating': 0,
+    'is_paid': False,
+    'price': 0,
+    'is_public': True
+}
+
+class FakeRpc:
+    def __init__(self, client, name, params):
+        self.client = client
+        self.name = name
+        self.params = params
+
+    def execute(self):
+        self.client.latency.wait()
+        if self.name != 'create_material_bundle':
+            return SimpleNamespace(data=[])
+
+        # Mirrors public.create_material_bundle in database/schema.sql
+        payload = self.params['payload']
+        with self.client.lock:
+            tables = self.client.tables
+            if any(row['material_id'] == payload['material']['material_id'] for row in tables.setdefault('Material', [])):
+                return SimpleNamespace(data=None)
+            material = dict(payload['material'])
+            # The columns the function fills in when the payload leaves them out or null
+            for column, default in MATERIAL_DEFAULTS.items():
+                if material.get(column) is None:
+                    material[column] = default() if callable(default) else default
+            tables['Material'].append(material)
+            tables.setdefault('MaterialPage', []).extend(payload['pages'])
+            if payload['summary']:
+                tables.setdefault('MaterialSummary', []).append(payload['summary'])
+            tables.setdefault('Rating', []).extend(payload['ratings'])
+            if payload['pending_task']:
+                for row in tables.setdefault('Task', []):
+                    if row['task_id'] == payload['pending_task']['task_id'] and row['status'] == 'pending':
+                        row['content'] = payload['pending_task']['content']
+            tables.setdefault('Task', []).extend(payload['tasks'])
+        return SimpleNamespace(data=None)
+
+class FakeSupabase:
+    """
+    Stands in for the Supabase client: storage, tables and the RPCs of database/schema.sql, all in memory.
+    """
+    def __init__(self, storage_latency = None, db_latency = None):
+        self.bucket = FakeStorageBucket(storage_latency)
+        self.latency = db_latency or Latency()
+        self.tables = {}
+        self.lock = threading.Lock()
+        self.storage = SimpleNamespace(from_=lambda name: self.bucket)
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def rpc(self, name, params):
+        return FakeRpc(self, name, params)
+
+class FakeGeminiBackend:
+    """
+    Answers summarization requests like GeminiBackend.generate, without network access.
+    Latency grows with the pages of a PDF or the size of a text digest, and so does the token usage.
+    """
+    def __init__(self, base_ms = 1500, per_page_ms = 150, per_kb_ms = 5, jitter = 0.2, seed = 0):
+        self.latency = Latency(base_ms, 0, jitter, seed)
+        self.per_page_ms = per_page_ms
+        self.per_kb_ms = per_kb_ms
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def generate(self, file_path, mime_type, system_instruction, user_prompt):
+        with self._lock:
+            self.requests += 1
+
+        if mime_type == 'text/plain':
+            with open(file_path, encoding='utf-8') as f:
+                text = f.read()
+            pages = [int(number) for number in PAGE_HEADER_PATTERN.findall(text)] or [1]
+            prompt_tokens = len(text) // 4
+            extra_ms = self.per_kb_ms * len(text.encode()) / 1024
+        else:
+            # Numbered from 1 like the model often does, the extractor maps them to the document pages
+            pages = list(range(1, len(PdfReader(file_path).pages) + 1))
+            prompt_tokens = TOKENS_PER_PDF_PAGE * len(pages)
+            extra_ms = self.per_page_ms * len(pages)
+
+        self.latency.wait()
+        time.sleep(extra_ms / 1000)
+
+        text = "\n\n".join(f"## Page {page}\nA summary of page {page} with its key points." for page in pages)
+        output_tokens = len(text) // 4
+        return SimpleNamespace(
+            text=text,
+            usage=SimpleNamespace(
+                prompt_token_count=prompt_tokens + len(user_prompt) // 4,
+                thoughts_token_count=0,
+                total_token_count=prompt_tokens + len(user_prompt) // 4 + output_tokens
+            )
+        )
@@ -0,0 +1,360 @@
+"""
+End-to-end benchmark of the conversion pipeline. Jobs go through the real Flask routes and Celery tasks,
+while Supabase and Gemini are replaced by in-process fakes with configurable latency (see fakes.py).
+Rendering, encoding and text extraction run for real, so poppler must be installed.
+
+Run from backend/flask:
+
+    python -m benchmarks.run --pages 1,10,50,200,500 --jobs 10 --concurrency 2
+    python -m benchmarks.run --mode redis --redis-url redis://localhost:6379/15 --workers 4
+    python -m benchmarks.run --save-baseline              # stores the report as the baseline
+    python -m benchmarks.run --fail-on-regression         # exits with 1 when slower than the baseline
+
+"eager" runs every task inside the request that submits it, "redis" queues the tasks on a local Redis
+and runs them on a Celery worker started inside this process.
+"""
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .corpus import build_corpus
+from .fakes import FakeSupabase, FakeGeminiBackend, Latency
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE_PATH = os.path.join(BENCHMARK_DIR, 'baseline.json')
+# A fake key in the format create_client expects, the fake client is installed before the real one is ever created
+FAKE_SUPABASE_KEY = "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.benchmark"
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description="Benchmark the conversion pipeline against local fakes.")
+    parser.add_argument('--mode', choices=['eager', 'redis'], default='eager')
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15')
+    parser.add_argument('--workers', type=int, default=2, help="Worker threads in redis mode")
+    parser.add_argument('--pages', default='1,10,50,200', help="Comma-separated page counts of the corpus")
+    parser.add_argument('--image-ratio', type=float, default=0.3, help="Share of image (scanned) pages")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--jobs', type=int, default=8, help="Number of conversions, cycling through the corpus")
+    parser.add_argument('--concurrency', type=int, default=1, help="Concurrent clients submitting jobs")
+    parser.add_argument('--quality', type=int, default=20)
+    parser.add_argument('--lazy-pages', type=int, default=0, help="LAZY_RENDER_PAGES of the run")
+    parser.add_argument('--cache', action='store_true', help="Keep the conversion cache enabled")
+    parser.add_argument('--scratch-mode', default='auto', choices=['auto', 'disk', 'tmpfs', 'memory'], help="SCRATCH_MODE of the run")
+    parser.add_argument('--storage-latency-ms', type=float, default=40)
+    parser.add_argument('--storage-per-kb-ms', type=float, default=0.05)
+    parser.add_argument('--db-latency-ms', type=float, default=20)
+    parser.add_argument('--gemini-latency-ms', type=float, default=1500)
+    parser.add_argument('--gemini-per-page-ms', type=float, default=150)
+    parser.add_argument('--timeout', type=float, default=1800, help="Seconds to wait for the jobs in redis mode")
+    parser.add_argument('--work-dir', help="Where the corpus and the task files go, defaults to a temporary directory")
+    parser.add_argument('--output', help="Also write the report as JSON to this path")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Allowed slowdown against the baseline (0.1 = 10%%)")
+    parser.add_argument('--fail-on-regression', action='store_true')
+    return parser.parse_args(argv)
+
+def configure_environment(args, work_dir):
+    """
+    Must run before the app is imported, every module reads its settings at import time.
+    """
+    os.environ.update({
+        'SUPABASE_URL': 'http://localhost:54321',
+        'SUPABASE_ANON_KEY': FAKE_SUPABASE_KEY,
+        'SUPABASE_BUCKET': 'benchmark',
+        'GEMINI_API_KEY': 'benchmark',
+        'BLOB_SPOOL_DIR': os.path.join(work_dir, 'spool'),
+        'PAGE_CACHE_DIR': os.path.join(work_dir, 'page-cache'),
+        'SCRATCH_DIR': os.path.join(work_dir, 'scratch'),
+        'SCRATCH_MODE': args.scratch_mode,
+        'CONVERSION_CACHE_BACKEND': 'memory' if args.cache else 'none',
+        'LAZY_RENDER_PAGES': str(args.lazy_pages),
+        # Any free port, several benchmark runs may share a host with a real worker
+        'WORKER_METRICS_PORT': '0'
+    })
+
+    if args.mode == 'redis':
+        for name in ('CELERY_BROKER_URL', 'CELERY_RESULT_BACKEND', 'REDIS_URL'):
+            os.environ[name] = args.redis_url
+    else:
+        # Empty values win over .flask.env, so nothing talks to Redis. The in-memory result backend keeps update_state working.
+        os.environ.update({'CELERY_BROKER_URL': '', 'REDIS_URL': '', 'CELERY_RESULT_BACKEND': 'cache+memory://'})
+
+def install_fakes(args):
+    from app.config import supabase_client
+    from app.services import file_content_extractor
+
+    fake_supabase = FakeSupabase(
+        storage_latency=Latency(args.storage_latency_ms, args.storage_per_kb_ms, seed=args.seed),
+        db_latency=Latency(args.db_latency_ms, seed=args.seed)
+    )
+    supabase_client.set_client(fake_supabase)
+
+    fake_gemini = FakeGeminiBackend(args.gemini_latency_ms, args.gemini_per_page_ms, seed=args.seed)
+    file_content_extractor.set_backend(fake_gemini)
+    return fake_supabase, fake_gemini
+
+def percentile(values, fraction):
+    # Nearest-rank percentile
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+def distribution(values):
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else None,
+        'p50': percentile(values, 0.50),
+        'p95': percentile(values, 0.95),
+        'p99': percentile(values, 0.99),
+        'max': max(values) if values else None
+    }
+
+class JobRecorder:
+    """
+    Records when each task attempt finished and what it returned, through Celery's task_postrun signal.
+    """
+    def __init__(self):
+        self.finished = {}
+        self.done = threading.Condition()
+
+    def on_postrun(self, task_id = None, retval = None, state = None, **kwargs):
+        if state == 'RETRY':
+            return
+        with self.done:
+            self.finished[task_id] = (time.time(), retval, state)
+            self.done.notify_all()
+
+    def wait_for(self, task_ids, timeout):
+        deadline = time.time() + timeout
+        with self.done:
+            while not all(task_id in self.finished for task_id in task_ids):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError(f"{len(task_ids) - len(self.finished)} jobs did not finish in {timeout} seconds")
+                self.done.wait(remaining)
+
+def submit_job(app, path, page_count, quality):
+    info = {
+        'material_id': f"bench-{uuid.uuid4()}",
+        'user_id': 'benchmark',
+        'name': os.path.basename(path),
+        'file_type': 'pdf'
+    }
+    with app.test_client() as client, open(path, 'rb') as file:
+        submitted_at = time.time()
+        response = client.post('/convert/pdf-to-webp', data={
+            'file': (file, os.path.basename(path)),
+            'info': json.dumps(info),
+            'quality': str(quality)
+        }, content_type='multipart/form-data')
+
+    if response.status_code != 202:
+        raise RuntimeError(f"Submitting {path} failed with {response.status_code}: {response.get_data(as_text=True)}")
+    return {'task_id': response.get_json()['task_id'], 'pages': page_count, 'submitted_at': submitted_at}
+
+def run(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='studyshare-benchmark-')
+    os.makedirs(work_dir, exist_ok=True)
+    configure_environment(args, work_dir)
+
+    page_counts = [int(count) for count in args.pages.split(',')]
+    corpus = list(zip(build_corpus(os.path.join(work_dir, 'corpus'), page_counts, args.image_ratio, args.seed), page_counts))
+
+    # Keeps anything written relative to the working directory inside the work directory
+    os.chdir(work_dir)
+    sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+    from celery.signals import task_postrun
+    from app import create_app
+    from app.config.celery import celery
+    from app.services.worker_metrics import PeakRSSSampler
+    # The routes send the tasks by name, they run in this process like in a worker
+    from app.services import celery_tasks  # noqa: F401
+
+    fake_supabase, fake_gemini = install_fakes(args)
+    recorder = JobRecorder()
+    task_postrun.connect(recorder.on_postrun, weak=False)
+
+    app = create_app({'TESTING': True})
+    worker = None
+    if args.mode == 'eager':
+        celery.conf.task_always_eager = True
+    else:
+        from celery.contrib.testing.worker import start_worker
+        worker = start_worker(celery, pool='threads', concurrency=args.workers, perform_ping_check=False)
+        worker.__enter__()
+
+    jobs_to_run = [corpus[index % len(corpus)] for index in range(args.jobs)]
+    sampler = PeakRSSSampler().start()
+    started_at = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            jobs = list(executor.map(lambda job: submit_job(app, job[0], job[1], args.quality), jobs_to_run))
+        recorder.wait_for([job['task_id'] for job in jobs], args.timeout)
+    finally:
+        wall_seconds = time.time() - started_at
+        peak_rss = sampler.stop()
+        if worker is not None:
+            worker.__exit__(None, None, None)
+
+    report = build_report(args, jobs, recorder, wall_seconds, peak_rss, fake_supabase, fake_gemini)
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+def build_report(args, jobs, recorder, wall_seconds, peak_rss, fake_supabase, fake_gemini):
+    latencies = []
+    stages = {}
+    failures = []
+    for job in jobs:
+        finished_at, retval, state = recorder.finished[job['task_id']]
+        result = retval[0] if isinstance(retval, tuple) else retval
+        if state != 'SUCCESS' or not isinstance(result, dict) or 'error' in result:
+            failures.append({'task_id': job['task_id'], 'pages': job['pages'], 'result': str(result)})
+            continue
+        latencies.append(finished_at - job['submitted_at'])
+        for stage, timing in result.get('timings', {}).items():
+            stages.setdefault(stage, []).append(timing['duration'])
+
+    succeeded_pages = sum(job['pages'] for job in jobs) - sum(failure['pages'] for failure in failures)
+    summaries = fake_supabase.tables.get('MaterialSummary', [])
+
+    return {
+        'scenario': {
+            'mode': args.mode,
+            'pages': args.pages,
+            'image_ratio': args.image_ratio,
+            'jobs': args.jobs,
+            'concurrency': args.concurrency,
+            'workers': args.workers if args.mode == 'redis' else None,
+            'quality': args.quality,
+            'lazy_pages': args.lazy_pages,
+            'cache': args.cache,
+            'scratch_mode': args.scratch_mode
+        },
+        'wall_seconds': wall_seconds,
+        'throughput': {
+            'jobs_per_second': (len(jobs) - len(failures)) / wall_seconds,
+            'pages_per_second': succeeded_pages / wall_seconds
+        },
+        'latency_seconds': distribution(latencies),
+        'stages_seconds': {stage: distribution(durations) for stage, durations in sorted(stages.items())},
+        'memory': {
+            'peak_rss_bytes': peak_rss,
+            # pdftoppm and the render processes
+            'peak_child_rss_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        },
+        'gemini': {
+            'requests': fake_gemini.requests,
+            'prompt_tokens': sum(summary['prompt_token_count'] for summary in summaries),
+            'total_tokens': sum(summary['total_token_count'] for summary in summaries)
+        },
+        'storage': {
+            'bytes_uploaded': fake_supabase.bucket.bytes_uploaded,
+            'objects': len(fake_supabase.bucket.objects)
+        },
+        'failures': failures
+    }
+
+# Metrics compared against the baseline, and whether a higher value is better
+COMPARED_METRICS = [
+    (('throughput', 'pages_per_second'), True),
+    (('throughput', 'jobs_per_second'), True),
+    (('latency_seconds', 'p50'), False),
+    (('latency_seconds', 'p95'), False),
+    (('latency_seconds', 'p99'), False),
+    (('memory', 'peak_rss_bytes'), False),
+    (('gemini', 'prompt_tokens'), False)
+]
+
+def _lookup(report, path):
+    for key in path:
+        report = (report or {}).get(key)
+    return report
+
+def compare(report, baseline, tolerance):
+    """
+    Returns (rows, regressions). A metric regresses when it is worse than the baseline by more than tolerance.
+    """
+    metrics = list(COMPARED_METRICS)
+    for stage in report['stages_seconds']:
+        metrics.append((('stages_seconds', stage, 'p50'), False))
+
+    rows = []
+    regressions = []
+    for path, higher_is_better in metrics:
+        current, previous = _lookup(report, path), _lookup(baseline, path)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        regressed = change < -tolerance if higher_is_better else change > tolerance
+        rows.append(('.'.join(path), previous, current, change, regressed))
+        if regressed:
+            regressions.append('.'.join(path))
+    return rows, regressions
+
+def _format(value):
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    return str(value)
+
+def print_report(report):
+    print(f"\nScenario: {json.dumps(report['scenario'])}")
+    print(f"Wall time {report['wall_seconds']:.2f}s, {report['throughput']['jobs_per_second']:.3f} jobs/s, "
+          f"{report['throughput']['pages_per_second']:.2f} pages/s")
+    latency = report['latency_seconds']
+    if latency['count']:
+        print(f"Latency p50 {latency['p50']:.2f}s  p95 {latency['p95']:.2f}s  p99 {latency['p99']:.2f}s  max {latency['max']:.2f}s")
+    print(f"Peak RSS {report['memory']['peak_rss_bytes'] / 1024 / 1024:.0f} MB (children {report['memory']['peak_child_rss_bytes'] / 1024 / 1024:.0f} MB)")
+    print(f"Gemini {report['gemini']['requests']} requests, {report['gemini']['prompt_tokens']} prompt tokens")
+
+    print(f"\n{'stage':<16}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for stage, timing in report['stages_seconds'].items():
+        print(f"{stage:<16}{timing['mean']:>10.3f}{timing['p50']:>10.3f}{timing['p95']:>10.3f}{timing['p99']:>10.3f}")
+
+    for failure in report['failures']:
+        print(f"FAILED {failure['task_id']} ({failure['pages']} pages): {failure['result']}")
+
+def main(argv = None):
+    args = parse_args(argv)
+    report = run(args)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    exit_code = 1 if report['failures'] else 0
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved the baseline to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('scenario') != report['scenario']:
+            print("\nWarning: the baseline was recorded with a different scenario")
+
+        rows, regressions = compare(report, baseline, args.tolerance)
+        print(f"\n{'metric':<36}{'baseline':>12}{'current':>12}{'change':>9}")
+        for name, previous, current, change, regressed in rows:
+            print(f"{name:<36}{_format(previous):>12}{_format(current):>12}{change:>+8.1%}{'  REGRESSED' if regressed else ''}")
+        if regressions and args.fail_on_regression:
+            exit_code = 1
+    else:
+        print(f"\nNo baseline at {args.baseline}, run with --save-baseline to record one")
+
+    return exit_code
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,248 @@
+"""
+Startup benchmark of the web tier and of the workers. Each run starts a fresh interpreter, like a new pod or
+a restarted worker, and measures how long the imports take, how long the first requests take and how long
+the Supabase and Gemini clients take to create on first use. Nothing talks to the network.
+
+Run from backend/flask:
+
+    python -m benchmarks.startup --runs 5
+    python -m benchmarks.startup --top-imports 15          # also lists the slowest imports of the web tier
+    python -m benchmarks.startup --save-baseline
+    python -m benchmarks.startup --fail-on-regression
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+from types import SimpleNamespace
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+FLASK_DIR = os.path.dirname(BENCHMARK_DIR)
+DEFAULT_BASELINE_PATH = os.path.join(BENCHMARK_DIR, 'startup_baseline.json')
+PROBES = ('web', 'worker')
+# Modules the web tier should not need to import, their presence is reported after startup
+HEAVY_MODULES = (
+    'google.genai', 'supabase', 'pdf2image', 'app.services.celery_tasks', 'app.services.file_content_extractor', 'app.services.file_converter'
+)
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description="Benchmark the startup of the web tier and of the workers.")
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters started per process type")
+    parser.add_argument('--warmup', type=int, default=1, help="Runs discarded first, while the file cache warms up")
+    parser.add_argument('--top-imports', type=int, default=0, help="List the N slowest imports of the web tier")
+    parser.add_argument('--output', help="Also write the report as JSON to this path")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed slowdown against the baseline (0.2 = 20%%)")
+    parser.add_argument('--fail-on-regression', action='store_true')
+    # Used internally, runs one probe in this process and prints its measurements
+    parser.add_argument('--probe', choices=PROBES, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def _heavy_modules():
+    return sorted(name for name in HEAVY_MODULES if name in sys.modules)
+
+def probe_web():
+    started = time.perf_counter()
+    from app import create_app
+    imported = time.perf_counter()
+    app = create_app({'TESTING': True})
+    created = time.perf_counter()
+    heavy_modules = _heavy_modules()
+    module_count = len(sys.modules)
+
+    client = app.test_client()
+    client.get('/')
+    first_request = time.perf_counter()
+    client.get(f'/task-status/{uuid.uuid4()}')
+    first_status = time.perf_counter()
+
+    # What the first request that reads or writes a material pays on top
+    from app.config import supabase_client
+    supabase_client.get_client()
+    supabase_ready = time.perf_counter()
+
+    return {
+        'import_seconds': imported - started,
+        'create_app_seconds': created - imported,
+        'first_request_seconds': first_request - created,
+        'first_status_seconds': first_status - first_request,
+        'supabase_client_seconds': supabase_ready - first_status,
+        'ready_seconds': first_request - started,
+        'modules': module_count,
+        'heavy_modules': heavy_modules,
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    }
+
+def probe_worker():
+    started = time.perf_counter()
+    # What "celery -A app.config.celery worker" imports before it starts consuming
+    from app.config.celery import celery
+    celery.loader.import_default_modules()
+    imported = time.perf_counter()
+    module_count = len(sys.modules)
+
+    # Created by the first task of every worker process
+    from app.config import supabase_client
+    from app.services import file_content_extractor
+    supabase_client.get_client()
+    supabase_ready = time.perf_counter()
+    file_content_extractor.get_backend()
+    gemini_ready = time.perf_counter()
+
+    return {
+        'import_seconds': imported - started,
+        'supabase_client_seconds': supabase_ready - imported,
+        'gemini_client_seconds': gemini_ready - supabase_ready,
+        'ready_seconds': gemini_ready - started,
+        'modules': module_count,
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    }
+
+def run_probe(probe, python_options = ()):
+    completed = subprocess.run(
+        [sys.executable, *python_options, '-m', 'benchmarks.startup', '--probe', probe],
+        cwd=FLASK_DIR, capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"The {probe} probe failed:\n{completed.stderr}")
+    # The app may print while it starts, the measurements are on the last line
+    return json.loads(completed.stdout.strip().splitlines()[-1]), completed.stderr
+
+def top_imports(count):
+    """
+    Returns the slowest top-level imports of the web tier, from the -X importtime output of a fresh interpreter.
+    """
+    _, stderr = run_probe('web', ('-X', 'importtime'))
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented, their time is already in the cumulative time of their parent
+        if name.startswith('  ') or not cumulative.strip().isdigit():
+            continue
+        imports.append({'module': name.strip(), 'cumulative_seconds': int(cumulative) / 1e6})
+    return sorted(imports, key=lambda entry: entry['cumulative_seconds'], reverse=True)[:count]
+
+def run(args):
+    # Only in the parent, the probes must not import the corpus builder and the fakes
+    from .run import configure_environment, distribution
+
+    work_dir = tempfile.mkdtemp(prefix='studyshare-startup-')
+    # The probes inherit the environment of the eager benchmark, without Redis or any network service
+    configure_environment(SimpleNamespace(mode='eager', scratch_mode='auto', cache=False, lazy_pages=0), work_dir)
+
+    report = {'scenario': {'runs': args.runs, 'python': sys.version.split()[0]}}
+    try:
+        for probe in PROBES:
+            for _ in range(args.warmup):
+                run_probe(probe)
+            results = [run_probe(probe)[0] for _ in range(args.runs)]
+
+            timings = {key: distribution([result[key] for result in results]) for key in results[0] if key.endswith('_seconds')}
+            report[probe] = {
+                'seconds': timings,
+                'modules': results[-1]['modules'],
+                'peak_rss_bytes': max(result['peak_rss_bytes'] for result in results)
+            }
+            if 'heavy_modules' in results[-1]:
+                report[probe]['heavy_modules'] = results[-1]['heavy_modules']
+
+        if args.top_imports:
+            report['web']['top_imports'] = top_imports(args.top_imports)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+# Metrics compared against the baseline, all of them lower is better
+COMPARED_METRICS = [
+    ('web', 'seconds', 'import_seconds', 'p50'),
+    ('web', 'seconds', 'first_request_seconds', 'p50'),
+    ('web', 'seconds', 'ready_seconds', 'p50'),
+    ('web', 'peak_rss_bytes'),
+    ('worker', 'seconds', 'import_seconds', 'p50'),
+    ('worker', 'seconds', 'ready_seconds', 'p50'),
+    ('worker', 'peak_rss_bytes')
+]
+
+def compare(report, baseline, tolerance):
+    """
+    Returns (rows, regressions). A metric regresses when it is higher than the baseline by more than tolerance.
+    """
+    from .run import _lookup
+
+    rows = []
+    regressions = []
+    for path in COMPARED_METRICS:
+        current, previous = _lookup(report, path), _lookup(baseline, path)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        rows.append(('.'.join(path), previous, current, change, change > tolerance))
+        if change > tolerance:
+            regressions.append('.'.join(path))
+    return rows, regressions
+
+def print_report(report):
+    print(f"\nScenario: {json.dumps(report['scenario'])}")
+    for probe in PROBES:
+        result = report[probe]
+        print(f"\n{probe}: {result['modules']} modules, peak RSS {result['peak_rss_bytes'] / 1024 / 1024:.0f} MB")
+        if 'heavy_modules' in result:
+            print(f"Heavy modules loaded at startup: {', '.join(result['heavy_modules']) or 'none'}")
+        print(f"{'step':<28}{'mean':>10}{'p50':>10}{'max':>10}")
+        for step, timing in result['seconds'].items():
+            print(f"{step:<28}{timing['mean']:>10.3f}{timing['p50']:>10.3f}{timing['max']:>10.3f}")
+
+    if report['web'].get('top_imports'):
+        print(f"\n{'slowest web imports':<40}{'seconds':>10}")
+        for entry in report['web']['top_imports']:
+            print(f"{entry['module']:<40}{entry['cumulative_seconds']:>10.3f}")
+
+def main(argv = None):
+    args = parse_args(argv)
+    if args.probe:
+        sys.path.insert(0, FLASK_DIR)
+        print(json.dumps(probe_web() if args.probe == 'web' else probe_worker()))
+        return 0
+
+    report = run(args)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    exit_code = 0
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved the baseline to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('scenario') != report['scenario']:
+            print("\nWarning: the baseline was recorded with a different scenario")
+
+        from .run import _format
+
+        rows, regressions = compare(report, baseline, args.tolerance)
+        print(f"\n{'metric':<44}{'baseline':>14}{'current':>14}{'change':>9}")
+        for name, previous, current, change, regressed in rows:
+            print(f"{name:<44}{_format(previous):>14}{_format(current):>14}{change:>+8.1%}{'  REGRESSED' if regressed else ''}")
+        if regressions and args.fail_on_regression:
+            exit_code = 1
+    else:
+        print(f"\nNo baseline at {args.baseline}, run with --save-baseline to record one")
+
+    return exit_code
+
+if __name__ == '__main__':
+    sys.exit(main())
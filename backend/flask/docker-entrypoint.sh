@@ -0,0 +1,12 @@
+#!/bin/sh
+set -e
+
+# prometheus_client writes the metrics of every worker process to PROMETHEUS_MULTIPROC_DIR as soon as the app
+# is imported, so the directory must exist before Celery starts. Files of a previous run would be summed into
+# this one, so it starts empty.
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
+
+exec "$@"
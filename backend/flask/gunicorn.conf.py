@@ -0,0 +1,11 @@
+import os
+
+# Loaded by gunicorn from the working directory, see the Dockerfile
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+# gevent runs every request in a greenlet, so long-lived /task-events streams don't tie up a thread each
+# and can't starve the upload and status endpoints. "gthread" uses a fixed pool of GUNICORN_THREADS instead.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+workers = int(os.getenv("GUNICORN_WORKERS", 1))
+# Concurrent connections of a gevent worker, event streams included
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", 1000))
+threads = int(os.getenv("GUNICORN_THREADS", 16))
@@ -0,0 +1,88 @@
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+
+FLASK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, FLASK_DIR)
+
+# Every module reads its settings at import time. Empty values win over .flask.env, so nothing talks to
+# Redis, Supabase or Gemini, and the in-memory result backend stands in for Redis (as in benchmarks/run.py).
+_work_dir = tempfile.mkdtemp(prefix='studyshare-tests-')
+os.environ.update({
+    'SUPABASE_URL': 'http://localhost:54321',
+    'SUPABASE_ANON_KEY': 'test',
+    'SUPABASE_BUCKET': 'test',
+    'GEMINI_API_KEY': 'test',
+    'BLOB_SPOOL_DIR': os.path.join(_work_dir, 'spool'),
+    'PAGE_CACHE_DIR': os.path.join(_work_dir, 'page-cache'),
+    'SCRATCH_DIR': os.path.join(_work_dir, 'scratch'),
+    'CELERY_BROKER_URL': '',
+    'REDIS_URL': '',
+    'CELERY_RESULT_BACKEND': 'cache+memory://'
+})
+
+class FakeQuery:
+    """
+    The insert, select, update, eq and limit calls of the models, on in-memory rows.
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.filters = []
+        self.inserted = None
+        self.changes = None
+        self.row_limit = None
+
+    def insert(self, data):
+        self.inserted = data if isinstance(data, list) else [data]
+        return self
+
+    def select(self, columns = "*"):
+        return self
+
+    def update(self, changes):
+        self.changes = changes
+        return self
+
+    def eq(self, column, value):
+        self.filters.append((column, value))
+        return self
+
+    def limit(self, count):
+        self.row_limit = count
+        return self
+
+    def execute(self):
+        if self.inserted is not None:
+            self.rows.extend(dict(row) for row in self.inserted)
+            return SimpleNamespace(data=self.inserted)
+        rows = [row for row in self.rows if all(row.get(column) == value for column, value in self.filters)]
+        for row in rows if self.changes is not None else []:
+            row.update(self.changes)
+        return SimpleNamespace(data=[dict(row) for row in rows[:self.row_limit]])
+
+class FakeSupabase:
+    """
+    Records the RPC calls of the app instead of sending them to Supabase, and keeps the rows of tables in memory.
+    """
+    def __init__(self):
+        self.rpc_calls = []
+        self.tables = {}
+
+    def table(self, name):
+        return FakeQuery(self.tables.setdefault(name, []))
+
+    def rpc(self, name, params):
+        self.rpc_calls.append((name, params))
+        return SimpleNamespace(execute=lambda: SimpleNamespace(data=None))
+
+@pytest.fixture
+def fake_supabase():
+    from app.config import supabase_client
+
+    fake = FakeSupabase()
+    previous = supabase_client.set_client(fake)
+    yield fake
+    supabase_client.set_client(previous)
@@ -0,0 +1,25 @@
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+
+from app.services import admission
+
+@pytest.fixture
+def redis(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(admission, 'redis_client', client)
+    return client
+
+def test_a_task_is_taken_off_the_backlog_once(redis):
+    file_info = {}
+    admission.record_enqueued(file_info, 'conversion-small', {'pages': 10})
+    admission.record_enqueued({}, 'conversion-small', {'pages': 5})
+    task = SimpleNamespace(request=SimpleNamespace(retries=0))
+
+    # The first delivery, then a redelivery after the worker died, then a retry
+    for retries in (0, 0, 1):
+        task.request.retries = retries
+        admission.take_off_backlog(task_id='task-1', task=task, args=(file_info, {}))
+
+    assert float(redis.hget(admission.QUEUED_PAGES_KEY, 'conversion-small')) == 5
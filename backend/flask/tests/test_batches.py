@@ -0,0 +1,75 @@
+import io
+import json
+import zipfile
+from datetime import datetime
+
+from werkzeug.datastructures import FileStorage
+
+from app.models.material import MaterialBundle
+from app.services import batches
+
+def plan_batch(filenames, shared_info, items = None):
+    files = [FileStorage(io.BytesIO(b'%PDF-1.4 test'), filename=filename) for filename in filenames]
+    uploads, skipped = batches.spool_batch(files)
+    assert not skipped
+    jobs = batches.plan_jobs(uploads, shared_info, items or {})
+    batches.discard(uploads)
+    return jobs
+
+def create_material(job):
+    # What save_material_records commits for a converted file of the batch
+    info = json.loads(job['form']['info'])
+    info['num_page'] = 1
+    MaterialBundle(info['material_id']).add_material(info).commit()
+    return info['material_id']
+
+def committed_materials(fake_supabase):
+    return [params['payload']['material'] for name, params in fake_supabase.rpc_calls if name == 'create_material_bundle']
+
+def test_batch_material_has_the_defaults_of_a_new_material(fake_supabase):
+    job, = plan_batch(['notes.pdf'], {'user_id': 'user-1', 'subject_id': 'subject-1', 'description': 'Week 1'})
+    material_id = create_material(job)
+
+    material, = committed_materials(fake_supabase)
+    assert material['material_id'] == material_id
+    assert material['name'] == 'notes'
+    assert material['file_type'] == 'pdf'
+    assert material['user_id'] == 'user-1'
+    assert material['description'] == 'Week 1'
+    assert datetime.fromisoformat(material['upload_date'])
+    for column in ('download_count', 'view_count', 'rating_count', 'total_rating', 'price'):
+        assert material[column] == 0
+    assert material['is_paid'] is False
+
+def test_shared_info_and_items_override_the_defaults(fake_supabase):
+    jobs = plan_batch(
+        ['free.pdf', 'paid.pdf'],
+        {'user_id': 'user-1', 'is_public': False},
+        {'paid.pdf': {'is_paid': True, 'price': 5}}
+    )
+    for job in jobs:
+        create_material(job)
+
+    materials = {material['name']: material for material in committed_materials(fake_supabase)}
+    assert materials['free']['is_paid'] is False and materials['free']['price'] == 0
+    assert materials['paid']['is_paid'] is True and materials['paid']['price'] == 5
+    assert not materials['free']['is_public'] and not materials['paid']['is_public']
+
+def test_zip_members_with_the_same_name_are_kept_apart():
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as z:
+        z.writestr('week-1/notes.pdf', b'%PDF-1.4 one')
+        z.writestr('week-2/notes.pdf', b'%PDF-1.4 two')
+    archive.seek(0)
+    files = [FileStorage(archive, filename='notes.zip'), FileStorage(io.BytesIO(b'%PDF-1.4 three'), filename='week-1/notes.pdf')]
+
+    uploads, skipped = batches.spool_batch(files)
+    jobs = batches.plan_jobs(uploads, {'user_id': 'user-1'}, {'week-2/notes.pdf': {'description': 'Week 2'}})
+    batches.discard(uploads)
+
+    # The upload named like the first member would shadow it in items, it is reported instead
+    assert [upload['filename'] for upload in uploads] == ['week-1/notes.pdf', 'week-2/notes.pdf']
+    assert skipped == ['week-1/notes.pdf']
+    infos = [json.loads(job['form']['info']) for job in jobs]
+    assert [info['name'] for info in infos] == ['notes', 'notes']
+    assert 'description' not in infos[0] and infos[1]['description'] == 'Week 2'
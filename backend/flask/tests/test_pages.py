@@ -0,0 +1,51 @@
+import pytest
+
+from app import create_app
+from app.models.material import Material
+from app.services import file_converter
+from app.services import lazy_renderer
+from app.services.page_cache import cache as page_cache
+
+@pytest.fixture
+def client():
+    return create_app({'TESTING': True}).test_client()
+
+@pytest.fixture
+def material(fake_supabase, monkeypatch, tmp_path):
+    fake_supabase.tables['Material'] = [{'material_id': 'material-1', 'is_public': True, 'is_paid': False}]
+    fake_supabase.tables['MaterialPage'] = [{'material_id': 'material-1', 'page': 2, 'url': None, 'is_rendered': False}]
+
+    def download_file(storage_path, dest_path):
+        with open(dest_path, 'wb') as f:
+            f.write(b'%' * 100)
+
+    def render_page(pdf_path, output_dir, prefix, page, quality = 20, dpi = None):
+        renditions = {}
+        for name in ('reader', 'thumbnail', 'zoom'):
+            path = tmp_path / f'{name}.webp'
+            path.write_bytes(name.encode() * 25)
+            renditions[name] = {'file': str(path)}
+        return {'kind': 'text', 'renditions': renditions}
+
+    monkeypatch.setattr(Material, 'download_file', download_file)
+    monkeypatch.setattr(file_converter, 'render_page', render_page)
+    # Rendered pages are uploaded in the background, that is not what these tests are about
+    monkeypatch.setattr(lazy_renderer._upload_executor, 'submit', lambda *args: None)
+    return fake_supabase.tables['Material'][0]
+
+def test_page_rendered_on_demand_is_served_when_the_cache_is_full(client, material, monkeypatch):
+    # Room for less than the source and the three renditions of the page
+    monkeypatch.setattr(page_cache, 'max_bytes', 250)
+
+    response = client.get('/materials/material-1/page/2.webp')
+
+    assert response.status_code == 200
+    assert response.data == b'reader' * 25
+
+@pytest.mark.parametrize('visibility', [{'is_public': False}, {'is_paid': True}])
+def test_pages_of_private_and_paid_materials_are_not_served(client, material, visibility):
+    material.update(visibility)
+
+    response = client.get('/materials/material-1/page/2.webp')
+
+    assert response.status_code == 404
@@ -0,0 +1,27 @@
+from types import SimpleNamespace
+
+from app.services.progress import ProgressReporter
+
+class FakeTask:
+    def __init__(self, retries):
+        self.request = SimpleNamespace(id='celery-task-1', retries=retries)
+
+    def update_state(self, **kwargs):
+        pass
+
+def test_resumed_attempt_keeps_the_log_of_the_earlier_attempts(fake_supabase):
+    first = ProgressReporter(FakeTask(0), 'task-1', 'material-1')
+    first.cache_hit([])
+    first.retrying(RuntimeError('storage unavailable'))
+
+    second = ProgressReporter(FakeTask(1), 'task-1', 'material-1', resumed=True)
+    second.close()
+
+    task, = fake_supabase.tables['Task']
+    assert task['status'] == 'pending'
+    assert task['content'].splitlines() == [
+        '- [Step 1/5] Starting conversion task',
+        '- [Step 2-4/5] Reused the content and 0 WebP files of an identical upload',
+        '- Attempt 1 failed: storage unavailable, retrying',
+        '- Resuming after a failed attempt (retry 1)'
+    ]
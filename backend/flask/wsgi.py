@@ -1,9 +1,13 @@
 from app import create_app
 from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_client import REGISTRY
+from app.services.admission import BacklogCollector
 
 app = create_app()
 metrics = PrometheusMetrics(app)
 metrics.info('app_info', 'File Conversion Service', version='1.0.0')
+# The conversion backlog, scraped by Prometheus for the KEDA scaler of the workers
+REGISTRY.register(BacklogCollector())
 
 if __name__ == '__main__':
     app.run(debug=False)
\ No newline at end of file
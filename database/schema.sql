@@ -69,6 +69,16 @@ CREATE TABLE public.MaterialPage (
   material_id character varying NOT NULL,
   page smallint NOT NULL,
   url text,
+  thumbnail_url text,
+  zoom_url text,
+  width integer,
+  height integer,
+  byte_size integer,
+  content_kind character varying,
+  is_rendered boolean NOT NULL DEFAULT true,
+  text_content text,
+  summary_content text,
+  search_vector tsvector,
   CONSTRAINT MaterialPage_pkey PRIMARY KEY (page, material_id),
   CONSTRAINT MaterialPage_material_id_fkey FOREIGN KEY (material_id) REFERENCES public.Material(material_id)
 );
@@ -162,4 +172,115 @@ CREATE TABLE public.User (
   is_verified boolean DEFAULT false,
   verification_code character varying,
   CONSTRAINT User_pkey PRIMARY KEY (user_id)
-);
\ No newline at end of file
+);
+-- Inserts every record of a converted material in one transaction, called by the Flask worker through RPC.
+-- If any insert fails the whole bundle is rolled back, so no orphan Material rows are left behind.
+CREATE OR REPLACE FUNCTION public.create_material_bundle(payload jsonb)
+RETURNS void
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  material_row public."Material";
+BEGIN
+  material_row := jsonb_populate_record(NULL::public."Material", payload->'material');
+
+  -- A retried task may commit the same bundle again when the response of its first commit was lost
+  IF EXISTS (SELECT 1 FROM public."Material" WHERE material_id = material_row.material_id) THEN
+    RETURN;
+  END IF;
+
+  -- jsonb_populate_record leaves every column missing from the payload NULL, and inserting the whole record
+  -- bypasses the column defaults. These are the values of a new material, as sent by the upload page.
+  material_row.upload_date := coalesce(material_row.upload_date, (now() AT TIME ZONE 'utc'));
+  material_row.download_count := coalesce(material_row.download_count, 0);
+  material_row.view_count := coalesce(material_row.view_count, 0);
+  material_row.rating_count := coalesce(material_row.rating_count, 0);
+  material_row.total_rating := coalesce(material_row.total_rating, 0);
+  material_row.is_paid := coalesce(material_row.is_paid, false);
+  material_row.price := coalesce(material_row.price, 0);
+  material_row.is_public := coalesce(material_row.is_public, true);
+  INSERT INTO public."Material" SELECT material_row.*;
+
+  INSERT INTO public."MaterialPage"
+  SELECT * FROM jsonb_populate_recordset(NULL::public."MaterialPage", payload->'pages');
+
+  IF jsonb_typeof(payload->'summary') = 'object' THEN
+    INSERT INTO public."MaterialSummary"
+    SELECT * FROM jsonb_populate_record(NULL::public."MaterialSummary", payload->'summary');
+  END IF;
+
+  INSERT INTO public."Rating"
+  SELECT * FROM jsonb_populate_recordset(NULL::public."Rating", payload->'ratings');
+
+  IF jsonb_typeof(payload->'pending_task') = 'object' THEN
+    UPDATE public."Task"
+    SET content = payload->'pending_task'->>'content'
+    WHERE task_id = payload->'pending_task'->>'task_id' AND status = 'pending';
+  END IF;
+
+  INSERT INTO public."Task"
+  SELECT * FROM jsonb_populate_recordset(NULL::public."Task", payload->'tasks');
+END;
+$$;
+
+-- Full-text index of material pages. The trigger fills search_vector from the local text layer (weight A)
+-- and the page's section of the summary (weight B), so pages are indexed in the same transaction that inserts them.
+CREATE OR REPLACE FUNCTION public.update_material_page_search_vector()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  NEW.search_vector :=
+    setweight(to_tsvector('simple', coalesce(NEW.text_content, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(NEW.summary_content, '')), 'B');
+  RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER material_page_search_vector_update
+BEFORE INSERT OR UPDATE OF text_content, summary_content ON public."MaterialPage"
+FOR EACH ROW EXECUTE FUNCTION public.update_material_page_search_vector();
+
+CREATE INDEX material_page_search_idx ON public."MaterialPage" USING GIN (search_vector);
+
+-- Ranked page hits of public, free materials with a highlighted snippet. Snippets are only built for the returned rows,
+-- ts_headline re-parses the text and is the expensive part of the query.
+CREATE OR REPLACE FUNCTION public.search_material_pages(query text, result_limit integer DEFAULT 20, result_offset integer DEFAULT 0)
+RETURNS TABLE (
+  material_id character varying,
+  name character varying,
+  page smallint,
+  url text,
+  thumbnail_url text,
+  rank real,
+  snippet text
+)
+LANGUAGE sql
+STABLE
+AS $$
+  WITH search AS (
+    SELECT websearch_to_tsquery('simple', query) AS tsquery
+  ),
+  hits AS (
+    SELECT p.material_id, p.page, p.url, p.thumbnail_url, p.text_content, p.summary_content,
+      ts_rank_cd(p.search_vector, search.tsquery) AS rank
+    FROM public."MaterialPage" p
+    JOIN public."Material" m ON m.material_id = p.material_id
+    CROSS JOIN search
+    -- Paid materials are left out, their text and summaries are only for the users who bought them
+    WHERE p.search_vector @@ search.tsquery AND m.is_public AND NOT coalesce(m.is_paid, false)
+    ORDER BY rank DESC, p.material_id, p.page
+    LIMIT result_limit OFFSET result_offset
+  )
+  SELECT hits.material_id, m.name, hits.page, hits.url, hits.thumbnail_url, hits.rank,
+    -- Highlight the local text when it matched, the summary otherwise
+    ts_headline('simple',
+      CASE WHEN to_tsvector('simple', coalesce(hits.text_content, '')) @@ search.tsquery
+        THEN hits.text_content ELSE coalesce(hits.summary_content, '') END,
+      search.tsquery,
+      'MaxFragments=2, MaxWords=25, MinWords=10, StartSel=<mark>, StopSel=</mark>') AS snippet
+  FROM hits
+  JOIN public."Material" m ON m.material_id = hits.material_id
+  CROSS JOIN search
+  ORDER BY hits.rank DESC, hits.material_id, hits.page;
+$$;